@@ -176,6 +176,70 @@ class MailServices {
 		throw new Exception('Mail-Services unknown error');
 	}
 
+	public function setGroupWeight($id, $weight) {
+		$result = $this -> sendAndRead(array(
+			'command' => 'group',
+			'group' => array('id' => $id, 'weight' => $weight),
+		));
+
+		if (! empty($result)) {
+			if (! empty($result['group']['id'])) {
+				// Success
+				return $result['group']['id'];
+			}
+		}
+
+		throw new Exception('Mail-Services unknown error');
+	}
+
+	public function setGroupLimits($id, $rate, $dailyQuota) {
+		$result = $this -> sendAndRead(array(
+			'command' => 'group',
+			'group' => array('id' => $id, 'rate' => $rate, 'daily_quota' => $dailyQuota),
+		));
+
+		if (! empty($result)) {
+			if (! empty($result['group']['id'])) {
+				// Success
+				return $result['group']['id'];
+			}
+		}
+
+		throw new Exception('Mail-Services unknown error');
+	}
+
+	public function setGroupStart($id, $start) {
+		$result = $this -> sendAndRead(array(
+			'command' => 'group',
+			'group' => array('id' => $id, 'start_at' => $start),
+		));
+
+		if (! empty($result)) {
+			if (! empty($result['group']['id'])) {
+				// Success
+				return $result['group']['id'];
+			}
+		}
+
+		throw new Exception('Mail-Services unknown error');
+	}
+
+	public function setGroupDeadline($id, $deadline) {
+		$result = $this -> sendAndRead(array(
+			'command' => 'group',
+			'group' => array('id' => $id, 'deadline' => $deadline),
+		));
+
+		if (! empty($result)) {
+			if (! empty($result['group']['id'])) {
+				// Success
+				return $result['group']['id'];
+			}
+		}
+
+		throw new Exception('Mail-Services unknown error');
+	}
+
 	public function addGroup(Array $data) {
 		$result = $this -> sendAndRead(array(
 			'command' => 'group',
@@ -223,6 +287,7 @@ class MailServices {
 				'message' => (! empty($this -> data['message']) ? $this -> data['message'] : null),
 				'to' => $data,
 				'group' => (! empty($this -> data['group']) ? (is_array($this -> data['group']) ? $this -> data['group']['id'] : $this -> data['group']) : null),
+				'class' => (! empty($this -> data['class']) ? $this -> data['class'] : null),
 			));
 
 			if (! empty($result)) {
@@ -274,6 +339,14 @@ class MailServices {
 		return $this -> delete('message', $id, $force);
 	}
 
+	public function setTransactional($value) {
+		if (null === $this -> data) {
+			$this -> data = array();
+		}
+
+		$this -> data['class'] = ($value ? 'transactional' : 'bulk');
+	}
+
 	public function bufferTo($value) {
 		$this -> bufferTo = !! $value;
 	}
@@ -285,6 +358,7 @@ class MailServices {
 				'message' => (! empty($this -> data['message']) ? $this -> data['message'] : null),
 				'to' => $this -> data['to'],
 				'group' => (! empty($this -> data['group']) ? (is_array($this -> data['group']) ? $this -> data['group']['id'] : $this -> data['group']) : null),
+				'class' => (! empty($this -> data['class']) ? $this -> data['class'] : null),
 			));
 
 			// Clean
@@ -82,17 +82,67 @@ class Config(ConfigParser, Notify):
 
 	  '[db]',
 	  'sync=3600 0, 120 100',
+	  'engine=files',
+	  'engine-interval=0.5',
+	  'engine-batch=5000',
+	  'engine-segment-size=67108864',
+	  'engine-garbage=0.5',
+	  'engine-fsync=yes',
+	  'write-behind=yes',
+	  'write-behind-size=33554432',
+	  'cache-size=67108864',
+	  'cache-life=60',
+	  'parts-inline=256',
+	  'background=no',
+	  'format=marshal',
+	  'fast-start=no',
+	  'fast-start-slice=1000',
+	  'queue-memory=0',
+	  'queue-batch=1000',
+	  'queue-segment=67108864',
+	  'journal=no',
+	  'journal-interval=0.5',
+	  'journal-fsync=yes',
+	  'journal-size=67108864',
 
 	  '[sender]',
 	  'debug=no',
 	  'workers=1',
 	  'interval-empty=5.0',
 	  'interval-next=0.5',
+	  'rate=0',
+	  'rate-burst=0',
+	  'quota-hour=0',
+	  'quota-day=0',
 	  'attach-images=yes',
 	  'attach-images-min-size=0',
 	  'attach-images-max-size=2097152',
 	  'attach-images-from=src',
 	  'attach-images-threads=5',
+	  'domain-rate=0',
+	  'domain-inflight=0',
+	  'domain-hold=10000',
+	  'domain-scan=100',
+	  'domain-backoff=0.5',
+	  'domain-backoff-rate=10',
+	  'domain-backoff-codes=421 450 451',
+	  'domain-probe=0.1',
+	  'domain-min-rate=0.1',
+	  'retry-delay=60',
+	  'retry-factor=2',
+	  'retry-delay-max=3600',
+	  'retry-age=86400',
+	  'retry-connect=10',
+	  'retry-defer=10',
+	  'retry-reject=0',
+	  'retry-error=1',
+	  'retry-share=0.25',
+	  'express-workers=0',
+	  'express-connections=0',
+	  'express-interval=0.1',
+	  'express-target=2.0',
+
+	  '[domains]',
 
 	  '[receiver]',
 	  'listen=tcp:6132',
@@ -143,6 +193,18 @@ class Config(ConfigParser, Notify):
 		# Success
 		return sync
 
+	def domainLimits(self):
+		limits = dict()
+
+		for name, value in self.items('domains'):
+			row = value.split()
+
+			if len(row) == 2:
+				limits[name.strip().lower()] = (float(row[0]), int(row[1]))
+
+		# Success
+		return limits
+
 
 config = Config()
 
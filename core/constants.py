@@ -44,6 +44,12 @@ QUEUE_MAX_PRIORITY = 10
 QUEUE_PAUSE_PRIORITY = QUEUE_MAX_PRIORITY * 2
 QUEUE_UNPAUSE_PRIORITY = 1
 
+# Lane level of retried recipients, served after all others
+QUEUE_RETRY_LEVEL = -1
+
+# Lane level of transactional recipients, served by own workers
+QUEUE_EXPRESS_LEVEL = -2
+
 (
 	GROUP_STATUS_ACTIVE,
 	GROUP_STATUS_PAUSED,
@@ -21,20 +21,27 @@ import os
 from marshal import dump as mdump, load as mload
 from itertools import count
 from heapq import heappush, heappop, heapify
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
+from itertools import chain
+from functools import partial
 from time import time
 
 from twisted.python import log
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.address import IPv4Address, UNIXAddress
-from twisted.internet.task import LoopingCall
+from twisted.internet.task import LoopingCall, cooperate, TaskStopped
+from twisted.internet.threads import deferToThread
 
-from core.constants import DEBUG, QUEUE_PAUSE_PRIORITY, QUEUE_UNPAUSE_PRIORITY, QUEUE_MAX_PRIORITY
+from core.constants import DEBUG, QUEUE_PAUSE_PRIORITY, QUEUE_UNPAUSE_PRIORITY, QUEUE_MAX_PRIORITY, QUEUE_RETRY_LEVEL, QUEUE_EXPRESS_LEVEL
 from core.constants import GROUP_STATUS_ACTIVE, GROUP_STATUS_PAUSED, GROUP_STATUS_INACTIVE
 from core.configs import config
 from core.dirs import dbs, tmp
-from core.mappers import Message, To, Group
+from core.mappers import Message, To, Group, bodies
+from core.storage import storage
+from core.records import RecordWriter, RecordReader
+from core.queues import SpoolQueue, BucketQueue, Budget, Lane, TimingWheel
+from core.limits import TokenBucket
 
 
 class Base:
@@ -51,6 +58,20 @@ class Base:
 
 		self.lastSyncTime = time()
 
+		self.saving = None
+		self.loading = None
+		self.background = config.getboolean('db', 'background')
+		self.format = config.get('db', 'format')
+
+		self.stats = (dict(
+			saves=0,
+			savePause=0.0,
+			saveWrite=0.0,
+		))
+
+		self.journal = storage.journal(self.name)
+		self.journalSize = config.getint('db', 'journal-size')
+
 	@property
 	def id(self):
 		return self.next.next()
@@ -58,12 +79,224 @@ class Base:
 	def load(self):
 		raise NotImplementedError
 
-	def save(self):
+	def read(self):
+		"""Snapshot counter and iterator over its rows"""
+		if not os.path.exists(self.file):
+			return None, ()
+
+		fp = open(self.file, 'rb')
+
+		if RecordReader.match(fp):
+			reader = iter(RecordReader(fp))
+
+			try:
+				# First record is header
+				header = reader.next()
+			except StopIteration:
+				fp.close()
+
+				log.msg(self, 'load', 'damaged header')
+
+				# Fail
+				return None, ()
+			except:
+				fp.close()
+				raise
+
+			log.msg(self, 'load', 'records', header)
+
+			# Success
+			return header['next'], self.rows(fp, reader)
+
+		try:
+			next, data = mload(fp)
+		finally:
+			fp.close()
+
+		# Success
+		return next, self.unpack(data)
+
+	def rows(self, fp, reader):
+		"""Rows of snapshot, file is closed after last one"""
+		with fp:
+			for row in reader:
+				yield row
+
+	def unpack(self, data):
+		return data
+
+	def save(self, background=False):
+		if self.journal is not None and not self.journal.snapshots:
+			# Engine keeps rows itself
+			return self.persist()
+
+		log.msg(self, 'save')
+
+		mark = time()
+		segment = None
+
+		if self.journal is not None:
+			# New changes go to next segment
+			segment = self.journal.rotate()
+
+		# Point-in-time copy, taken on main-loop
+		data = self.capture()
+
+		self.stats['savePause'] = time() - mark
+
+		if background:
+			self.saving = deferToThread(self.dump, data)
+			self.saving.addCallback(self.saved, segment)
+			self.saving.addErrback(log.err)
+			self.saving.addBoth(self._saving)
+
+			# Wait in this deferred
+			return self.saving
+
+		self.saved(self.dump(data), segment)
+
+	def _saving(self, result):
+		self.saving = None
+
+	def saved(self, elapsed, segment):
+		if segment is not None:
+			# Snapshot covers all closed segments
+			self.journal.purge(segment)
+
+		self.stats['saves'] += 1
+		self.stats['saveWrite'] = elapsed
+
+		log.msg(self, 'save ok', 'pause', '{0:.3f}'.format(self.stats['savePause']),
+			'write', '{0:.3f}'.format(elapsed))
+
+	def persist(self):
+		log.msg(self, 'save')
+
+		mark = time()
+
+		for record in self.refresh():
+			self.record(*record)
+
+		# Commit in engine thread
+		self.journal.flush(False)
+
+		self.stats['saves'] += 1
+		self.stats['savePause'] = time() - mark
+
+		log.msg(self, 'save ok', 'pause', '{0:.3f}'.format(self.stats['savePause']))
+
+	def refresh(self):
+		"""Records for state that changes without journal records"""
+		return self.records()
+
+	def records(self):
+		return (('a', value.toDict()) for value in self.iterate())
+
+	def iterate(self):
+		return self.data.itervalues()
+
+	def migrate(self):
+		if self.journal is None or self.journal.snapshots:
+			# Nothing to do
+			return
+
+		migrated = '{0}.migrated'.format(self.file)
+
+		if os.path.exists(self.file):
+			log.msg(self, 'migrate', storage)
+
+			# Move snapshot rows into engine
+			for record in self.records():
+				self.record(*record)
+
+			os.rename(self.file, migrated)
+
+		if os.path.exists(migrated):
+			# Fields still in files
+			storage.fallback()
+
+	def capture(self):
+		raise NotImplementedError
+
+	def serialize(self, data):
 		raise NotImplementedError
 
+	def stream(self, data):
+		raise NotImplementedError
+
+	def dump(self, data):
+		mark = time()
+		temp = '{0}.tmp'.format(self.file)
+
+		# Save
+		with open(temp, 'wb') as fp:
+			if self.format == 'records':
+				writer = RecordWriter(fp)
+				writer.write(dict(name=self.name, next=data[0]))
+
+				# Header in own block
+				writer.flush()
+
+				for row in self.stream(data[1]):
+					writer.write(row)
+
+				writer.close()
+			else:
+				mdump(self.serialize(data), fp)
+
+			# Snapshot must be on disk before journal purge
+			fp.flush()
+			os.fsync(fp.fileno())
+
+		# Replace old snapshot
+		os.rename(temp, self.file)
+
+		# Success
+		return time() - mark
+
 	def empty(self):
 		raise NotImplementedError
 
+	def record(self, *record):
+		if self.journal is not None:
+			self.journal.write(record)
+
+	def replay(self, record):
+		raise NotImplementedError
+
+	def replayJournal(self):
+		if self.journal is None:
+			# Disabled
+			return 0
+
+		replayed = 0
+		top = 0
+
+		for record in self.journal.replay():
+			if record[0] == 'n':
+				# Counter kept by engine, ids of deleted rows not given again
+				top = max(top, record[1] - 1)
+			else:
+				top = max(top, self.replay(record) or 0)
+
+			replayed += 1
+
+		if replayed:
+			# Keep counter ahead of replayed ids
+			self.next = self.counter(max(self.id, top + 1))
+
+		log.msg(self, 'load', 'journal', replayed)
+
+		# Start new segment
+		self.journal.open()
+
+		# Success
+		return replayed
+
+	def stopJournal(self):
+		if self.journal is not None:
+			self.journal.close()
+
 	def counter(self, start):
 		return count(start, step=1)
 
@@ -86,14 +319,32 @@ class Base:
 		mark = reactor.seconds()
 		last = self.lastSyncTime
 
+		if self.saving is not None or self.loading is not None:
+			# Wait for previous snapshot or background load
+			return
+
 		try:
+			if self.journal is not None and self.journal.size >= self.journalSize:
+				log.msg(self, 'sync', 'journal', self.journal.size)
+
+				# Compact journal into snapshot
+				self.save(self.background)
+
+				log.msg(self, 'sync', 'ok')
+
+				# Update
+				self.changesOne = 0
+				self.lastSyncTime = mark
+
+				# Exit
+				return
+
 			for seconds, changes in config.dbSync():
 				if self.changesOne >= changes:
 					if last <= (mark - seconds):
 						log.msg(self, 'sync', seconds, changes)
 
-						# @TODO: This code block all main-loop, fix-it
-						self.save()
+						self.save(self.background)
 
 						log.msg(self, 'sync', 'ok')
 
@@ -138,6 +389,8 @@ class Messages(Base):
 		self.changesOne += 1
 		self.changesAll += 1
 
+		self.record('a', message.toDict())
+
 		# Success
 		return id
 
@@ -155,6 +408,8 @@ class Messages(Base):
 				# Changes
 				self.changesOne += 1
 				self.changesAll += 1
+
+				self.record('d', id)
 			except KeyError:
 				# Skip
 				pass
@@ -165,6 +420,8 @@ class Messages(Base):
 			self.changesOne += 1
 			self.changesAll += 1
 
+			self.record('d', id)
+
 		# Clean object
 		if message is not None:
 			message.delete()
@@ -175,34 +432,103 @@ class Messages(Base):
 	def load(self):
 		log.msg(self, 'load')
 
-		if os.path.exists(self.file):
-			# Load
-			with open(self.file, 'rb') as fp:
-				next, data = mload(fp)
+		next, rows = self.read()
 
-				log.msg(self, 'load', len(data))
+		if next is not None:
+			self.next = self.counter(next)
 
-				self.next = self.counter(next)
-				self.data = dict(((message['id'], Message.fromDict(message)) for message in data))
+		for message in rows:
+			self.data[message['id']] = Message.fromDict(message)
 
-		log.msg(self, 'load ok')
+		log.msg(self, 'load', len(self.data))
 
-	def save(self):
-		log.msg(self, 'save')
+		self.replayJournal()
+		self.migrate()
+
+		# Count bodies shared by loaded messages
+		bodies.rebuild(self.data.itervalues())
+
+		log.msg(self, 'load ok', bodies.stats())
+
+	def replay(self, record):
+		if record[0] == 'a':
+			message = Message.fromDict(record[1])
+
+			# Insert or update
+			self.data[message.id] = message
+
+			# Success
+			return message.id
+		elif record[0] == 'd':
+			self.data.pop(record[1], None)
+
+	def capture(self):
 		log.msg(self, 'save', len(self.data))
 
-		# Save
-		with open(self.file, 'wb') as fp:
-			mdump((self.next.next(), tuple(message.toDict() for id, message in self.data.iteritems())), fp)
+		# Success
+		return (self.next.next(), self.data.values())
 
-		log.msg(self, 'save ok')
+	def serialize(self, data):
+		next, data = data
+
+		# Success
+		return (next, tuple(message.toDict() for message in data))
+
+	def stream(self, data):
+		for message in data:
+			yield message.toDict()
 
 
 class Tos(Base):
 
 	def __init__(self):
+		SpoolQueue.cleanup()
+
 		Base.__init__(self, 'tos')
 
+		# Recipients of all lanes kept in memory, the rest spills to disk
+		self.budget = Budget(config.getint('db', 'queue-memory'))
+
+		# Lanes with ready recipients per level, served round-robin
+		self.rings = BucketQueue(QUEUE_MAX_PRIORITY + 3)
+
+		# Retry and express levels are served apart from first attempts
+		self.masks = (dict(
+			ready=(1 << self.bucket(QUEUE_RETRY_LEVEL)) - 1,
+			retry=1 << self.bucket(QUEUE_RETRY_LEVEL),
+			express=1 << self.bucket(QUEUE_EXPRESS_LEVEL),
+		))
+
+		# Heaps of (deadline, group, lane) per bucket, served before round-robin
+		self.urgent = dict()
+
+		# Delayed recipients by lane
+		self.wheel = TimingWheel(reactor.seconds())
+
+		# Time of last dispatch rates update
+		self.measured = reactor.seconds()
+
+		# Recipients set aside by sender while their domain is throttled
+		self.held = dict()
+		self.heldSize = 0
+
+		# Handed to sender, removed from journal when done
+		self.flight = dict()
+
+		# Dropped after deadline, without group
+		self.stats['expired'] = 0
+
+		# Timers of groups not started yet
+		self.starts = dict()
+
+		# Heap of (time, group) of lanes over rate or daily quota
+		self.capped = []
+
+		self.loader = None
+
+		self.fastStart = config.getboolean('db', 'fast-start')
+		self.fastStartSlice = config.getint('db', 'fast-start-slice')
+
 	def add(self, to):
 		assert isinstance(to, To)
 
@@ -216,387 +542,835 @@ class Tos(Base):
 			if id > self.id:
 				self.next = self.counter(id)
 
-		if to.after is None:
-			if to.group:
-				group = groups.get(to.group)
+		# Update
+		to.id = id
 
-				if group:
-					# Check group status
-					assert group.status != GROUP_STATUS_INACTIVE
-					
-					if group.status == GROUP_STATUS_PAUSED:
-						to.priority = QUEUE_PAUSE_PRIORITY + to.priority
+		# Back from sender
+		self.flight.pop(id, None)
 
-				# Clean
-				del group
+		if to.group:
+			group = groups.get(to.group)
 
-		# Insert
-		if to.after is not None:
-			(heappush(
-				self.data[2], 
-				(to.after, to)
-			))
-		elif to.priority > 0:
-			(heappush(
-				self.data[1], 
-				(to.priority, to)
-			))
-		else:
-			self.data[0].append(to)
+			if group is not None and group.status == GROUP_STATUS_INACTIVE:
+				# Group stopped while recipient was in work
+				self.discard(to)
 
-		# Update
-		to.id = id
+				self.record('p', id)
+
+				# Success
+				return id
+
+			# Clean
+			del group
+
+		# Insert
+		self.push(to)
 
 		# Changes
 		self.changesOne += 1
 		self.changesAll += 1
 
+		self.record('a', to.toDict())
+
 		# Success
 		return id
 
-	def pop(self):
-		to = None
-		ps = None
+	def lane(self, group):
+		lane = self.data.get(group)
+
+		if lane is None:
+			lane = self.data[group] = Lane(group, self.fifo(group), partial(self.fifo, group), self.budget)
+
+			if group:
+				group = groups.get(group)
+
+				if group is not None:
+					lane.paused = group.status == GROUP_STATUS_PAUSED
+					lane.weight = group.weight
+					lane.deadline = group.deadline
+
+					self.limitsForGroup(group.id, group.rate, group.dailyQuota)
+
+					if group.startAt:
+						self.startForGroup(group.id, group.startAt)
+
+		# Success
+		return lane
+
+	def push(self, to):
+		# Old snapshots keep pause offset in priority
+		if to.priority > QUEUE_MAX_PRIORITY:
+			to.priority -= QUEUE_PAUSE_PRIORITY
+
+		lane = self.lane(to.group or 0)
 
+		if to.after is not None:
+			if not self.wheel.add(lane, to):
+				# Already due
+				self.ready(lane, to)
+		else:
+			self.ready(lane, to)
+
+	def ready(self, lane, to):
+		if to.attempts > 0:
+			# Failed before, never ahead of first attempts
+			level = QUEUE_RETRY_LEVEL
+		elif to.express:
+			level = QUEUE_EXPRESS_LEVEL
+		else:
+			level = to.priority if to.priority > 0 else 0
+
+		lane.append(level, to)
+
+		if not (lane.parked or level in lane.ringed):
+			lane.ringed.add(level)
+
+			self.rings.append(self.bucket(level), lane)
+
+		if not lane.parked and lane.expires(to):
+			self.urge(lane, level)
+
+	def ring(self, lane):
+		"""List lane for round-robin on all levels it has recipients"""
+		for level in lane.readyLevels():
+			if not level in lane.ringed:
+				lane.ringed.add(level)
+
+				self.rings.append(self.bucket(level), lane)
+
+			self.urge(lane, level)
+
+	def urge(self, lane, level):
+		"""List lane by earliest deadline of level, if it has one"""
+		deadline = lane.earliest(level)
+
+		if deadline and (level not in lane.urgent or deadline < lane.urgent[level]):
+			lane.urgent[level] = deadline
+
+			heappush(self.urgent.setdefault(self.bucket(level), []), (deadline, lane.group, lane))
+
+	def earliest(self, bucket, level):
+		"""Lane with earliest deadline on level, None if no lane has one"""
+		heap = self.urgent.get(bucket)
+
+		while heap:
+			deadline, group, lane = heap[0]
+
+			if lane.urgent.get(level) != deadline:
+				# Listed again with earlier deadline
+				heappop(heap)
+
+				continue
+
+			if lane.parked or lane.closed or lane.earliest(level) != deadline:
+				# Listed again on resume or with next deadline
+				heappop(heap)
+
+				del lane.urgent[level]
+
+				if not (lane.parked or lane.closed):
+					self.urge(lane, level)
+
+				continue
+
+			# Success
+			return lane
+
+	def pop(self, kind='ready'):
+		"""Next recipient of kind: ready, retry or express"""
 		if DEBUG:
-			log.msg(self, 'pop', len(self.data[0]), len(self.data[1]))
+			log.msg(self, 'pop', len(self.data), kind)
+
+		rings = self.rings
+		mask = self.masks[kind]
+		current = reactor.seconds()
+
+		while rings.mask & mask:
+			bucket = rings.first(mask)
+			ring = rings.buckets[bucket]
+
+			level = self.level(bucket)
 
-		if to is None:
-			if self.data[1]:
-				# Check statuses
-				if self.data[1][0][0] <= QUEUE_MAX_PRIORITY:
-					if DEBUG:
-						log.msg(self, 'pop', '1')
+			# Earliest deadline across groups first, then round-robin
+			lane = self.earliest(bucket, level)
+			urgent = lane is not None
 
-					to = heappop(self.data[1])[1]
+			if not urgent:
+				lane = ring[0]
 
-		if to is None:
-			if self.data[0]:
-				if DEBUG:
-					log.msg(self, 'pop', '0')
+				if lane.parked or lane.closed or not lane.ready(level):
+					# Parked or drained, listed again on resume or push
+					rings.popleft(bucket)
 
-				to = self.data[0].popleft()
+					lane.ringed.discard(level)
+					lane.deficit = 0
+
+					continue
+
+				if lane.deficit < 1:
+					# New round for group, deficit round-robin
+					lane.deficit += lane.weight
+
+					if lane.deficit < 1:
+						ring.rotate(-1)
+
+						continue
+
+			if (lane.bucket is not None or lane.quota) and not self.allowed(lane, current):
+				if not urgent:
+					# Over limit, listed again by checkAfter
+					rings.popleft(bucket)
+
+					lane.ringed.discard(level)
+					lane.deficit = 0
+
+				continue
+
+			to = lane.popleft(level)
+
+			deadline = lane.expires(to)
+
+			if deadline and deadline < current:
+				# Too late, not sent at all
+				self.expire(lane, to)
+
+				continue
+
+			self.charge(lane, current)
+
+			if not urgent:
+				lane.deficit -= 1
+
+				if lane.deficit < 1:
+					# Next group on next pop
+					ring.rotate(-1)
 
-		# Found
-		if to is not None:
 			# Changes
 			self.changesOne += 1
 			self.changesAll += 1
 
+			self.flight[to.id] = to
+
 			# Success
 			return to
 
-	def checkAfter(self):
-		if self.data[2]:
-			current = reactor.seconds()
-			rotated= 0
+	def done(self, to):
+		"""Sent or given up by sender, not queued any more"""
+		self.flight.pop(to.id, None)
 
-			data = self.data[2]
+		# Changes
+		self.changesOne += 1
+		self.changesAll += 1
 
-			if DEBUG:
-				log.msg(self, 'checkAfter', len(data), 'wait', current)
-
-			while data and rotated < 10000:
-				startup, to1 = data[0]
-
-				if DEBUG:
-					log.msg(self, 'checkAfter', 'wait first', startup - current, 'seconds')
-
-				if startup <= current:
-					# if DEBUG:
-					# 	log.msg(self, 'checkAfter', 'startup', to1, 'got', startup, current)
-
-					after, to2 = heappop(data)
-
-					# if DEBUG:
-					# 	log.msg(self, 'checkAfter', 'startup', to1, to2, 'rotate')
-
-					if to1 is to2:
-						if to2.group:
-							group = groups.get(to2.group)
-
-							if group:
-								# Check group status
-								if group.status == GROUP_STATUS_PAUSED:
-									to2.priority = QUEUE_PAUSE_PRIORITY + to2.priority
-
-						if not to2.group or group.status != GROUP_STATUS_INACTIVE:
-							# Ok, rotate
-							if to2.priority > 0:
-								(heappush(
-									self.data[1], 
-									(to2.priority, to2)
-								))
-							else:
-								self.data[0].append(to2)
-
-						if to2.group:
-							# Clean
-							del group
-
-						# Changes
-						self.changesOne += 1
-						self.changesAll += 1
-					else:
-						(heappush(
-							data, 
-							(after, to2)
-						))
-
-					rotated += 1
-				else:
-					# Ok, wait time
-					break
+		self.record('p', to.id)
 
-			if DEBUG:
-				log.msg(self, 'checkAfter', len(data), 'wait', current, 'rotated', rotated)
+	def charge(self, lane, current):
+		"""Count dispatch of recipient in rate and daily quota of group"""
+		if lane.bucket is not None:
+			lane.bucket.consume(current)
 
-	def statusForGroup(self, group, status):
-		if status == GROUP_STATUS_ACTIVE:
-			if DEBUG:
-				log.msg(self, 'statusForGroup', group, 'active')
+		if lane.quota:
+			group = groups.get(lane.group)
+			group.dailySent += 1
 
-			# A queue
-			aq = self.data[1][:]
-			aa = None
+			groups.changed(group)
 
-			# B queue
-			bq = self.data[0]
-			ba = bq.append
+		lane.dispatched += 1
 
-			if aq:
-				# Update
-				self.data[1][:] = []
+	def refund(self, to):
+		"""Give back limits charged by pop, recipient was not sent"""
+		lane = self.data.get(to.group or 0)
 
-				# C queue
-				cq = self.data[1]
-				ca = cq.append
+		if lane is None:
+			return
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'aq', len(aq))
+		if lane.bucket is not None:
+			lane.bucket.tokens = min(lane.bucket.burst, lane.bucket.tokens + 1)
 
-				for (a, b) in aq:
-					if a >= QUEUE_PAUSE_PRIORITY and b.group == group:
-						# Paused
-						b.priority = b.priority - QUEUE_PAUSE_PRIORITY
+		if lane.quota:
+			group = groups.get(lane.group)
 
-						# If priority
-						if b.priority > 0:
-							# Update
-							ca((b.priority, b))
-						else:
-							ba(b)
-					else:
-						ca((a, b))
+			if group is not None and group.dailySent > 0:
+				group.dailySent -= 1
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'aq', 'ok')
+				groups.changed(group)
 
-				# Transform list into a heap
-				heapify(cq)
+		lane.deficit += 1
+		lane.dispatched -= 1
 
-			if DEBUG:
-				log.msg(self, 'statusForGroup', group, 'active', 'ok')
-		elif status == GROUP_STATUS_PAUSED:
-			if DEBUG:
-				log.msg(self, 'statusForGroup', group, 'paused')
+	def allowed(self, lane, current):
+		"""Check rate and daily quota of lane, park it if over"""
+		until = None
 
-			# A queue
-			aq = self.data[1]
-			aa = aq.append
+		if lane.bucket is not None and not lane.bucket.ready(current):
+			until = current + lane.bucket.delay(current)
 
-			# B queue
-			bq = list(self.data[0])
-			ba = bq.append
+		if lane.quota:
+			group = groups.get(lane.group)
+			day = int(current // 86400)
 
-			if aq:
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'aq', len(aq))
+			if group.day != day:
+				# New day, UTC
+				group.day = day
+				group.dailySent = 0
 
-				for i, (a, b) in enumerate(aq):
-					if a <= QUEUE_MAX_PRIORITY and b.group == group:
-						# Paused
-						b.priority = b.priority + QUEUE_PAUSE_PRIORITY
+				groups.changed(group)
 
-						# Update
-						aq[i] = (b.priority, b)
+			if group.dailySent >= lane.quota:
+				until = (day + 1) * 86400
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'aq', 'ok')
+		if until is None:
+			# Success
+			return True
 
-			if bq:
-				# Update
-				self.data[0].clear()
+		lane.capped = until
 
-				# C queue
-				cq = self.data[0]
-				ca = cq.append
+		heappush(self.capped, (until, lane.group))
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'bq', len(bq))
+		# Fail
+		return False
 
-				for (b) in bq:
-					if b.group == group:
-						# Paused
-						b.priority = QUEUE_PAUSE_PRIORITY
+	def uncap(self, current):
+		while self.capped and self.capped[0][0] <= current:
+			until, group = heappop(self.capped)
 
-						# Update
-						aa((b.priority, b))
-					else:
-						ca(b)
+			lane = self.data.get(group)
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'bq', 'ok')
+			if lane is not None and lane.capped == until:
+				lane.capped = None
 
-			# Transform list into a heap
-			heapify(aq)
+				if not lane.parked:
+					self.ring(lane)
 
-			if DEBUG:
-				log.msg(self, 'statusForGroup', group, 'paused', 'ok')
-		elif status == GROUP_STATUS_INACTIVE:
-			if DEBUG:
-				log.msg(self, 'statusForGroup', group, 'inactive')
+	def cappedDelay(self, current):
+		"""Seconds until first capped lane may be served, None if none"""
+		if self.capped:
+			return max(0.0, self.capped[0][0] - current)
 
-			# A queue
-			aq = self.data[1][:]
-			aa = None
+	def expire(self, lane, to):
+		self.discard(to)
 
-			# B queue
-			bq = list(self.data[0])
-			ba = bq.append
+		if lane.group:
+			group = groups.get(lane.group)
 
-			# D queue
-			dq = self.data[2][:]
-			da = None
+			if group is not None:
+				group.wait -= 1
+				group.expired += 1
 
-			if aq:
-				# Update
-				self.data[1][:] = []
+				groups.changed(group)
+		else:
+			self.stats['expired'] += 1
 
-				# C queue
-				cq = self.data[1]
-				ca = cq.append
+		# Changes
+		self.changesOne += 1
+		self.changesAll += 1
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'aq', len(aq))
+		self.record('p', to.id)
 
-				for (a, b) in aq:
-					if b.group == group:
-						# Update
-						if b.message:
-							message = messages.get(b.message)
+		# Clean
+		to.delete()
 
-							if message is not None:
-								# Update tos count
-								message.tos -= 1
-					else:
-						ca((a, b))
+	def hold(self, to):
+		self.flight.pop(to.id, None)
 
-				# Transform list into a heap
-				heapify(cq)
+		# Group limits are charged on release
+		self.refund(to)
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'aq', 'ok')
+		queue = self.held.get(to.domain)
 
-			if bq:
-				# Update
-				self.data[0].clear()
+		if queue is None:
+			queue = self.held[to.domain] = deque()
 
-				# C queue
-				cq = self.data[0]
-				ca = cq.append
+		queue.append(to)
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'bq', len(bq))
+		self.heldSize += 1
 
-				for (b) in bq:
-					if b.group == group:
-						# Update
-						if b.message:
-							message = messages.get(b.message)
+		# Changes
+		self.changesOne += 1
+		self.changesAll += 1
 
-							if message is not None:
-								# Update tos count
-								message.tos -= 1
-					else:
-						ca(b)
+	def release(self, domain):
+		queue = self.held.get(domain)
+		current = reactor.seconds()
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'bq', 'ok')
+		while queue:
+			to = queue.popleft()
 
-			if dq:
-				# Update
-				self.data[2][:] = []
+			self.heldSize -= 1
 
-				# E queue
-				eq = self.data[2]
-				ea = eq.append
+			# Changes
+			self.changesOne += 1
+			self.changesAll += 1
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'dq', len(dq))
+			group = groups.get(to.group) if to.group else None
 
-				for (a, b) in dq:
-					if b.group == group:
-						# Update
-						if b.message:
-							message = messages.get(b.message)
+			if group is not None and group.status == GROUP_STATUS_INACTIVE:
+				# Group stopped while recipient was held
+				self.discard(to)
+
+				self.record('p', to.id)
+			elif group is not None and group.status == GROUP_STATUS_PAUSED:
+				# Back to parked lane
+				self.push(to)
+			else:
+				lane = self.lane(to.group or 0)
+
+				if (lane.bucket is not None or lane.quota) and not self.allowed(lane, current):
+					# Group over limit, back to capped lane
+					self.push(to)
 
-							if message is not None:
-								# Update tos count
-								message.tos -= 1
-					else:
-						ea((a, b))
+					continue
 
-				# Transform list into a heap
-				heapify(eq)
+				self.charge(lane, current)
 
-				if DEBUG:
-					log.msg(self, 'statusForGroup', group, 'eq', 'ok')
+				self.flight[to.id] = to
+
+				# Clean
+				if not queue:
+					del self.held[domain]
+
+				# Success
+				return to
+
+		if queue is not None:
+			# Clean
+			del self.held[domain]
+
+	def back(self, to):
+		"""Put recipient of throttled domain back to lane, hold is full"""
+		self.flight.pop(to.id, None)
+
+		self.refund(to)
+		self.push(to)
+
+		# Changes
+		self.changesOne += 1
+		self.changesAll += 1
+
+	def bucket(self, level):
+		# Priorities first, then plain FIFO, then retries and express
+		if level < 0:
+			return QUEUE_MAX_PRIORITY - level
+
+		return level - 1 if level else QUEUE_MAX_PRIORITY
+
+	def level(self, bucket):
+		if bucket > QUEUE_MAX_PRIORITY:
+			return QUEUE_MAX_PRIORITY - bucket
+
+		return bucket + 1 if bucket < QUEUE_MAX_PRIORITY else 0
+
+	def waiting(self, kind):
+		"""True if some lane of kind may have ready recipients"""
+		return bool(self.rings.mask & self.masks[kind])
+
+	def checkAfter(self):
+		current = reactor.seconds()
+		rotated = 0
+
+		if DEBUG:
+			log.msg(self, 'checkAfter', len(self.wheel), 'wait', current)
+
+		if self.capped:
+			self.uncap(current)
+
+		# Also moves empty wheel to current time
+		for lane, items in self.wheel.advance(current):
+			for to in items:
+				self.ready(lane, to)
+
+			rotated += len(items)
+
+		if rotated:
+			# Changes
+			self.changesOne += rotated
+			self.changesAll += rotated
+
+		if DEBUG:
+			log.msg(self, 'checkAfter', len(self.wheel), 'wait', current, 'rotated', rotated)
+
+	def statusForGroup(self, group, status):
+		lane = self.data.get(group)
+
+		if status == GROUP_STATUS_ACTIVE:
+			if DEBUG:
+				log.msg(self, 'statusForGroup', group, 'active', lane)
+
+			if lane is not None and lane.paused:
+				lane.paused = False
+
+				if not lane.parked:
+					self.ring(lane)
+		elif status == GROUP_STATUS_PAUSED:
+			if DEBUG:
+				log.msg(self, 'statusForGroup', group, 'paused', lane)
+
+			if lane is not None:
+				# Parked, pop drops lane from rings
+				lane.paused = True
+		elif status == GROUP_STATUS_INACTIVE:
+			if DEBUG:
+				log.msg(self, 'statusForGroup', group, 'inactive', lane)
+
+			if group in self.starts:
+				self.starts.pop(group).cancel()
+
+			if lane is not None:
+				del self.data[group]
+
+				lane.closed = True
+
+				for to in chain(lane, self.wheel.remove(lane)):
+					self.discard(to)
+
+					self.record('p', to.id)
+
+				lane.clear()
+
+				# Changes
+				self.changesOne += 1
+				self.changesAll += 1
 
 			if DEBUG:
 				log.msg(self, 'statusForGroup', group, 'inactive', 'ok')
 		else:
 			raise RuntimeError('Unknown status {0}'.format(status))
-		
+
+	def weightForGroup(self, group, weight):
+		lane = self.data.get(group)
+
+		if lane is not None:
+			lane.weight = weight
+
+	def startForGroup(self, group, start):
+		"""Park recipients of group until start, one timer for all"""
+		delay = (start or 0) - reactor.seconds()
+
+		# New lane may schedule start of group itself
+		lane = self.lane(group) if delay > 0 else None
+
+		if group in self.starts:
+			self.starts.pop(group).cancel()
+
+		if delay > 0:
+			lane.start = start
+			self.starts[group] = reactor.callLater(delay, self.startGroup, group)
+		else:
+			self.startGroup(group)
+
+	def startGroup(self, group):
+		self.starts.pop(group, None)
+
+		lane = self.data.get(group)
+
+		if lane is not None and lane.start is not None:
+			if DEBUG:
+				log.msg(self, 'startGroup', group, lane)
+
+			lane.start = None
+
+			if not lane.parked:
+				self.ring(lane)
+
+	def limitsForGroup(self, group, rate, quota):
+		lane = self.data.get(group)
+
+		if lane is not None:
+			lane.bucket = TokenBucket(rate, max(1, rate), reactor.seconds()) if rate else None
+			lane.quota = quota
+
+			if lane.capped is not None:
+				# Check again with new limits
+				lane.capped = None
+
+				if not lane.parked:
+					self.ring(lane)
+
+	def deadlineForGroup(self, group, deadline):
+		lane = self.data.get(group)
+
+		if lane is not None:
+			lane.deadline = deadline
+
+			if not lane.parked:
+				# List lane by new deadline
+				self.ring(lane)
+
+	def measure(self):
+		current = reactor.seconds()
+		elapsed = current - self.measured
+
+		if elapsed > 0:
+			for lane in self.data.itervalues():
+				lane.rate = (lane.dispatched - lane.measured) / elapsed
+				lane.measured = lane.dispatched
+
+		self.measured = current
+
+	def laneStats(self, group):
+		lane = self.data.get(group)
+
+		if lane is None:
+			return None
+
+		# Success
+		return (dict(
+			queued=len(lane),
+			retry=lane.size(QUEUE_RETRY_LEVEL),
+			express=lane.size(QUEUE_EXPRESS_LEVEL),
+			weight=lane.weight,
+			start=lane.start,
+			capped=lane.capped,
+			dispatched=lane.dispatched,
+			rate=lane.rate,
+		))
+
+	def depth(self):
+		"""Queued recipients by kind, first attempts and retries apart"""
+		retry = 0
+		express = 0
+		ready = 0
+
+		for lane in self.data.itervalues():
+			for level in set(lane.levels).union(lane.deadlines):
+				if level == QUEUE_RETRY_LEVEL:
+					retry += lane.size(level)
+				elif level == QUEUE_EXPRESS_LEVEL:
+					express += lane.size(level)
+				else:
+					ready += lane.size(level)
+
+		# Success
+		return (dict(
+			ready=ready,
+			retry=retry,
+			express=express,
+			delayed=len(self.wheel),
+			held=self.heldSize,
+		))
+
+	def sync(self):
+		self.measure()
+
+		# Success
+		return Base.sync(self)
+
+	def discard(self, to):
+		if to.message:
+			message = messages.get(to.message)
+
+			if message is not None:
+				# Update tos count
+				message.tos -= 1
+
 	def empty(self):
-		return (deque(), [], [])
+		return dict()
+
+	def fifo(self, group):
+		return (SpoolQueue(
+			'{0}-{1}'.format(self.name, group),
+			batch=config.getint('db', 'queue-batch'),
+			size=config.getint('db', 'queue-segment'),
+			budget=self.budget,
+		))
+
+	def iterate(self):
+		return chain(
+			chain.from_iterable(self.data.values()),
+			chain.from_iterable(self.held.values()),
+			self.flight.values(),
+			iter(self.wheel),
+		)
 
 	def load(self):
 		log.msg(self, 'load')
 
-		if os.path.exists(self.file):
-			# Load
-			with open(self.file, 'rb') as fp:
-				next, data = mload(fp)
+		mark = time()
+		next, rows = self.read()
 
-				log.msg(self, 'load', len(data[0]), len(data[1]), len(data[2]))
+		if next is not None:
+			self.next = self.counter(next)
 
-				self.next = self.counter(next)
-				self.data = ((
-					deque(tuple(To.fromDict(to) for to in data[0])), 
-					[(priority, To.fromDict(to)) for priority, to in data[1]],
-					[(after, To.fromDict(to)) for after, to in data[2]],
-				))
+		pending = dict()
 
-				# Transform list into a heap
-				heapify(self.data[1])
-				heapify(self.data[2])
+		if self.journal is not None:
+			# Journal tail first, snapshot rows changed by it are skipped
+			self.pending = OrderedDict()
+			self.replayJournal()
 
-		log.msg(self, 'load ok')
+			pending = self.pending
 
-	def save(self):
-		log.msg(self, 'save')
-		log.msg(self, 'save', len(self.data[0]), len(self.data[1]), len(self.data[2]))
+			# Clean
+			del self.pending
 
-		# Save
-		with open(self.file, 'wb') as fp:
-			mdump((self.next.next(), ( 
-				tuple(to.toDict() for to in self.data[0]), 
-				tuple((priority, to.toDict()) for priority, to in self.data[1]),
-				tuple((after, to.toDict()) for after, to in self.data[2]),
-			)), fp)
+			# Journal does not track counters, restore counts them again
+			self.reset()
+
+			for to in pending.itervalues():
+				if to is not None:
+					self.restore(To.fromDict(to))
+
+		self.stats['loadRows'] = 0
+		self.stats['loadDone'] = False
 
-		log.msg(self, 'save ok')
+		if self.fastStart:
+			log.msg(self, 'load', 'continue in background')
+
+			self.loader = self.loadRows(rows, pending, mark)
+			self.loading = cooperate(self.loader)
+			self.loading.whenDone().addErrback(self._eb_loading)
+		else:
+			for _ in self.loadRows(rows, pending, mark):
+				pass
+
+	def loadRows(self, rows, pending, mark):
+		push = self.push if self.journal is None else self.restore
+		loaded = 0
+
+		for to in rows:
+			if not to['id'] in pending:
+				push(To.fromDict(to))
+
+			loaded += 1
+
+			if not loaded % self.fastStartSlice:
+				self.stats['loadRows'] = loaded
+
+				# Let main-loop work
+				yield None
+
+		self.loading = None
+		self.loader = None
+
+		self.stats['loadRows'] = loaded
+		self.stats['loadDone'] = True
+		self.stats['loadTime'] = time() - mark
+
+		self.migrate()
+
+		log.msg(self, 'load', len(self.data), 'groups', sum(len(lane) for lane in self.data.itervalues()), 'delayed', len(self.wheel))
+		log.msg(self, 'load ok', '{0:.3f}'.format(self.stats['loadTime']))
+
+	def _eb_loading(self, failure):
+		failure.trap(TaskStopped)
+
+	def finishLoading(self):
+		if self.loading is not None:
+			log.msg(self, 'load', 'finish in foreground')
+
+			self.loading.stop()
+
+			for _ in self.loader:
+				pass
+
+	def unpack(self, data):
+		return chain(
+			data[0],
+			(to for priority, to in data[1]),
+			(to for after, to in data[2]),
+		)
+
+	def replay(self, record):
+		if record[0] == 'a':
+			to = record[1]
+
+			# Move to end
+			self.pending.pop(to['id'], None)
+			self.pending[to['id']] = to
+
+			# Success
+			return to['id']
+		elif record[0] == 'p':
+			# Mark removed, snapshot may contain it
+			self.pending.pop(record[1], None)
+			self.pending[record[1]] = None
+
+	def restore(self, to):
+		if to.group:
+			group = groups.get(to.group)
+
+			if group:
+				if group.status == GROUP_STATUS_INACTIVE:
+					# Skip
+					return
+
+				group.wait += 1
+
+		if to.message:
+			message = messages.get(to.message)
+
+			if message is not None:
+				message.tos += 1
+
+		self.push(to)
+
+	def refresh(self):
+		# Rows follow add and pop
+		return ()
+
+	def reset(self):
+		for message in messages.getData().itervalues():
+			message.tos = 0
+
+		for group in groups.getData().itervalues():
+			group.wait = 0
+
+	def save(self, background=False):
+		# Snapshot must contain all rows
+		self.finishLoading()
+
+		# Success
+		return Base.save(self, background)
+
+	def capture(self):
+		log.msg(self, 'save', len(self.data), 'groups')
+
+		fifo = []
+		ready = []
+		delayed = []
+
+		for lane in self.data.itervalues():
+			for level, queue in lane.levels.iteritems():
+				if level:
+					ready.append(((to.priority, to) for to in queue.capture()))
+				else:
+					fifo.append(queue.capture())
+
+			for heap in lane.deadlines.itervalues():
+				ready.append([(to.priority, to) for deadline, id, to in heap])
+
+		for queue in (self.held.values() + [self.flight.values()]):
+			fifo.append([to for to in queue if not to.priority > 0])
+			ready.append([(to.priority, to) for to in queue if to.priority > 0])
+
+		delayed.extend((to.after, to) for to in self.wheel)
+
+		# Success
+		return (self.next.next(), (
+			chain.from_iterable(fifo),
+			chain.from_iterable(ready),
+			delayed,
+		))
+
+	def serialize(self, data):
+		next, data = data
+
+		# Success
+		return (next, ( 
+			tuple(to.toDict() for to in data[0]), 
+			tuple((priority, to.toDict()) for priority, to in data[1]),
+			tuple((after, to.toDict()) for after, to in data[2]),
+		))
+
+	def stream(self, data):
+		for to in data[0]:
+			yield to.toDict()
+
+		for priority, to in data[1]:
+			yield to.toDict()
+
+		for after, to in data[2]:
+			yield to.toDict()
 
 
 class Groups(Base):
@@ -627,6 +1401,8 @@ class Groups(Base):
 		self.changesOne += 1
 		self.changesAll += 1
 
+		self.record('a', group.toDict())
+
 		# Success
 		return id
 
@@ -648,6 +1424,8 @@ class Groups(Base):
 				# Changes
 				self.changesOne += 1
 				self.changesAll += 1
+
+				self.record('d', id)
 			except KeyError:
 				# Skip
 				pass
@@ -658,6 +1436,8 @@ class Groups(Base):
 			self.changesOne += 1
 			self.changesAll += 1
 
+			self.record('d', id)
+
 		# Clean object
 		if group is not None:
 			group.delete()
@@ -672,54 +1452,169 @@ class Groups(Base):
 
 			# Update
 			group.status = status
+
+			self.record('s', group.id, status)
 		else:
 			raise RuntimeError('Unknown status {0}'.format(status))
 
 		# Success
 		return group.status
 
+	def limits(self, group, rate, quota):
+		group = self.data[group]
+
+		if rate < 0 or quota < 0:
+			raise RuntimeError('Limits must not be negative {0} {1}'.format(rate, quota))
+
+		# Update
+		group.rate = rate
+		group.dailyQuota = quota
+
+		tos.limitsForGroup(group.id, rate, quota)
+
+		# Changes
+		self.changesOne += 1
+		self.changesAll += 1
+
+		self.record('a', group.toDict())
+
+		# Success
+		return group.rate, group.dailyQuota
+
+	def start(self, group, start):
+		group = self.data[group]
+
+		# Update
+		group.startAt = start
+
+		tos.startForGroup(group.id, start)
+
+		# Changes
+		self.changesOne += 1
+		self.changesAll += 1
+
+		self.record('a', group.toDict())
+
+		# Success
+		return group.startAt
+
+	def deadline(self, group, deadline):
+		group = self.data[group]
+
+		# Update
+		group.deadline = deadline
+
+		tos.deadlineForGroup(group.id, deadline)
+
+		# Changes
+		self.changesOne += 1
+		self.changesAll += 1
+
+		self.record('a', group.toDict())
+
+		# Success
+		return group.deadline
+
+	def changed(self, group):
+		"""Counters of group changed, journal them"""
+		# Changes
+		self.changesOne += 1
+		self.changesAll += 1
+
+		self.record('a', group.toDict())
+
+	def weight(self, group, weight):
+		group = self.data[group]
+
+		if not weight > 0:
+			raise RuntimeError('Weight must be positive {0}'.format(weight))
+
+		# Update
+		group.weight = weight
+
+		tos.weightForGroup(group.id, weight)
+
+		# Changes
+		self.changesOne += 1
+		self.changesAll += 1
+
+		self.record('a', group.toDict())
+
+		# Success
+		return group.weight
+
 	def empty(self):
 		return dict()
 
 	def load(self):
 		log.msg(self, 'load')
 
-		if os.path.exists(self.file):
-			# Load
-			with open(self.file, 'rb') as fp:
-				next, data = mload(fp)
+		next, rows = self.read()
 
-				log.msg(self, 'load', len(data))
+		if next is not None:
+			self.next = self.counter(next)
 
-				self.next = self.counter(next)
-				self.data = dict(((group['id'], Group.fromDict(group)) for group in data))
+		for group in rows:
+			self.data[group['id']] = Group.fromDict(group)
+
+		log.msg(self, 'load', len(self.data))
+
+		self.replayJournal()
+		self.migrate()
 
 		log.msg(self, 'load ok')
 
-	def save(self):
-		log.msg(self, 'save')
+	def replay(self, record):
+		if record[0] == 'a':
+			group = Group.fromDict(record[1])
+
+			# Insert or update
+			self.data[group.id] = group
+
+			# Success
+			return group.id
+		elif record[0] == 's':
+			group = self.data.get(record[1])
+
+			if group is not None:
+				group.status = record[2]
+		elif record[0] == 'd':
+			self.data.pop(record[1], None)
+
+	def capture(self):
 		log.msg(self, 'save', len(self.data))
 
-		# Save
-		with open(self.file, 'wb') as fp:
-			mdump((self.next.next(), tuple(group.toDict() for id, group in self.data.iteritems())), fp)
+		# Success
+		return (self.next.next(), self.data.values())
 
-		log.msg(self, 'save ok')
+	def serialize(self, data):
+		next, data = data
+
+		# Success
+		return (next, tuple(group.toDict() for group in data))
+
+	def stream(self, data):
+		for group in data:
+			yield group.toDict()
 
 
 messages = Messages()
 tos = Tos()
 groups = Groups()
 
-# Handlers
+# Handlers, groups first: tos restore needs group statuses
+reactor.addSystemEventTrigger('before', 'startup', groups.load)
 reactor.addSystemEventTrigger('before', 'startup', messages.load)
 reactor.addSystemEventTrigger('before', 'startup', tos.load)
-reactor.addSystemEventTrigger('before', 'startup', groups.load)
 
 reactor.addSystemEventTrigger('after', 'shutdown', messages.save)
 reactor.addSystemEventTrigger('after', 'shutdown', tos.save)
 reactor.addSystemEventTrigger('after', 'shutdown', groups.save)
 
+reactor.addSystemEventTrigger('after', 'shutdown', messages.stopJournal)
+reactor.addSystemEventTrigger('after', 'shutdown', tos.stopJournal)
+reactor.addSystemEventTrigger('after', 'shutdown', groups.stopJournal)
+
 reactor.addSystemEventTrigger('after', 'startup', messages.startSync)
 reactor.addSystemEventTrigger('after', 'startup', tos.startSync)
 reactor.addSystemEventTrigger('after', 'startup', groups.startSync)
@@ -0,0 +1,178 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from marshal import dumps as mdumps, load as mload
+
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
+
+from core.dirs import dbs
+
+
+class Journal:
+	"""Append-only journal of changes, replayed on top of the last snapshot"""
+
+	snapshots = True
+
+	def __init__(self, name, directory=dbs, interval=0.5, fsync=True):
+		self.name = name
+		self.directory = directory
+		self.interval = interval
+		self.fsync = fsync
+
+		self.fp = None
+		self.segment = 0
+		self.size = 0
+
+		self._buffer = []
+		self._flushCall = None
+		self._syncing = None
+
+	def path(self, segment):
+		return os.path.join(self.directory, '{0}.journal.{1:08d}'.format(self.name, segment))
+
+	def segments(self):
+		prefix = '{0}.journal.'.format(self.name)
+		result = []
+
+		for name in os.listdir(self.directory):
+			if name.startswith(prefix):
+				try:
+					result.append(int(name[len(prefix):]))
+				except ValueError:
+					# Skip foreign files
+					pass
+
+		# Success
+		return sorted(result)
+
+	def replay(self):
+		for segment in self.segments():
+			with open(self.path(segment), 'rb') as fp:
+				while True:
+					try:
+						record = mload(fp)
+					except EOFError:
+						break
+					except (ValueError, TypeError):
+						# Tail of segment was not fully written, stop here
+						log.msg(self, 'replay', 'truncated', segment, fp.tell())
+
+						break
+
+					yield record
+
+			# Continue numbering after replayed segments
+			self.segment = max(self.segment, segment)
+
+	def open(self):
+		self.segment += 1
+		self.size = 0
+
+		self.fp = open(self.path(self.segment), 'ab')
+
+	def write(self, record):
+		data = mdumps(record)
+
+		self._buffer.append(data)
+		self.size += len(data)
+
+		# Group commit
+		if self._flushCall is None:
+			self._flushCall = reactor.callLater(self.interval, self.flush, False)
+
+	def flush(self, wait=True):
+		if self._flushCall is not None:
+			if self._flushCall.active():
+				self._flushCall.cancel()
+
+			# Clean
+			self._flushCall = None
+
+		if self._buffer and self.fp is not None:
+			self.fp.write(''.join(self._buffer))
+			self.fp.flush()
+
+			# Clean
+			del self._buffer[:]
+
+			if self.fsync:
+				if wait:
+					os.fsync(self.fp.fileno())
+				elif self._syncing is None:
+					self._syncing = deferToThread(os.fsync, self.fp.fileno())
+					self._syncing.addErrback(log.err)
+					self._syncing.addBoth(self._synced)
+
+	def _synced(self, result):
+		self._syncing = None
+
+	def close(self, wait=True):
+		self.flush(wait)
+
+		if self.fp is not None:
+			fp, self.fp = self.fp, None
+
+			if wait and self.fsync:
+				# Writes fsync in thread may have missed
+				os.fsync(fp.fileno())
+
+			if self._syncing is not None:
+				# Close after fsync in thread is done
+				self._syncing.addBoth(self._closeSynced, fp, wait)
+			else:
+				self._closeSynced(None, fp, wait)
+
+	def _closeSynced(self, result, fp, wait):
+		if wait or not self.fsync:
+			fp.close()
+		else:
+			# Same in thread, not on main-loop
+			return deferToThread(self._syncClose, fp).addErrback(log.err)
+
+	def _syncClose(self, fp):
+		try:
+			os.fsync(fp.fileno())
+		finally:
+			fp.close()
+
+	def rotate(self):
+		"""Start new segment, return number of last closed segment"""
+		segment = self.segment
+
+		# Do not wait for fsync on main-loop
+		self.close(False)
+		self.open()
+
+		# Success
+		return segment
+
+	def purge(self, segment):
+		"""Remove segments already covered by snapshot"""
+		for current in self.segments():
+			if current <= segment:
+				try:
+					os.unlink(self.path(current))
+				except OSError:
+					log.err()
+
+	def __str__(self):
+		return 'Journal-{0}'.format(self.name)
@@ -0,0 +1,365 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+
+class TokenBucket:
+	"""Rate tokens per second, up to burst tokens saved"""
+
+	def __init__(self, rate, burst, now):
+		self.rate = float(rate)
+		self.burst = float(burst)
+
+		self.tokens = self.burst
+		self.time = now
+
+	def refill(self, now):
+		if now > self.time:
+			self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+			self.time = now
+
+	def ready(self, now):
+		self.refill(now)
+
+		# Success
+		return self.tokens >= 1
+
+	def consume(self, now):
+		self.refill(now)
+
+		if self.tokens >= 1:
+			self.tokens -= 1
+
+			# Success
+			return True
+
+		return False
+
+	def delay(self, now):
+		"""Seconds until next token"""
+		self.refill(now)
+
+		if self.tokens >= 1:
+			return 0.0
+
+		return (1 - self.tokens) / self.rate
+
+
+class Quota:
+	"""Limit messages per fixed window of period seconds, UTC aligned"""
+
+	def __init__(self, limit, period):
+		self.limit = limit
+		self.period = period
+
+		self.window = None
+		self.count = 0
+
+	def roll(self, now):
+		window = int(now // self.period)
+
+		if window != self.window:
+			self.window = window
+			self.count = 0
+
+	def delay(self, now):
+		"""Seconds until next message fits"""
+		self.roll(now)
+
+		if self.count < self.limit:
+			return 0.0
+
+		return (self.window + 1) * self.period - now
+
+
+class RateLimiter:
+	"""Global rate with burst, hourly and daily quotas of upstream"""
+
+	def __init__(self, rate, burst, now, hourly=0, daily=0):
+		self.bucket = TokenBucket(rate, burst or max(1, rate), now) if rate else None
+		self.quotas = [Quota(limit, period) for limit, period in ((hourly, 3600), (daily, 86400)) if limit]
+
+		self.taken = 0
+		self.forced = 0
+
+	def delay(self, now):
+		"""Seconds until token may be taken"""
+		delay = self.bucket.delay(now) if self.bucket is not None else 0.0
+
+		for quota in self.quotas:
+			delay = max(delay, quota.delay(now))
+
+		# Success
+		return delay
+
+	def take(self, now, force=False):
+		"""Take token, with force even if there is none"""
+		if not force and self.delay(now) > 0:
+			return False
+
+		if self.bucket is not None:
+			self.bucket.refill(now)
+			self.bucket.tokens -= 1
+
+		for quota in self.quotas:
+			quota.roll(now)
+			quota.count += 1
+
+		self.taken += 1
+
+		if force:
+			self.forced += 1
+
+		# Success
+		return True
+
+	def state(self):
+		"""Windows and counts of quotas, to survive restart"""
+		return [(quota.period, quota.window, quota.count) for quota in self.quotas]
+
+	def restore(self, state):
+		windows = dict(((period, (window, count)) for period, window, count in state))
+
+		for quota in self.quotas:
+			if quota.period in windows:
+				quota.window, quota.count = windows[quota.period]
+
+	def stats(self):
+		return (dict(
+			rate=self.bucket.rate if self.bucket is not None else 0,
+			tokens=self.bucket.tokens if self.bucket is not None else None,
+			quotas=[(quota.limit, quota.period, quota.count) for quota in self.quotas],
+			taken=self.taken,
+			forced=self.forced,
+		))
+
+
+class DomainLimit:
+	"""Dispatch rate and in-flight limit of one recipient domain
+
+	Rate goes down multiplicatively on deferrals and back up additively
+	on deliveries, never above configured rate (none means unlimited).
+	"""
+
+	# Weight of last response in deferral rate
+	alpha = 0.1
+
+	def __init__(self, name, rate, inflight, now):
+		self.name = name
+
+		self.bucket = TokenBucket(rate, max(1, rate), now) if rate else None
+		self.ceiling = rate
+		self.limit = inflight
+
+		self.inflight = 0
+		self.sent = 0
+		self.throttled = 0
+
+		self.deferred = 0
+		self.deferral = 0.0
+		self.decreased = None
+		self.code = None
+
+	def allowed(self, now):
+		if self.limit and self.inflight >= self.limit:
+			return False
+
+		if self.bucket is not None and not self.bucket.ready(now):
+			return False
+
+		# Success
+		return True
+
+	def acquire(self, now):
+		if self.bucket is not None:
+			self.bucket.consume(now)
+
+		self.inflight += 1
+		self.sent += 1
+
+	def release(self):
+		if self.inflight > 0:
+			self.inflight -= 1
+
+	def adapted(self):
+		if self.bucket is None:
+			return False
+
+		return not self.ceiling or self.bucket.rate < self.ceiling
+
+	def defer(self, now, code, backoff, start, floor):
+		self.deferred += 1
+		self.deferral += (1 - self.deferral) * self.alpha
+		self.code = code
+
+		if self.decreased is not None and now - self.decreased < 1:
+			# One decrease per second, answers of sends already in flight
+			return
+
+		self.decreased = now
+
+		if self.bucket is None:
+			self.bucket = TokenBucket(start, 1, now)
+		else:
+			self.bucket.refill(now)
+			self.bucket.rate = max(floor, self.bucket.rate * backoff)
+
+		self.bucket.burst = max(1.0, self.bucket.rate)
+		self.bucket.tokens = min(self.bucket.tokens, self.bucket.burst)
+
+	def deliver(self, now, probe, start):
+		self.deferral -= self.deferral * self.alpha
+
+		if self.adapted():
+			self.bucket.refill(now)
+			self.bucket.rate += probe
+
+			if not self.ceiling and self.bucket.rate >= start:
+				# Recovered, unlimited again
+				self.bucket = None
+			else:
+				if self.ceiling:
+					self.bucket.rate = min(self.ceiling, self.bucket.rate)
+
+				self.bucket.burst = max(1.0, self.bucket.rate)
+
+	def delay(self, now):
+		if self.bucket is not None:
+			return self.bucket.delay(now)
+
+		return 0.0
+
+	def idle(self, now):
+		if self.inflight or self.adapted():
+			return False
+
+		if self.bucket is not None:
+			self.bucket.refill(now)
+
+			# Full bucket, same as new one
+			return self.bucket.tokens >= self.bucket.burst
+
+		# Success
+		return True
+
+	def stats(self):
+		return (dict(
+			rate=self.bucket.rate if self.bucket is not None else 0,
+			limit=self.limit,
+			inflight=self.inflight,
+			sent=self.sent,
+			throttled=self.throttled,
+			deferred=self.deferred,
+			deferral=self.deferral,
+			code=self.code,
+		))
+
+
+class DomainLimits:
+	"""Limits per recipient domain, rules override defaults"""
+
+	def __init__(self, rules, rate=0, inflight=0, size=10000, codes=(421, 450, 451),
+			backoff=0.5, probe=0.1, start=10, floor=0.1):
+		self.rules = rules
+		self.rate = rate
+		self.inflight = inflight
+		self.size = size
+
+		# Deferral answers and rate adaptation
+		self.codes = codes
+		self.backoff = backoff
+		self.probe = probe
+		self.start = start
+		self.floor = floor
+
+		self.domains = dict()
+
+	def limited(self, name):
+		return name in self.domains or name in self.rules or self.rate or self.inflight
+
+	def get(self, name, now):
+		domain = self.domains.get(name)
+
+		if domain is None:
+			if len(self.domains) >= self.size:
+				self.cleanup(now)
+
+			rate, inflight = self.rules.get(name, (self.rate, self.inflight))
+
+			domain = self.domains[name] = DomainLimit(name, rate, inflight, now)
+
+		# Success
+		return domain
+
+	def allowed(self, name, now):
+		if not self.limited(name):
+			return True
+
+		domain = self.get(name, now)
+
+		if domain.allowed(now):
+			return True
+
+		domain.throttled += 1
+
+		# Fail
+		return False
+
+	def acquire(self, name, now):
+		if self.limited(name):
+			self.get(name, now).acquire(now)
+
+	def release(self, name):
+		domain = self.domains.get(name)
+
+		if domain is not None:
+			domain.release()
+
+	def response(self, name, code, now):
+		"""Learn from answer of send, code None is delivery"""
+		if code is None:
+			domain = self.domains.get(name)
+
+			if domain is not None:
+				domain.deliver(now, self.probe, self.start)
+		elif code in self.codes:
+			domain = self.get(name, now)
+			domain.defer(now, code, self.backoff, self.start, self.floor)
+
+	def delay(self, names, now):
+		"""Seconds until first of domains may get token"""
+		result = None
+
+		for name in names:
+			domain = self.domains.get(name)
+
+			if domain is not None:
+				delay = domain.delay(now)
+
+				if result is None or delay < result:
+					result = delay
+
+		# Success
+		return result
+
+	def cleanup(self, now):
+		for name, domain in self.domains.items():
+			if domain.idle(now):
+				del self.domains[name]
+
+	def stats(self):
+		return dict(((name, domain.stats()) for name, domain in self.domains.iteritems()))
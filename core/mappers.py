@@ -19,21 +19,140 @@
 import os
 
 from itertools import count
-from marshal import dump as mdump, load as mload
+from hashlib import sha1
+from marshal import dump as mdump, load as mload, dumps as mdumps
 from cPickle import load, dump
 from time import time
 from math import ceil
 
 from twisted.python.log import msg, err
-from twisted.internet.reactor import callLater
 from twisted.internet import reactor
 
 from core.constants import DEBUG, GROUP_STATUS_ACTIVE
+from core.configs import config
 from core.dirs import tmp, dbs
+from core.storage import storage
+from core.utils import LRUCache
+
+
+# Fields of messages and recipients read from storage, shared by all
+cache = LRUCache(config.getint('db', 'cache-size'), config.getint('db', 'cache-life'))
+
+# Values repeated in many objects, kept once, cleared when full
+_shared = dict()
+_sharedSize = 10000
+
+
+def shared(value):
+    """Same object for equal strings, like intern() but for unicode too
+
+    Only for values of few variants, like domains and senders.
+    """
+    if value is None:
+        return None
+
+    if type(value) is str:
+        return intern(value)
+
+    if value not in _shared and len(_shared) >= _sharedSize:
+        _shared.clear()
+
+    return _shared.setdefault(value, value)
+
+
+class Bodies(object):
+    """Message bodies stored once by content hash, counted by messages
+
+    Message keeps (id, digest, size) of each body, counters are rebuilt
+    from loaded messages.
+    """
+
+    prefix = 'b'
+
+    def __init__(self):
+        # Digest to [id, references, size]
+        self.digests = dict()
+        self.next = count(1)
+
+    def acquire(self, value):
+        """Store value unless same one is stored, return body of message"""
+        data = mdumps(value)
+        digest = sha1(data).hexdigest()
+
+        entry = self.digests.get(digest)
+
+        if entry is None:
+            entry = self.digests[digest] = [self.next.next(), 0, len(data)]
+
+            storage.set(self.prefix, entry[0], 'body', value)
+
+        entry[1] += 1
+
+        # Success
+        return (entry[0], digest, entry[2])
+
+    def release(self, body):
+        id, digest, size = body
+
+        entry = self.digests.get(digest)
+
+        if entry is None:
+            return
+
+        entry[1] -= 1
+
+        if entry[1] <= 0:
+            del self.digests[digest]
+
+            storage.delete(self.prefix, id, 'body')
+            cache.delete((self.prefix, id, 'body'))
+
+    def get(self, body):
+        key = (self.prefix, body[0], 'body')
+
+        value = cache.get(key)
+
+        if value is None:
+            value = storage.get(*key)
+
+            if value is not None and cache.size:
+                cache.set(key, value)
+
+        # Success
+        return value
+
+    def rebuild(self, messages):
+        self.digests.clear()
+
+        for message in messages:
+            for id, digest, size in (message.bodies or {}).itervalues():
+                entry = self.digests.get(digest)
+
+                if entry is None:
+                    entry = self.digests[digest] = [id, 0, size]
+
+                entry[1] += 1
+
+        self.next = count(max([entry[0] for entry in self.digests.itervalues()] or [0]) + 1)
+
+    def stats(self):
+        stored = sum(entry[2] for entry in self.digests.itervalues())
+
+        return (dict(
+            bodies=len(self.digests),
+            references=sum(entry[1] for entry in self.digests.itervalues()),
+            stored=stored,
+            saved=sum(entry[2] * entry[1] for entry in self.digests.itervalues()) - stored,
+        ))
+
+
+bodies = Bodies()
 
 
 class Base(object):
 
+    __slots__ = ()
+
     @classmethod
     def fromDict(cls, params):
         return cls(**params)
@@ -47,142 +166,81 @@ class Base(object):
 
 class BaseWithStorage(Base):
 
-    prefix = None
-
-    def path(self, name):
-        id = ceil(self.id / 1000.)
+    __slots__ = ()
 
-        path = dbs('{0:.0f}'.format(ceil((id) / 100.)), '{0:.0f}'.format(id))
-        file = os.path.join(path, '{0}_{1}_{2}'.format(self.prefix, self.id, name))
-
-        return ((
-            path,
-            file
-        ))
+    prefix = None
 
     def set(self, name, value):
         if self.id is None:
             raise RuntimeError('Cannot set with ID none')
 
         if value is not None:
-            path, file = self.path(name)
-
-            if not os.path.exists(path):
-                os.makedirs(path, 0777)
-                os.chmod(path, 0777)
+            storage.set(self.prefix, self.id, name, value)
 
-            with open(file, 'wb') as fp:
-                mdump(value, fp)
+            # Other objects of same ID read it again
+            self._cachedDelete(name)
 
     def get(self, name):
         if self.id is None:
             raise RuntimeError('Cannot get with ID none')
 
-        if self._cachedLife:
+        if cache.size:
             # Try find in cache
             result = self._cachedGet(name)
             if not result is self._cachedNone:
                 # Success
                 return result
 
-        path, file = self.path(name)
-
-        if os.path.exists(file):
-            with open(file, 'rb') as fp:
-                result = mload(fp)
+        result = storage.get(self.prefix, self.id, name)
 
-                # If cache enabled, set it
-                if self._cachedLife:
-                    self._cachedSet(name, result)
+        if result is not None:
+            # If cache enabled, set it
+            if cache.size:
+                self._cachedSet(name, result)
 
-                # Return to user, not from cache
-                return result
+            # Return to user, not from cache
+            return result
 
     def deleteFiles(self, *files):
         for name in files:
-            path, file = self.path(name)
-
-            if os.path.exists(file):
-                try:
-                    os.unlink(file)
-                except:
-                    err()
+            storage.delete(self.prefix, self.id, name)
 
             # Clean cache
             self._cachedDelete(name)
 
-    _cached = None
-
     _cachedNone = object()
-    _cachedLife = 60
-    _cachedTime = None
 
     def _cachedSet(self, name, value):
         if DEBUG:
             msg(self, '_cachedSet', name)
 
-        if self._cached is None:
-            # Init
-            self._cached = dict()
-            self._cachedTime = dict()
-
-        if (name in self._cachedTime and self._cachedTime[name] is not None):
-            if self._cachedTime[name].active():
-                self._cachedTime[name].cancel()
-
-            # Clean
-            self._cachedTime[name] = None
-
-        self._cached[name] = value
-        self._cachedTime[name] = callLater(self._cachedLife, self._cachedDelete, name)
+        cache.set((self.prefix, self.id, name), value)
 
     def _cachedGet(self, name):
         if DEBUG:
             msg(self, '_cachedGet', name)
 
-        if self._cached is not None and name in self._cached:
-            if (name in self._cachedTime and self._cachedTime[name] is not None):
-                if self._cachedTime[name].active():
-                    if DEBUG:
-                        msg(self, '_cachedGet', name, 'reset')
-
-                    self._cachedTime[name].reset(self._cachedLife)
-
-            return self._cached[name]
-
-        return self._cachedNone
+        return cache.get((self.prefix, self.id, name), self._cachedNone)
 
     def _cachedDelete(self, name):
         if DEBUG:
             msg(self, '_cachedDelete', name)
 
-        if self._cached is not None and name in self._cached:
-            del self._cached[name]
-
-            # Clean
-            if not self._cached:
-                self._cached = None
-
-        if self._cachedTime is not None:
-            if (name in self._cachedTime and self._cachedTime[name] is not None):
-                if self._cachedTime[name].active():
-                    self._cachedTime[name].cancel()
-
-                # Clean
-                self._cachedTime[name] = None
-                if not self._cachedTime:
-                    self._cachedTime = None
+        cache.delete((self.prefix, self.id, name))
 
 
 class Message(BaseWithStorage):
 
-    prefix = 'm'
+    __slots__ = ((
+        'id',
+        'time',
+        'last',
+        'tos',
+        '_sender',
+        'bodies',
+    ))
 
-    id = None
-    time = None
-    last = None
-    tos = 0
-    sender = None
+    prefix = 'm'
 
     available = ((
         'id',
@@ -194,9 +252,20 @@ class Message(BaseWithStorage):
         'tos',
         'sender',
         'params',
+        'bodies',
     ))
 
+    # Fields stored by content, once for all messages
+    contents = ('subject', 'html', 'text')
+
     def __init__(self, **params):
+        self.id = None
+        self.time = None
+        self.last = None
+        self.tos = 0
+        self.sender = None
+        self.bodies = None
+
         if len(params):
             if 'id' in params:
                 self.id = params.pop('id')
@@ -217,9 +286,21 @@ class Message(BaseWithStorage):
             time=self.time,
             last=self.last,
             tos=self.tos,
-            sender=self.sender
+            sender=self.sender,
+            bodies=self.bodies,
         ))
 
+    @property
+    def sender(self):
+        return self._sender
+
+    @sender.setter
+    def sender(self, value):
+        if isinstance(value, dict):
+            value = dict((shared(key), shared(item)) for key, item in value.iteritems())
+
+        self._sender = value
+
     @property
     def params(self):
         return self.get('params')
@@ -230,47 +311,84 @@ class Message(BaseWithStorage):
 
     @property
     def subject(self):
-        return self.get('subject')
+        return self.getBody('subject')
 
     @subject.setter
     def subject(self, value):
-        return self.set('subject', value)
+        return self.setBody('subject', value)
 
     @property
     def html(self):
-        return self.get('html')
+        return self.getBody('html')
 
     @html.setter
     def html(self, value):
-        return self.set('html', value)
+        return self.setBody('html', value)
 
     @property
     def text(self):
-        return self.get('text')
+        return self.getBody('text')
 
     @text.setter
     def text(self, value):
-        return self.set('text', value)
+        return self.setBody('text', value)
+
+    def getBody(self, name):
+        if self.bodies and name in self.bodies:
+            return bodies.get(self.bodies[name])
+
+        # Stored before bodies were shared
+        return self.get(name)
+
+    def setBody(self, name, value):
+        if value is None:
+            return
+
+        if self.bodies is None:
+            self.bodies = dict()
+
+        body = self.bodies.get(name)
+
+        self.bodies[name] = bodies.acquire(value)
+
+        if body is not None:
+            bodies.release(body)
 
     def delete(self):
-        self.deleteFiles('params', 'subject', 'html', 'text')
+        # Fields stored before bodies were shared, only if not covered
+        self.deleteFiles('params', *[name for name in self.contents if not (self.bodies and name in self.bodies)])
+
+        for body in (self.bodies or {}).itervalues():
+            bodies.release(body)
+
+        self.bodies = None
 
 
 class To(BaseWithStorage):
 
+    __slots__ = ((
+        'id',
+        'message',
+        'group',
+        '_email',
+        '_domain',
+        'name',
+        '_replyEmail',
+        '_replyName',
+        'time',
+        'after',
+        'priority',
+        'attempts',
+        'express',
+        'deadline',
+        'queued',
+        '_parts',
+    ))
+
     prefix = 't'
 
-    id = None
-    message = None
-    group = None
-    email = None
-    name = None
-    replyEmail = None
-    replyName = None
-    time = None
-    after = None
-    priority = 0
-    retries = None
+    # Parts up to this marshaled size are kept in record, not in storage
+    inline = config.getint('db', 'parts-inline')
 
     available = ((
         'id',
@@ -284,14 +402,38 @@ class To(BaseWithStorage):
         'parts',
         'after',
         'priority',
-        'retries',
+        'attempts',
+        'express',
+        'deadline',
     ))
 
     def __init__(self, **params):
+        self.id = None
+        self.message = None
+        self.group = None
+        self._email = None
+        self._domain = None
+        self.name = None
+        self._replyEmail = None
+        self._replyName = None
+        self.time = None
+        self.after = None
+        self.priority = 0
+        self.attempts = 0
+        self.express = False
+        self.deadline = None
+        self._parts = None
+
+        # Time of enqueue in this process, not saved
+        self.queued = None
+
         if len(params):
             if 'id' in params:
                 self.id = params.pop('id')
 
+            # Old rows keep retries left, attempts start from zero
+            params.pop('retries', None)
+
             for key, value in params.iteritems():
                 if not key in self.available:
                     raise RuntimeError('Unknown key for To {0}'.format(key))
@@ -302,11 +444,8 @@ class To(BaseWithStorage):
             if self.time is None:
                 self.time = int(reactor.seconds())
 
-            if self.retries is None:
-                self.retries = 1
-
     def toDict(self):
-        return (dict(
+        result = (dict(
             id=self.id,
             message=self.message,
             group=self.group,
@@ -317,19 +456,68 @@ class To(BaseWithStorage):
             time=self.time,
             after=self.after,
             priority=self.priority,
-            retries=self.retries,
+            attempts=self.attempts,
+            express=self.express,
+            deadline=self.deadline,
         ))
 
+        if self._parts is not None:
+            result['parts'] = self._parts
+
+        # Success
+        return result
+
+    @property
+    def email(self):
+        return self._email
+
+    @email.setter
+    def email(self, value):
+        self._email = value
+        self._domain = None
+
+    @property
+    def domain(self):
+        if self._domain is None and self._email:
+            self._domain = shared(self._email.rpartition('@')[2].lower())
+
+        return self._domain
+
+    @property
+    def replyEmail(self):
+        return self._replyEmail
+
+    @replyEmail.setter
+    def replyEmail(self, value):
+        self._replyEmail = shared(value)
+
+    @property
+    def replyName(self):
+        return self._replyName
+
+    @replyName.setter
+    def replyName(self, value):
+        self._replyName = shared(value)
+
     @property
     def parts(self):
+        if self._parts is not None:
+            return self._parts
+
         return self.get('parts')
 
     @parts.setter
     def parts(self, value):
-        return self.set('parts', value)
+        if value is not None and len(mdumps(value)) <= self.inline:
+            self._parts = value
+        else:
+            self._parts = None
+
+            return self.set('parts', value)
 
     def delete(self):
-        self.deleteFiles('parts')
+        if self._parts is None:
+            self.deleteFiles('parts')
 
     def __repr__(self):
         return '<To 0x{0} {1!r}-{2!r}>'.format(self.id, self.email, self.name)
@@ -337,14 +525,24 @@ class To(BaseWithStorage):
 
 class Group(Base):
 
-    id = None
-    all = 0
-    wait = 0
-    sending = 0
-    sent = 0
-    errors = 0
-    time = None
-    status = GROUP_STATUS_ACTIVE
+    __slots__ = ((
+        'id',
+        'all',
+        'wait',
+        'sending',
+        'sent',
+        'errors',
+        'time',
+        'status',
+        'weight',
+        'deadline',
+        'expired',
+        'startAt',
+        'rate',
+        'dailyQuota',
+        'dailySent',
+        'day',
+    ))
 
     available = ((
         'id',
@@ -355,9 +553,34 @@ class Group(Base):
         'errors',
         'time',
         'status',
+        'weight',
+        'deadline',
+        'expired',
+        'startAt',
+        'rate',
+        'dailyQuota',
+        'dailySent',
+        'day',
     ))
 
     def __init__(self, **params):
+        self.id = None
+        self.all = 0
+        self.wait = 0
+        self.sending = 0
+        self.sent = 0
+        self.errors = 0
+        self.time = None
+        self.status = GROUP_STATUS_ACTIVE
+        self.weight = 1
+        self.deadline = None
+        self.expired = 0
+        self.startAt = None
+        self.rate = 0
+        self.dailyQuota = 0
+        self.dailySent = 0
+        self.day = None
+
         if len(params):
             for key, value in params.iteritems():
                 if not key in self.available:
@@ -378,5 +601,13 @@ class Group(Base):
             sent=self.sent,
             errors=self.errors,
             time=self.time,
-            status=self.status
+            status=self.status,
+            weight=self.weight,
+            deadline=self.deadline,
+            expired=self.expired,
+            startAt=self.startAt,
+            rate=self.rate,
+            dailyQuota=self.dailyQuota,
+            dailySent=self.dailySent,
+            day=self.day,
         ))
@@ -0,0 +1,553 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from collections import deque
+from itertools import count, chain
+from heapq import heappush, heappop
+from marshal import dumps as mdumps, load as mload
+
+from twisted.python import log
+
+from core.dirs import dbs
+from core.mappers import To
+
+
+class Segment:
+	"""One append-only file with spilled recipients"""
+
+	def __init__(self, path):
+		self.path = path
+		self.length = 0
+		self.count = 0
+
+		self.writer = open(self.path, 'ab')
+		self.reader = None
+
+	@property
+	def offset(self):
+		if self.reader is None:
+			return 0
+
+		return self.reader.tell()
+
+	def write(self, to):
+		data = mdumps(to.toDict())
+
+		self.writer.write(data)
+		self.length += len(data)
+		self.count += 1
+
+	def read(self, limit):
+		if self.writer is not None:
+			self.writer.flush()
+
+		if self.reader is None:
+			self.reader = open(self.path, 'rb')
+
+		result = []
+
+		for i in xrange(min(limit, self.count)):
+			result.append(To.fromDict(mload(self.reader)))
+
+		self.count -= len(result)
+
+		# Success
+		return result
+
+	def close(self):
+		for fp in (self.writer, self.reader):
+			if fp is not None:
+				fp.close()
+
+		self.writer = None
+		self.reader = None
+
+	def remove(self):
+		self.close()
+
+		try:
+			os.unlink(self.path)
+		except OSError:
+			log.err()
+
+
+class SpoolView:
+	"""Point-in-time copy of spool queue, spilled part by hard links"""
+
+	def __init__(self, hot, ranges):
+		self.hot = hot
+		self.ranges = ranges
+
+	def __len__(self):
+		return len(self.hot) + sum(count for path, offset, count in self.ranges)
+
+	def __iter__(self):
+		try:
+			for to in self.hot:
+				yield to
+
+			for path, offset, count in self.ranges:
+				with open(path, 'rb') as fp:
+					fp.seek(offset)
+
+					for i in xrange(count):
+						yield To.fromDict(mload(fp))
+		finally:
+			self.close()
+
+	def close(self):
+		for path, offset, count in self.ranges:
+			if os.path.exists(path):
+				os.unlink(path)
+
+		# Clean
+		self.ranges = ()
+
+
+class Budget:
+	"""Recipients kept in memory by all queues sharing it, zero is unlimited"""
+
+	def __init__(self, limit=0):
+		self.limit = limit
+		self.used = 0
+
+	def full(self):
+		return bool(self.limit) and self.used >= self.limit
+
+
+class SpoolQueue:
+	"""FIFO queue of recipients, keeps head in memory and spills tail to disk"""
+
+	counter = count(1)
+	directory = dbs('spool')
+
+	def __init__(self, name, limit=0, batch=1000, size=67108864, budget=None):
+		self.name = name
+		self.batch = batch
+		self.size = size
+
+		# Own limit unless shared with other queues
+		self.budget = budget if budget is not None else Budget(limit)
+
+		self.hot = deque()
+		self.segments = deque()
+		self.spilled = 0
+
+	@classmethod
+	def cleanup(cls):
+		"""Spool is rebuilt from snapshot on start, drop files of old process"""
+		if os.path.isdir(cls.directory):
+			for name in os.listdir(cls.directory):
+				os.unlink(os.path.join(cls.directory, name))
+
+	def path(self):
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+
+		return os.path.join(self.directory, '{0}-{1}.spool'.format(self.name, self.counter.next()))
+
+	def append(self, to):
+		if self.spilled or self.budget.full():
+			self.spill(to)
+		else:
+			self.hot.append(to)
+
+			self.budget.used += 1
+
+	def spill(self, to):
+		if not self.segments or self.segments[-1].length >= self.size or self.segments[-1].writer is None:
+			if self.segments and self.segments[-1].writer is not None:
+				# Full, read only from now
+				self.segments[-1].writer.close()
+				self.segments[-1].writer = None
+
+			self.segments.append(Segment(self.path()))
+
+		self.segments[-1].write(to)
+		self.spilled += 1
+
+	def refill(self):
+		hot = len(self.hot)
+
+		while self.segments and len(self.hot) < self.batch:
+			segment = self.segments[0]
+
+			self.hot.extend(segment.read(self.batch - len(self.hot)))
+
+			if not segment.count:
+				# Drained
+				segment.remove()
+
+				self.segments.popleft()
+
+		self.spilled = sum(segment.count for segment in self.segments)
+
+		self.budget.used += len(self.hot) - hot
+
+	def popleft(self):
+		if not self.hot and self.spilled:
+			self.refill()
+
+		to = self.hot.popleft()
+
+		self.budget.used -= 1
+
+		# Success
+		return to
+
+	def clear(self):
+		self.budget.used -= len(self.hot)
+		self.hot.clear()
+
+		for segment in self.segments:
+			segment.remove()
+
+		self.segments.clear()
+		self.spilled = 0
+
+	def capture(self):
+		ranges = []
+
+		for segment in self.segments:
+			if segment.writer is not None:
+				segment.writer.flush()
+
+			path = '{0}.{1}.snapshot'.format(segment.path, self.counter.next())
+
+			# Keep file even if drained meanwhile
+			os.link(segment.path, path)
+
+			ranges.append((path, segment.offset, segment.count))
+
+		# Success
+		return SpoolView(list(self.hot), ranges)
+
+	def __iter__(self):
+		return iter(self.capture())
+
+	def __len__(self):
+		return len(self.hot) + self.spilled
+
+	def __nonzero__(self):
+		return bool(self.hot) or bool(self.spilled)
+
+
+
+class BucketQueue:
+	"""Deque per level and bitmap of non-empty levels, lowest level served first"""
+
+	def __init__(self, levels):
+		self.buckets = [deque() for level in xrange(levels)]
+		self.mask = 0
+
+	def append(self, level, item):
+		self.buckets[level].append(item)
+		self.mask |= 1 << level
+
+	def first(self, mask=-1):
+		"""Lowest non-empty level of levels in mask, None if empty"""
+		mask &= self.mask
+
+		if mask:
+			return (mask & -mask).bit_length() - 1
+
+	def popleft(self, level):
+		bucket = self.buckets[level]
+		item = bucket.popleft()
+
+		if not bucket:
+			self.mask &= ~(1 << level)
+
+		# Success
+		return item
+
+	def __len__(self):
+		return sum(len(bucket) for bucket in self.buckets)
+
+	def __nonzero__(self):
+		return bool(self.mask)
+
+
+class Lane:
+	"""Queued recipients of one group
+
+	Inside each priority level recipients go earliest deadline first, own
+	or of group, then the rest in FIFO order.
+	"""
+
+	def __init__(self, group, fifo, spool=deque, budget=None):
+		self.group = group
+
+		# Queues of other levels, memory of deadline heaps
+		self.spool = spool
+		self.budget = budget
+
+		self.paused = False
+		self.closed = False
+
+		# Group start time, parked until then
+		self.start = None
+
+		# Rate and daily quota of group, parked until capped time
+		self.bucket = None
+		self.quota = 0
+		self.capped = None
+
+		# Level 0 is plain FIFO, may spill to disk
+		self.levels = {0: fifo}
+
+		# Heaps of (deadline, id, to) per level
+		self.deadlines = dict()
+
+		# Deadline of group, for recipients without own
+		self.deadline = None
+
+		# Earliest deadlines lane is listed with, by level
+		self.urgent = dict()
+
+		# Levels where lane is listed for round-robin
+		self.ringed = set()
+
+		# Deficit round-robin share
+		self.weight = 1
+		self.deficit = 0
+
+		# Dispatch counter and rate per second since last measure
+		self.dispatched = 0
+		self.measured = 0
+		self.rate = 0.0
+
+	def append(self, level, to):
+		if to.deadline and not (self.budget is not None and self.budget.full()):
+			heap = self.deadlines.get(level)
+
+			if heap is None:
+				heap = self.deadlines[level] = []
+
+			heappush(heap, (to.deadline, to.id, to))
+
+			if self.budget is not None:
+				self.budget.used += 1
+
+			# Success
+			return
+
+		queue = self.levels.get(level)
+
+		if queue is None:
+			queue = self.levels[level] = self.spool()
+
+		queue.append(to)
+
+	@property
+	def parked(self):
+		return self.paused or self.start is not None or self.capped is not None
+
+	def ready(self, level):
+		return bool(self.deadlines.get(level)) or bool(self.levels.get(level))
+
+	def popleft(self, level):
+		heap = self.deadlines.get(level)
+
+		if heap:
+			queue = self.levels.get(level)
+
+			if not (self.deadline and queue and self.deadline < heap[0][0]):
+				if self.budget is not None:
+					self.budget.used -= 1
+
+				return heappop(heap)[2]
+
+		return self.levels[level].popleft()
+
+	def earliest(self, level):
+		"""Deadline of first recipient of level, own or of group"""
+		heap = self.deadlines.get(level)
+		deadline = heap[0][0] if heap else None
+
+		if self.deadline and self.levels.get(level):
+			if deadline is None or self.deadline < deadline:
+				deadline = self.deadline
+
+		# Success
+		return deadline
+
+	def size(self, level):
+		return len(self.deadlines.get(level, ())) + len(self.levels.get(level, ()))
+
+	def readyLevels(self):
+		return [level for level in set(self.levels).union(self.deadlines) if self.ready(level)]
+
+	def expires(self, to):
+		"""Deadline of recipient, own or of group"""
+		return to.deadline or self.deadline
+
+	def clear(self):
+		for queue in self.levels.itervalues():
+			queue.clear()
+
+		if self.budget is not None:
+			self.budget.used -= sum(len(heap) for heap in self.deadlines.itervalues())
+
+		self.deadlines.clear()
+
+	def __iter__(self):
+		return chain(
+			(to for heap in self.deadlines.itervalues() for deadline, id, to in heap),
+			chain.from_iterable(self.levels.itervalues()),
+		)
+
+	def __len__(self):
+		return sum(len(heap) for heap in self.deadlines.itervalues()) + sum(len(queue) for queue in self.levels.itervalues())
+
+	def __repr__(self):
+		return '<Lane {0!r} {1}>'.format(self.group, len(self))
+
+
+class TimingWheel:
+	"""Hierarchical timing wheel of recipients keyed by second of after
+
+	Level 0 has one slot per second, every next level one slot per turn
+	of previous one, later recipients wait in overflow. Slot is a dict of
+	owner to list of recipients, due slot is handed over in one step.
+	"""
+
+	def __init__(self, now, bits=(8, 6, 6, 6)):
+		self.current = int(now)
+		self.bits = bits
+
+		self.levels = [[None] * (1 << bit) for bit in bits]
+		self.overflow = dict()
+
+		# Level limit of delta, shift and mask of slot index, slots
+		self.table = [(1 << sum(bits[:level + 1]), sum(bits[:level]), (1 << bit) - 1, self.levels[level])
+			for level, bit in enumerate(bits)]
+
+		self.size = 0
+
+	def place(self, owner, to):
+		when = int(to.after)
+		delta = when - self.current
+
+		for limit, shift, mask, slots in self.table:
+			if delta < limit:
+				index = (when >> shift) & mask
+				slot = slots[index]
+
+				if slot is None:
+					slot = slots[index] = dict()
+
+				break
+		else:
+			slot = self.overflow
+
+		items = slot.get(owner)
+
+		if items is None:
+			slot[owner] = [to]
+		else:
+			items.append(to)
+
+	def add(self, owner, to):
+		"""Schedule recipient, false if it is already due"""
+		if int(to.after) <= self.current:
+			return False
+
+		self.place(owner, to)
+		self.size += 1
+
+		# Success
+		return True
+
+	def cascade(self, slot):
+		place = self.place
+
+		for owner, items in slot.iteritems():
+			for to in items:
+				place(owner, to)
+
+	def advance(self, now):
+		"""Move to second now, yield (owner, recipients) that are due"""
+		now = int(now)
+
+		first = self.levels[0]
+		mask = self.table[0][2]
+
+		while self.current < now:
+			if not self.size:
+				# Nothing to wait for
+				self.current = now
+
+				break
+
+			self.current += 1
+
+			if not self.current & mask:
+				for limit, shift, levelMask, slots in self.table[1:]:
+					if self.current & ((1 << shift) - 1):
+						# Lower level did not finish turn
+						break
+
+					index = (self.current >> shift) & levelMask
+
+					if slots[index] is not None:
+						slot, slots[index] = slots[index], None
+
+						self.cascade(slot)
+				else:
+					if self.overflow:
+						slot, self.overflow = self.overflow, dict()
+
+						self.cascade(slot)
+
+			index = self.current & mask
+
+			if first[index] is not None:
+				slot, first[index] = first[index], None
+
+				for owner, items in slot.iteritems():
+					self.size -= len(items)
+
+					yield owner, items
+
+	def remove(self, owner):
+		"""Drop all recipients of owner, return them"""
+		result = []
+
+		for slot in chain(chain.from_iterable(self.levels), (self.overflow, )):
+			if slot and owner in slot:
+				items = slot.pop(owner)
+
+				self.size -= len(items)
+
+				result.extend(items)
+
+		# Success
+		return result
+
+	def __iter__(self):
+		for slot in chain(chain.from_iterable(self.levels), (self.overflow, )):
+			if slot:
+				for items in slot.itervalues():
+					for to in items:
+						yield to
+
+	def __len__(self):
+		return self.size
@@ -0,0 +1,132 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+from struct import Struct
+from zlib import crc32
+from marshal import dumps as mdumps, loads as mloads
+
+from twisted.python import log
+
+
+MAGIC = 'MSRF'
+VERSION = 1
+
+header = Struct('!4sB')
+block = Struct('!II')
+record = Struct('!I')
+
+
+class RecordWriter:
+	"""Length-prefixed marshal records, grouped in checksummed blocks
+
+	File: magic, version, then blocks of (size, crc32, records).
+	"""
+
+	def __init__(self, fp, size=65536):
+		self.fp = fp
+		self.size = size
+
+		self._buffer = []
+		self._length = 0
+
+		self.fp.write(header.pack(MAGIC, VERSION))
+
+	def write(self, value):
+		data = mdumps(value)
+
+		self._buffer.append(record.pack(len(data)))
+		self._buffer.append(data)
+		self._length += record.size + len(data)
+
+		if self._length >= self.size:
+			self.flush()
+
+	def flush(self):
+		if self._buffer:
+			data = ''.join(self._buffer)
+
+			self.fp.write(block.pack(len(data), crc32(data) & 0xffffffff))
+			self.fp.write(data)
+
+			# Clean
+			del self._buffer[:]
+			self._length = 0
+
+	def close(self):
+		self.flush()
+
+
+class RecordReader:
+	"""Read records one by one, stop on first damaged block"""
+
+	def __init__(self, fp):
+		self.fp = fp
+
+		magic, version = header.unpack(self.fp.read(header.size))
+
+		if magic != MAGIC:
+			raise ValueError('Not a records file')
+
+		if version > VERSION:
+			raise ValueError('Unsupported records version {0}'.format(version))
+
+	@classmethod
+	def match(cls, fp):
+		position = fp.tell()
+
+		try:
+			return fp.read(len(MAGIC)) == MAGIC
+		finally:
+			fp.seek(position)
+
+	def __iter__(self):
+		read = self.fp.read
+
+		while True:
+			data = read(block.size)
+
+			if not data:
+				# Success
+				break
+
+			if len(data) < block.size:
+				log.msg(self, 'truncated block header')
+
+				break
+
+			length, checksum = block.unpack(data)
+
+			data = read(length)
+
+			if len(data) < length or (crc32(data) & 0xffffffff) != checksum:
+				log.msg(self, 'damaged block', length)
+
+				break
+
+			offset = 0
+
+			while offset < length:
+				size, = record.unpack_from(data, offset)
+				offset += record.size
+
+				yield mloads(data[offset:offset + size])
+
+				offset += size
+
+	def __str__(self):
+		return 'RecordReader-{0}'.format(getattr(self.fp, 'name', '?'))
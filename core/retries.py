@@ -0,0 +1,66 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+
+
+class RetryPolicy:
+	"""Exponential backoff with jitter, attempts limited per error class
+
+	Recipient attempts is number of failed sends, delay of attempt n is
+	delay * factor ** (n - 1), not more than limit, randomly shortened up
+	to half. Recipients older than age or not in time for deadline are
+	not retried.
+	"""
+
+	def __init__(self, attempts, delay=60, factor=2, limit=3600, age=86400):
+		self.attempts = attempts
+		self.delay = delay
+		self.factor = factor
+		self.limit = limit
+		self.age = age
+
+		# Given up by error class
+		self.failed = dict()
+
+	def backoff(self, attempt):
+		delay = min(self.limit, self.delay * self.factor ** max(0, attempt - 1))
+
+		# Success
+		return delay * random.uniform(0.5, 1.0)
+
+	def schedule(self, to, kind, now, deadline=None):
+		"""Count failed attempt, set after and return true if to is retried"""
+		to.attempts += 1
+
+		after = int(now + self.backoff(to.attempts))
+
+		if (to.attempts > self.attempts.get(kind, 0) or (self.age and now - to.time > self.age)
+				or (deadline and after >= deadline)):
+			self.failed[kind] = self.failed.get(kind, 0) + 1
+
+			# Fail
+			return False
+
+		to.after = after
+
+		# Success
+		return True
+
+	def stats(self):
+		return dict(self.failed)
@@ -0,0 +1,1028 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import mmap
+import sqlite3
+
+from math import ceil
+from zlib import crc32
+from struct import Struct
+from marshal import load as mload, dumps as mdumps, loads as mloads
+
+from twisted.python.log import msg, err
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.internet.task import cooperate, TaskStopped
+from twisted.internet.threads import deferToThread, deferToThreadPool
+
+from core.configs import config
+from core.dirs import dbs
+from core.journal import Journal
+
+
+class FilesStorage(object):
+    """Default engine, marshal snapshots and one file per field"""
+
+    name = 'files'
+    snapshots = True
+
+    def path(self, prefix, id, name):
+        part = ceil(id / 1000.)
+
+        path = dbs('{0:.0f}'.format(ceil((part) / 100.)), '{0:.0f}'.format(part))
+        file = os.path.join(path, '{0}_{1}_{2}'.format(prefix, id, name))
+
+        return ((
+            path,
+            file
+        ))
+
+    def set(self, prefix, id, name, value):
+        self.write(prefix, id, name, mdumps(value))
+
+    def write(self, prefix, id, name, data):
+        """Set already marshaled value"""
+        path, file = self.path(prefix, id, name)
+
+        if not os.path.exists(path):
+            os.makedirs(path, 0777)
+            os.chmod(path, 0777)
+
+        with open(file, 'wb') as fp:
+            fp.write(data)
+
+    def get(self, prefix, id, name):
+        path, file = self.path(prefix, id, name)
+
+        if os.path.exists(file):
+            with open(file, 'rb') as fp:
+                return mload(fp)
+
+    def delete(self, prefix, id, name):
+        path, file = self.path(prefix, id, name)
+
+        if os.path.exists(file):
+            try:
+                os.unlink(file)
+            except:
+                err()
+
+    def journal(self, name):
+        if config.getboolean('db', 'journal'):
+            return (Journal(
+                name,
+                interval=config.getfloat('db', 'journal-interval'),
+                fsync=config.getboolean('db', 'journal-fsync'),
+            ))
+
+    def __str__(self):
+        return 'Storage-{0}'.format(self.name)
+
+
+class SQLiteJournal(object):
+    """Journal compatible view of one table in SQLite storage"""
+
+    snapshots = False
+
+    def __init__(self, storage, kind):
+        self.storage = storage
+        self.kind = kind
+
+        # Compaction by size is not needed
+        self.size = 0
+
+    def write(self, record):
+        if record[0] == 'a':
+            # Ids of deleted rows are not given again
+            self.storage.counter(self.kind, record[1]['id'] + 1)
+            self.storage.queue(('put', self.kind, record[1]['id'], mdumps(record[1])))
+        elif record[0] == 's':
+            self.storage.queue(('status', self.kind, record[1], record[2]))
+        else:
+            self.storage.queue(('del', self.kind, record[1]))
+
+    def replay(self):
+        next = self.storage.next(self.kind)
+
+        if next is not None:
+            yield ('n', next)
+
+        for data in self.storage.records(self.kind):
+            yield ('a', data)
+
+    def open(self):
+        """Nothing to do, rows are written in place"""
+
+    def flush(self, wait=True):
+        self.storage.flush(wait)
+
+    def close(self):
+        self.storage.close()
+
+    def __str__(self):
+        return 'SQLiteJournal-{0}'.format(self.kind)
+
+
+class SQLiteStorage(object):
+    """Messages, recipients, groups and fields in one SQLite database"""
+
+    name = 'sqlite'
+    snapshots = False
+
+    schema = ((
+        'CREATE TABLE IF NOT EXISTS records (kind TEXT NOT NULL, id INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (kind, id))',
+        'CREATE TABLE IF NOT EXISTS blobs (prefix TEXT NOT NULL, id INTEGER NOT NULL, name TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (prefix, id, name))',
+        'CREATE TABLE IF NOT EXISTS counters (kind TEXT NOT NULL PRIMARY KEY, next INTEGER NOT NULL)',
+    ))
+
+    deleted = object()
+
+    # Fields written before migration
+    legacy = None
+
+    def __init__(self, file, interval=0.5, limit=5000):
+        self.file = file
+        self.interval = interval
+        self.limit = limit
+
+        self.batch = []
+        self.generation = 0
+
+        # Id counters by kind, changed ones written with next batch
+        self.counters = dict()
+        self.advanced = set()
+
+        # Not yet committed fields, served to readers
+        self.overlay = dict()
+
+        self._reader = None
+        self._writer = None
+        self._flushCall = None
+
+        self._pool = ThreadPool(minthreads=1, maxthreads=1, name=str(self))
+
+    def connect(self, **params):
+        connection = sqlite3.connect(self.file, **params)
+        connection.text_factory = str
+
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+        for query in self.schema:
+            connection.execute(query)
+
+        connection.commit()
+
+        # Success
+        return connection
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            self._reader = self.connect()
+
+        return self._reader
+
+    @property
+    def writer(self):
+        if self._writer is None:
+            self._writer = self.connect(check_same_thread=False)
+
+        return self._writer
+
+    def queue(self, operation):
+        self.batch.append(operation)
+
+        if len(self.batch) >= self.limit:
+            self.flush(False)
+        elif self._flushCall is None:
+            self._flushCall = reactor.callLater(self.interval, self.flush, False)
+
+    def flush(self, wait=True):
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+
+            # Clean
+            self._flushCall = None
+
+        if not self.batch:
+            return
+
+        batch, self.batch = self.batch, []
+        batch.extend(('next', kind, self.counters[kind]) for kind in self.advanced)
+
+        self.advanced.clear()
+        self.generation += 1
+
+        if wait or not self._pool.started:
+            self.execute(batch)
+            self.committed(None, self.generation)
+        else:
+            deferred = deferToThreadPool(reactor, self._pool, self.execute, batch)
+            deferred.addCallback(self.committed, self.generation)
+            deferred.addErrback(err)
+
+    def execute(self, batch):
+        cursor = self.writer.cursor()
+
+        for operation in batch:
+            if operation[0] == 'put':
+                cursor.execute('INSERT OR REPLACE INTO records (kind, id, data) VALUES (?, ?, ?)',
+                    (operation[1], operation[2], buffer(operation[3])))
+            elif operation[0] == 'del':
+                cursor.execute('DELETE FROM records WHERE kind = ? AND id = ?',
+                    (operation[1], operation[2]))
+            elif operation[0] == 'status':
+                row = cursor.execute('SELECT data FROM records WHERE kind = ? AND id = ?',
+                    (operation[1], operation[2])).fetchone()
+
+                if row is not None:
+                    data = mloads(str(row[0]))
+                    data['status'] = operation[3]
+
+                    cursor.execute('UPDATE records SET data = ? WHERE kind = ? AND id = ?',
+                        (buffer(mdumps(data)), operation[1], operation[2]))
+            elif operation[0] == 'set':
+                cursor.execute('INSERT OR REPLACE INTO blobs (prefix, id, name, value) VALUES (?, ?, ?, ?)',
+                    (operation[1], operation[2], operation[3], buffer(operation[4])))
+            elif operation[0] == 'unset':
+                cursor.execute('DELETE FROM blobs WHERE prefix = ? AND id = ? AND name = ?',
+                    (operation[1], operation[2], operation[3]))
+            elif operation[0] == 'next':
+                cursor.execute('INSERT OR REPLACE INTO counters (kind, next) VALUES (?, ?)',
+                    (operation[1], operation[2]))
+
+        # One transaction per batch
+        self.writer.commit()
+
+    def committed(self, result, generation):
+        for key, (value, current) in self.overlay.items():
+            if current <= generation:
+                del self.overlay[key]
+
+    def records(self, kind):
+        for row in self.reader.execute('SELECT data FROM records WHERE kind = ? ORDER BY rowid', (kind, )):
+            yield mloads(str(row[0]))
+
+    def counter(self, kind, next):
+        if next > self.counters.get(kind, 0):
+            self.counters[kind] = next
+            self.advanced.add(kind)
+
+    def next(self, kind):
+        """Id counter of kind, None if never written"""
+        row = self.reader.execute('SELECT next FROM counters WHERE kind = ?', (kind, )).fetchone()
+
+        if row is not None:
+            self.counters[kind] = max(self.counters.get(kind, 0), row[0])
+
+            # Success
+            return row[0]
+
+    def set(self, prefix, id, name, value):
+        value = mdumps(value)
+
+        self.overlay[(prefix, id, name)] = (value, self.generation + 1)
+        self.queue(('set', prefix, id, name, value))
+
+    def get(self, prefix, id, name):
+        key = (prefix, id, name)
+
+        if key in self.overlay:
+            value = self.overlay[key][0]
+
+            if value is self.deleted:
+                return None
+
+            return mloads(value)
+
+        row = self.reader.execute('SELECT value FROM blobs WHERE prefix = ? AND id = ? AND name = ?',
+            key).fetchone()
+
+        if row is not None:
+            return mloads(str(row[0]))
+
+        if self.legacy is not None:
+            return self.legacy.get(prefix, id, name)
+
+    def delete(self, prefix, id, name):
+        self.overlay[(prefix, id, name)] = (self.deleted, self.generation + 1)
+        self.queue(('unset', prefix, id, name))
+
+        if self.legacy is not None:
+            self.legacy.delete(prefix, id, name)
+
+    def fallback(self):
+        if self.legacy is None:
+            msg(self, 'fallback to files for old fields')
+
+            self.legacy = FilesStorage()
+
+    def journal(self, name):
+        return SQLiteJournal(self, name)
+
+    def start(self):
+        self._pool.start()
+
+    def stop(self):
+        if self._pool.started:
+            # Wait for batch in thread
+            self._pool.stop()
+
+    def close(self):
+        self.stop()
+
+        # Last batch, synchronous
+        self.flush()
+
+    def __str__(self):
+        return 'Storage-{0}'.format(self.name)
+
+
+def fsync(fd):
+    """Sync and close duplicate of descriptor, original may be closed meanwhile"""
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class BlobSegment(object):
+    """One append-only file of blob records, mapped once sealed"""
+
+    def __init__(self, path, number):
+        self.path = path
+        self.number = number
+
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.dead = 0
+
+        # Bytes of tombstones by (first, last) segment of values they hide
+        self.tombs = dict()
+
+        # Bytes already handed to kernel
+        self.written = self.size
+
+        self.writer = None
+        self.reader = None
+        self.map = None
+
+    def open(self):
+        self.writer = open(self.path, 'ab')
+
+    def write(self, data):
+        self.writer.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+            self.written = self.size
+
+    def fileno(self):
+        return (self.writer or self.reader).fileno()
+
+    def seal(self):
+        """Read only from now, reads go through memory map"""
+        self.flush()
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+        if self.reader is None:
+            self.reader = open(self.path, 'rb')
+
+        if self.size and self.map is None:
+            self.map = mmap.mmap(self.reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, offset, length):
+        if self.map is not None:
+            return self.map[offset:offset + length]
+
+        if offset + length > self.written:
+            self.flush()
+
+        if self.reader is None:
+            self.reader = open(self.path, 'rb')
+
+        self.reader.seek(offset)
+
+        return self.reader.read(length)
+
+    def close(self):
+        self.flush()
+
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+        for fp in (self.writer, self.reader):
+            if fp is not None:
+                fp.close()
+
+        self.writer = None
+        self.reader = None
+
+    def remove(self):
+        self.close()
+
+        try:
+            os.unlink(self.path)
+        except OSError:
+            err()
+
+
+class SegmentStorage(object):
+    """Fields appended to packed segment files, offsets of live values in memory
+
+    Record is header (kind, crc, key size, value size), marshaled key and
+    value. Delete appends tombstone with range of segments holding values
+    of key, index is rebuilt by scan on start. Segments with more dead
+    bytes than garbage ratio are compacted in background, live records
+    are copied into active segment, tombstones only while segments of
+    their range are left.
+    """
+
+    name = 'segments'
+    snapshots = True
+
+    header = Struct('!BIII')
+
+    PUT = 1
+    DELETE = 2
+
+    # Fields written before migration
+    legacy = None
+
+    def __init__(self, directory, size=67108864, garbage=0.5, interval=0.5, fsync=True):
+        self.directory = directory
+        self.size = size
+        self.garbage = garbage
+        self.interval = interval
+        self.fsync = fsync
+
+        # Key (prefix, id, name) to (segment, offset, size, first segment) of value
+        self.index = dict()
+        self.segments = dict()
+        self.active = None
+
+        self.compacting = None
+        self.compacted = 0
+
+        self._flushCall = None
+        self._syncing = None
+        self._resync = False
+
+        self.load()
+
+    def path(self, number):
+        return os.path.join(self.directory, '{0:08d}.seg'.format(number))
+
+    def load(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0777)
+            os.chmod(self.directory, 0777)
+
+        numbers = []
+
+        for name in os.listdir(self.directory):
+            if name.endswith('.seg'):
+                try:
+                    numbers.append(int(name[:-4]))
+                except ValueError:
+                    # Skip foreign files
+                    pass
+
+        for number in sorted(numbers):
+            segment = self.segments[number] = BlobSegment(self.path(number), number)
+            segment.seal()
+
+            end = self.scan(segment)
+
+            if end < segment.size:
+                msg(self, 'load', 'truncated', number, end)
+
+                # Tail was not fully written, drop it
+                segment.close()
+
+                with open(segment.path, 'r+b') as fp:
+                    fp.truncate(end)
+
+                segment.size = segment.written = end
+                segment.seal()
+
+            if not segment.size:
+                # Nothing in it, active segment of last start
+                del self.segments[number]
+
+                segment.remove()
+
+        if os.path.isdir(dbs()) and any(name.isdigit() for name in os.listdir(dbs())):
+            self.fallback()
+
+        self.rotate()
+
+    def records(self, segment):
+        """Yield (kind, key, offset of value, value size, end) of segment"""
+        data = segment.map
+        header = self.header
+
+        if data is None:
+            return
+
+        offset = 0
+        size = len(data)
+
+        while offset + header.size <= size:
+            kind, crc, keySize, valueSize = header.unpack_from(data, offset)
+
+            start = offset + header.size
+            end = start + keySize + valueSize
+
+            if kind not in (self.PUT, self.DELETE) or end > size or crc32(data[start:end]) & 0xffffffff != crc:
+                break
+
+            yield kind, mloads(data[start:start + keySize]), start + keySize, valueSize, end
+
+            offset = end
+
+    def scan(self, segment):
+        """Put records of segment into index, return end of last valid one"""
+        end = 0
+
+        for kind, key, offset, size, next in self.records(segment):
+            location = self.drop(key)
+
+            if kind == self.PUT:
+                self.index[key] = (segment.number, offset, size, location[3] if location is not None else segment.number)
+            else:
+                self.tomb(segment, self.span(segment, segment.map[offset:offset + size]), next - end)
+
+            end = next
+
+        # Success
+        return end
+
+    def drop(self, key):
+        """Forget value of key, whole record is dead"""
+        location = self.index.pop(key, None)
+
+        if location is not None and location[0] in self.segments:
+            self.segments[location[0]].dead += self.header.size + len(mdumps(key)) + location[2]
+
+        # Success
+        return location
+
+    def span(self, segment, value):
+        """Range of segments tombstone hides values in, any older for old ones"""
+        if value:
+            return mloads(value)
+
+        return (0, segment.number)
+
+    def needed(self, span, number):
+        """Tombstone in segment number still hides values"""
+        first, last = span
+
+        return any(first <= other <= last and other != number for other in self.segments)
+
+    def tomb(self, segment, span, size):
+        if self.needed(span, segment.number):
+            segment.tombs[span] = segment.tombs.get(span, 0) + size
+        else:
+            segment.dead += size
+
+    def settle(self):
+        """Tombstones of removed segments are dead"""
+        for segment in self.segments.itervalues():
+            for span in segment.tombs.keys():
+                if not self.needed(span, segment.number):
+                    segment.dead += segment.tombs.pop(span)
+
+    def append(self, kind, key, value=''):
+        data = mdumps(key)
+        body = data + value
+
+        segment = self.active
+        offset = segment.size + self.header.size + len(data)
+
+        segment.write(self.header.pack(kind, crc32(body) & 0xffffffff, len(data), len(value)) + body)
+
+        location = self.drop(key)
+
+        if kind == self.PUT:
+            self.index[key] = (segment.number, offset, len(value), location[3] if location is not None else segment.number)
+        else:
+            self.tomb(segment, self.span(segment, value), self.header.size + len(body))
+
+        if segment.size >= self.size:
+            self.rotate()
+        elif self._flushCall is None:
+            # Group commit
+            self._flushCall = reactor.callLater(self.interval, self.flush, False)
+
+    def rotate(self):
+        if self.active is not None:
+            self.active.seal()
+
+            if self.fsync:
+                self.sync(self.active).addErrback(err)
+
+        number = max(self.segments) + 1 if self.segments else 1
+
+        self.active = self.segments[number] = BlobSegment(self.path(number), number)
+        self.active.open()
+
+        self.compact()
+
+    def flush(self, wait=True):
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+
+            # Clean
+            self._flushCall = None
+
+        if self.active is not None:
+            self.active.flush()
+
+            if self.fsync:
+                if wait:
+                    os.fsync(self.active.fileno())
+                elif self._syncing is None:
+                    self._syncing = self.sync(self.active)
+                    self._syncing.addErrback(err)
+                    self._syncing.addBoth(self._synced)
+                else:
+                    # Fsync in thread may miss last writes
+                    self._resync = True
+
+        if not wait:
+            self.compact()
+
+    def sync(self, segment):
+        """Fsync of segment in thread, not on main-loop"""
+        return deferToThread(fsync, os.dup(segment.fileno()))
+
+    def _synced(self, result):
+        self._syncing = None
+
+        if self._resync:
+            self._resync = False
+
+            self.flush(False)
+
+    def compact(self):
+        if self.compacting is not None:
+            return
+
+        for number in sorted(self.segments):
+            segment = self.segments[number]
+
+            if segment is not self.active and segment.dead >= segment.size * self.garbage:
+                self.compacting = cooperate(self.copy(segment))
+                self.compacting.whenDone().addBoth(self._compacted)
+
+                break
+
+    def copy(self, segment):
+        """Move live records of segment to active one, step by step"""
+        targets = set()
+
+        for i, (kind, key, offset, size, end) in enumerate(self.records(segment)):
+            targets.add(self.active.number)
+
+            location = self.index.get(key)
+
+            if kind == self.PUT:
+                if location is not None and location[:3] == (segment.number, offset, size):
+                    self.append(kind, key, segment.map[offset:offset + size])
+            else:
+                span = self.span(segment, segment.map[offset:offset + size])
+
+                if not self.needed(span, segment.number):
+                    # Values it hides are gone
+                    pass
+                elif location is None:
+                    self.append(kind, key, mdumps(span))
+                elif span[0] < location[3]:
+                    # Put again later, next tombstone hides older values too
+                    self.index[key] = location[:3] + (span[0], )
+
+            if not i % 1000:
+                yield None
+
+        self.active.flush()
+
+        if self.fsync:
+            # Copies are on disk before segment is gone
+            yield (DeferredList(
+                [self.sync(self.segments[number]) for number in targets if number in self.segments],
+                fireOnOneErrback=True,
+                consumeErrors=True,
+            ))
+
+        del self.segments[segment.number]
+
+        segment.remove()
+
+        self.compacted += 1
+        self.settle()
+
+    def _compacted(self, result):
+        self.compacting = None
+
+        if isinstance(result, Failure) and not result.check(TaskStopped):
+            err(result)
+        elif not isinstance(result, Failure):
+            # Next one, if any
+            self.compact()
+
+    def set(self, prefix, id, name, value):
+        self.append(self.PUT, (prefix, id, name), mdumps(value))
+
+    def get(self, prefix, id, name):
+        location = self.index.get((prefix, id, name))
+
+        if location is not None:
+            number, offset, size, first = location
+
+            return mloads(self.segments[number].read(offset, size))
+
+        if self.legacy is not None:
+            return self.legacy.get(prefix, id, name)
+
+    def delete(self, prefix, id, name):
+        key = (prefix, id, name)
+        location = self.index.get(key)
+
+        if location is not None:
+            self.append(self.DELETE, key, mdumps((location[3], location[0])))
+
+        if self.legacy is not None:
+            self.legacy.delete(prefix, id, name)
+
+    def fallback(self):
+        if self.legacy is None:
+            msg(self, 'fallback to files for old fields')
+
+            self.legacy = FilesStorage()
+
+    def journal(self, name):
+        if config.getboolean('db', 'journal'):
+            return (Journal(
+                name,
+                interval=config.getfloat('db', 'journal-interval'),
+                fsync=config.getboolean('db', 'journal-fsync'),
+            ))
+
+    def stop(self):
+        if self.compacting is not None:
+            self.compacting.stop()
+            self.compacting = None
+
+        self.flush()
+
+    def close(self):
+        self.stop()
+
+        for segment in self.segments.itervalues():
+            segment.close()
+
+    def stats(self):
+        return (dict(
+            segments=len(self.segments),
+            keys=len(self.index),
+            size=sum(segment.size for segment in self.segments.itervalues()),
+            dead=sum(segment.dead for segment in self.segments.itervalues()),
+            compacted=self.compacted,
+        ))
+
+    def __str__(self):
+        return 'Storage-{0}'.format(self.name)
+
+
+class WriteBehindStorage(object):
+    """Fields of engine written in batches by thread, served from memory meanwhile
+
+    Not yet written bytes are limited, when over limit storage is full
+    and receivers should wait for drained.
+    """
+
+    deleted = object()
+
+    def __init__(self, engine, limit=33554432, interval=0.5, batch=5000):
+        self.engine = engine
+        self.limit = limit
+        self.interval = interval
+        self.size = batch
+
+        self.name = engine.name
+        self.snapshots = engine.snapshots
+
+        self.batch = []
+        self.generation = 0
+
+        # Id counters by kind, changed ones written with next batch
+        self.counters = dict()
+        self.advanced = set()
+
+        # Not yet written fields, served to readers
+        self.overlay = dict()
+
+        # Dirty bytes, in total and per generation
+        self.bytes = 0
+        self.sizes = dict()
+
+        self._waiting = []
+        self._flushCall = None
+
+        self._pool = ThreadPool(minthreads=1, maxthreads=1, name=str(self))
+
+    @property
+    def full(self):
+        return self.bytes >= self.limit
+
+    def drained(self):
+        """Deferred fired when storage is not full"""
+        if not self.full:
+            return succeed(None)
+
+        self._waiting.append(Deferred())
+
+        return self._waiting[-1]
+
+    def queue(self, operation, size):
+        self.batch.append(operation)
+
+        self.bytes += size
+        self.sizes[self.generation + 1] = self.sizes.get(self.generation + 1, 0) + size
+
+        if len(self.batch) >= self.size or self.full:
+            self.flush(False)
+        elif self._flushCall is None:
+            self._flushCall = reactor.callLater(self.interval, self.flush, False)
+
+    def flush(self, wait=True):
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+
+            # Clean
+            self._flushCall = None
+
+        if not self.batch:
+            return
+
+        batch, self.batch = self.batch, []
+        batch.extend(('next', kind, self.counters[kind]) for kind in self.advanced)
+
+        self.advanced.clear()
+        self.generation += 1
+
+        if wait or not self._pool.started:
+            self.execute(batch)
+            self.committed(None, self.generation)
+        else:
+            deferred = deferToThreadPool(reactor, self._pool, self.execute, batch)
+            deferred.addCallback(self.committed, self.generation)
+            deferred.addErrback(err)
+
+    def execute(self, batch):
+        for operation in batch:
+            if operation[0] == 'set':
+                self.engine.write(*operation[1:])
+            else:
+                self.engine.delete(*operation[1:])
+
+    def committed(self, result, generation):
+        for key, (value, current) in self.overlay.items():
+            if current <= generation:
+                del self.overlay[key]
+
+        for current in [current for current in self.sizes if current <= generation]:
+            self.bytes -= self.sizes.pop(current)
+
+        if not self.full:
+            waiting, self._waiting = self._waiting, []
+
+            for deferred in waiting:
+                deferred.callback(None)
+
+    def set(self, prefix, id, name, value):
+        value = mdumps(value)
+
+        self.overlay[(prefix, id, name)] = (value, self.generation + 1)
+        self.queue(('set', prefix, id, name, value), len(value))
+
+    def get(self, prefix, id, name):
+        key = (prefix, id, name)
+
+        if key in self.overlay:
+            value = self.overlay[key][0]
+
+            if value is self.deleted:
+                return None
+
+            return mloads(value)
+
+        return self.engine.get(prefix, id, name)
+
+    def delete(self, prefix, id, name):
+        self.overlay[(prefix, id, name)] = (self.deleted, self.generation + 1)
+        self.queue(('delete', prefix, id, name), 0)
+
+    def journal(self, name):
+        return self.engine.journal(name)
+
+    def start(self):
+        self._pool.start()
+
+    def stop(self):
+        if self._pool.started:
+            # Wait for batch in thread
+            self._pool.stop()
+
+    def close(self):
+        self.stop()
+
+        # Last batch, synchronous
+        self.flush()
+
+    def stats(self):
+        return (dict(
+            bytes=self.bytes,
+            limit=self.limit,
+            pending=len(self.overlay),
+            waiting=len(self._waiting),
+        ))
+
+    def __str__(self):
+        return 'Storage-{0}-write-behind'.format(self.name)
+
+
+def create():
+    engine = config.get('db', 'engine')
+
+    if engine == 'files':
+        if config.getboolean('db', 'write-behind'):
+            return (WriteBehindStorage(
+                FilesStorage(),
+                limit=config.getint('db', 'write-behind-size'),
+                interval=config.getfloat('db', 'engine-interval'),
+                batch=config.getint('db', 'engine-batch'),
+            ))
+
+        return FilesStorage()
+
+    if engine == 'sqlite':
+        return (SQLiteStorage(
+            dbs('storage.sqlite'),
+            interval=config.getfloat('db', 'engine-interval'),
+            limit=config.getint('db', 'engine-batch'),
+        ))
+
+    if engine == 'segments':
+        return (SegmentStorage(
+            dbs('blobs'),
+            size=config.getint('db', 'engine-segment-size'),
+            garbage=config.getfloat('db', 'engine-garbage'),
+            interval=config.getfloat('db', 'engine-interval'),
+            fsync=config.getboolean('db', 'engine-fsync'),
+        ))
+
+    raise RuntimeError('Unknown db engine {0}'.format(engine))
+
+
+storage = create()
+
+if isinstance(storage, SQLiteStorage):
+    reactor.addSystemEventTrigger('after', 'startup', storage.start)
+    reactor.addSystemEventTrigger('during', 'shutdown', storage.stop)
+
+if isinstance(storage, WriteBehindStorage):
+    reactor.addSystemEventTrigger('after', 'startup', storage.start)
+    reactor.addSystemEventTrigger('during', 'shutdown', storage.close)
+
+if isinstance(storage, SegmentStorage):
+    reactor.addSystemEventTrigger('during', 'shutdown', storage.stop)
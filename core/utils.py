@@ -19,6 +19,11 @@
 import os
 import sys
 
+from math import ceil
+from time import time
+from marshal import dumps as mdumps
+from collections import deque, OrderedDict
+
 from twisted.python.log import msg, err
 from twisted.internet.defer import Deferred
 from twisted.internet.task import cooperate
@@ -37,3 +42,135 @@ def sleep(timeout, result=None):
 		deferred.callback, result)
 
 	return deferred
+
+
+class Latencies:
+	"""Last size latencies in seconds, percentiles on demand"""
+
+	def __init__(self, size=1000, target=0):
+		self.values = deque(maxlen=size)
+		self.target = target
+
+		self.count = 0
+		self.late = 0
+
+	def add(self, value):
+		self.values.append(value)
+		self.count += 1
+
+		if self.target and value > self.target:
+			self.late += 1
+
+	def percentile(self, percent):
+		if not self.values:
+			return None
+
+		values = sorted(self.values)
+
+		# Nearest rank
+		return values[max(0, int(ceil(len(values) * percent / 100.0)) - 1)]
+
+	def stats(self):
+		return (dict(
+			p50=self.percentile(50),
+			p99=self.percentile(99),
+			target=self.target,
+			count=self.count,
+			late=self.late,
+		))
+
+
+class LRUCache:
+	"""Values up to size bytes, least recently used evicted first
+
+	Entries not used for life seconds are dropped when met, no timers.
+	"""
+
+	def __init__(self, size, life=0):
+		self.size = size
+		self.life = life
+
+		# Key to (value, bytes, expires), oldest first
+		self.entries = OrderedDict()
+		self.bytes = 0
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+
+	def sizeof(self, value):
+		if isinstance(value, (str, unicode)):
+			return len(value)
+
+		return len(mdumps(value))
+
+	def get(self, key, default=None):
+		entry = self.entries.pop(key, None)
+
+		if entry is None:
+			self.misses += 1
+
+			# Fail
+			return default
+
+		if entry[2] and entry[2] < time():
+			self.bytes -= entry[1]
+			self.expirations += 1
+			self.misses += 1
+
+			# Fail
+			return default
+
+		if self.life:
+			# Sliding life, like timer reset on hit
+			entry = (entry[0], entry[1], time() + self.life)
+
+		# Most recent again
+		self.entries[key] = entry
+		self.hits += 1
+
+		# Success
+		return entry[0]
+
+	def set(self, key, value):
+		size = self.sizeof(value)
+
+		self.delete(key)
+
+		if size > self.size:
+			# Never fits
+			return
+
+		self.entries[key] = (value, size, time() + self.life if self.life else 0)
+		self.bytes += size
+
+		while self.bytes > self.size:
+			key, entry = self.entries.popitem(last=False)
+
+			self.bytes -= entry[1]
+			self.evictions += 1
+
+	def delete(self, key):
+		entry = self.entries.pop(key, None)
+
+		if entry is not None:
+			self.bytes -= entry[1]
+
+	def clear(self):
+		self.entries.clear()
+		self.bytes = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def stats(self):
+		return (dict(
+			size=self.size,
+			bytes=self.bytes,
+			entries=len(self.entries),
+			hits=self.hits,
+			misses=self.misses,
+			evictions=self.evictions,
+			expirations=self.expirations,
+		))
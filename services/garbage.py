@@ -196,6 +196,12 @@ class GarbageService(Service):
 			# Fail
 			returnValue(None)
 
+		if tos.loading is not None:
+			# Message counters are not complete yet
+			msg(self.name, 'process messages', 'skip, queue is loading', system='-')
+
+			returnValue(None)
+
 		self._process += 1
 
 		# Try
@@ -42,7 +42,8 @@ from core.db import messages, tos, groups
 from core.dirs import tmp
 from core.constants import DEBUG, DEBUG_DUMPS, CHARSET, QUEUE_MAX_PRIORITY
 from core.constants import GROUP_STATUS_ACTIVE, GROUP_STATUS_INACTIVE, GROUP_STATUSES, GROUP_STATUSES_NAMES
-from core.mappers import Message, To, Group
+from core.mappers import Message, To, Group, bodies
+from core.storage import storage, WriteBehindStorage
 
 
 class ReceiverError(Exception):
@@ -112,6 +113,16 @@ class ReceiverProtocol(Int32StringReceiver):
         self.sequence += 1
         self.process(data)
 
+        if isinstance(storage, WriteBehindStorage) and storage.full:
+            # Fields are not written yet, stop reading until disk catches up
+            self.transport.pauseProducing()
+
+            storage.drained().addCallback(self._drained)
+
+    def _drained(self, result):
+        if self.connected:
+            self.transport.resumeProducing()
+
     def process(self, item):
         self.factory.service._workers += 1
 
@@ -205,6 +216,20 @@ class ReceiverProtocol(Int32StringReceiver):
             id=id,
         ))
 
+    def commands_stats(self, id, item):
+        sender = self.factory.service.parent.namedServices.get('Sender') if self.factory.service.parent else None
+
+        self.send(dict(
+            db=dict(((base.name, base.stats) for base in (messages, tos, groups))),
+            bodies=bodies.stats(),
+            receiver=dict(
+                listening=self.factory.service.listening,
+                storage=storage.stats() if isinstance(storage, WriteBehindStorage) else None,
+            ),
+            sender=sender.stats() if sender is not None else None,
+            id=id,
+        ))
+
     def commands_delete(self, id, item):
         itemType = None
         itemId = None
@@ -257,6 +282,10 @@ class ReceiverProtocol(Int32StringReceiver):
                     # Message has tos
                     raise ReceiverError('Message "{0}" has tos'.format(itemId))
 
+                if tos.loading is not None:
+                    # Counters are not complete yet
+                    raise ReceiverError('Message "{0}" may have tos, queue is loading'.format(itemId))
+
                 messages.delete(message.id)
             except ReceiverError, e:
                 if not itemForce:
@@ -286,15 +315,63 @@ class ReceiverProtocol(Int32StringReceiver):
             if 'status' in item['group'] and not item['group']['status'] in GROUP_STATUSES_NAMES:
                 raise ReceiverError('Value "group" must be contains valid "status" field, values {0}'.format(GROUP_STATUSES.values()))
 
+            if 'weight' in item['group']:
+                try:
+                    item['group']['weight'] = float(item['group']['weight'])
+                except (TypeError, ValueError):
+                    raise ReceiverError('Value "group" field "weight" must be number')
+
+                if not item['group']['weight'] > 0:
+                    raise ReceiverError('Value "group" field "weight" must be positive')
+
+            if item['group'].get('deadline'):
+                try:
+                    item['group']['deadline'] = int(item['group']['deadline'])
+                except (TypeError, ValueError):
+                    raise ReceiverError('Value "group" field "deadline" must be timestamp')
+
+            for key, name in (('rate', 'rate'), ('daily_quota', 'dailyQuota')):
+                if key in item['group']:
+                    try:
+                        item['group'][name] = (float if key == 'rate' else int)(item['group'].pop(key) or 0)
+                    except (TypeError, ValueError):
+                        raise ReceiverError('Value "group" field "{0}" must be number'.format(key))
+
+                    if item['group'][name] < 0:
+                        raise ReceiverError('Value "group" field "{0}" must not be negative'.format(key))
+
+            if 'start_at' in item['group']:
+                try:
+                    item['group']['startAt'] = int(item['group'].pop('start_at') or 0) or None
+                except (TypeError, ValueError):
+                    raise ReceiverError('Value "group" field "start_at" must be timestamp')
+
             # Check group
             group = groups.get(item['group']['id'])
             if group is None:
                 # Insert
                 group = Group.fromDict(dict(id=item['group'].pop('id'), **item['group']))
             else:
-                if 'status' in item['group']:
-                    # Update status
-                    groups.status(group.id, item['group']['status'])
+                if set(item['group']).intersection(('status', 'weight', 'deadline', 'startAt', 'rate', 'dailyQuota')):
+                    if 'status' in item['group']:
+                        # Update status
+                        groups.status(group.id, item['group']['status'])
+
+                    if 'weight' in item['group']:
+                        # Update share in sender
+                        groups.weight(group.id, item['group']['weight'])
+
+                    if 'deadline' in item['group']:
+                        # Not sent after
+                        groups.deadline(group.id, item['group']['deadline'] or None)
+
+                    if 'startAt' in item['group']:
+                        # Parked until
+                        groups.start(group.id, item['group']['startAt'])
+
+                    if 'rate' in item['group'] or 'dailyQuota' in item['group']:
+                        # Shape sending of group
+                        groups.limits(group.id, item['group'].get('rate', group.rate), item['group'].get('dailyQuota', group.dailyQuota))
                 else:
                     self.send(dict(
                         error='Group already "{0}" exists'.format(group.id),
@@ -304,6 +381,11 @@ class ReceiverProtocol(Int32StringReceiver):
             response['group'] = (dict(
                 id=groups.add(group),
                 status=group.status,
+                weight=group.weight,
+                deadline=group.deadline,
+                start_at=group.startAt,
+                rate=group.rate,
+                daily_quota=group.dailyQuota,
             ))
 
             self.send(response)
@@ -312,7 +394,7 @@ class ReceiverProtocol(Int32StringReceiver):
             itemGroup = map(int, itemGroup)
 
             self.send(dict(
-                groups=dict(((group.id, group.toDict()) for group in map(groups.get, itemGroup) if group)),
+                groups=dict(((group.id, dict(group.toDict(), queue=tos.laneStats(group.id))) for group in map(groups.get, itemGroup) if group)),
                 id=id,
             ))
         else:
@@ -379,6 +461,10 @@ class ReceiverProtocol(Int32StringReceiver):
     def commands_mail(self, id, item):
         itemType = item.get('type', 'single')
         itemGroup = int(item.get('group')) if (item.has_key('group') and item['group']) else None
+        itemClass = item.get('class') or 'bulk'
+
+        if not itemClass in ('bulk', 'transactional'):
+            raise ReceiverError('Value "class" must be "bulk" or "transactional"')
 
         response = (dict(
             counts = (dict(
@@ -423,6 +509,16 @@ class ReceiverProtocol(Int32StringReceiver):
                     # Clean
                     del to['delay']
 
+                if 'ttl' in to:
+                    if to['ttl']:
+                        to['deadline'] = int(reactor.seconds() + to['ttl'])
+
+                    # Clean
+                    del to['ttl']
+
+                if to.get('deadline'):
+                    to['deadline'] = int(to['deadline'])
+
             if not isinstance(item['message'], DictType):
                 raise ReceiverError('Value "message" must be dictonary type')
 
@@ -484,6 +580,11 @@ class ReceiverProtocol(Int32StringReceiver):
                 to = To.fromDict(dict(id=tos.id, **to))
                 to.message = messageId
 
+                if itemClass == 'transactional':
+                    # Own workers and connections, latency is tracked
+                    to.express = True
+                    to.queued = reactor.seconds()
+
                 if group is not None:
                     to.group = group.id
 
@@ -500,6 +601,8 @@ class ReceiverProtocol(Int32StringReceiver):
                     group.all += response['counts']['queued']
                     group.wait += response['counts']['queued']
 
+                    groups.changed(group)
+
                 # Update message
                 message.tos += response['counts']['queued']
 
@@ -534,6 +637,10 @@ class ReceiverService(Service):
         self._stopDeferred = None
         self._workers = 0
 
+        # Seconds from create to listen
+        self.listening = None
+        self._created = time()
+
         (Service.__init__(
             self,
             endpoint=serverFromString(reactor, listen),
@@ -560,6 +667,17 @@ class ReceiverService(Service):
 
         Service.startService(self)
 
+        if self._waitingForPort is not None:
+            self._waitingForPort.addCallback(self._listening)
+
+    def _listening(self, port):
+        if self.listening is None:
+            self.listening = time() - self._created
+
+            msg(self.name, 'listening after', '{0:.3f}'.format(self.listening), 'seconds')
+
+        return port
+
     def stopService(self):
         deferred = Deferred()
 
@@ -29,6 +29,7 @@ from time import strftime, time
 from uuid import uuid4
 from types import ListType, TupleType, UnicodeType, DictType, StringTypes
 from json import loads, dumps
+from marshal import dump as mdump, load as mload
 from collections import defaultdict
 from urlparse import urlparse, urlunparse
 
@@ -66,10 +67,13 @@ from twisted.web.iweb import UNKNOWN_LENGTH, IResponse
 from twisted.application.service import Service
 
 from core.db import messages, tos, groups
-from core.dirs import tmp
+from core.mappers import cache
+from core.dirs import tmp, dbs
 from core.constants import DEBUG, DEBUG_SENDER, CHARSET, VERSION_NAME, VERSION, USERAGENT
-from core.utils import sleep
+from core.utils import sleep, Latencies
 from core.configs import config
+from core.limits import DomainLimits, RateLimiter
+from core.retries import RetryPolicy
 from core.smtp import ESMTPSenderPool, SMTPClientError, ESMTPSenderPoolError, SMTPConnectError, SMTPProtocolError
 from core.http import Headers, HttpAgent, BufferProtocol, FileProtocol, ContentDecoderAgent, GzipDecoder, HTTPError
 
@@ -78,6 +82,14 @@ class SenderStopItem(Exception):
     """Stop item in process"""
 
 
+class SenderDropItem(Exception):
+    """Item can not be sent, do not retry"""
+
+
+class SenderExpiredItem(SenderDropItem):
+    """Item deadline passed"""
+
+
 class SenderService(Service):
 
     queueWorkers = config.getint('sender', 'workers')
@@ -96,6 +108,7 @@ class SenderService(Service):
         self.name = 'Sender'
         self.loop = -1
         self.queue = None
+        self.queueExpress = None
 
         # Inside
         self._stopCall = None
@@ -105,15 +118,75 @@ class SenderService(Service):
         self._process = 0
         self._fetcher = 0
 
+        # Retries in process
+        self._retrying = 0
+
+        # Transactional recipients in process and their workers
+        self._expressing = 0
+        self._workersExpress = 0
+
+        # Enqueue to sent of transactional recipients
+        self.latency = Latencies(target=config.getfloat('sender', 'express-target'))
+
+        # Global ceiling, without it workers pause for interval-next
+        self.limiter = None
+
+        if any(config.getfloat('sender', key) for key in ('rate', 'quota-hour', 'quota-day')):
+            self.limiter = (RateLimiter(
+                config.getfloat('sender', 'rate'),
+                config.getfloat('sender', 'rate-burst'),
+                reactor.seconds(),
+                hourly=config.getint('sender', 'quota-hour'),
+                daily=config.getint('sender', 'quota-day'),
+            ))
+
+            # Quotas are counted across restarts
+            self.loadLimiter()
+
+        self._limiterSaved = 0
+        self._limiterState = self.limiter.state() if self.limiter is not None else None
+
         self._state = 'stopped'
 
+        # Limits per recipient domain
+        self.domains = (DomainLimits(
+            config.domainLimits(),
+            rate=config.getfloat('sender', 'domain-rate'),
+            inflight=config.getint('sender', 'domain-inflight'),
+            codes=tuple(int(code) for code in config.get('sender', 'domain-backoff-codes').split()),
+            backoff=config.getfloat('sender', 'domain-backoff'),
+            probe=config.getfloat('sender', 'domain-probe'),
+            start=config.getfloat('sender', 'domain-backoff-rate'),
+            floor=config.getfloat('sender', 'domain-min-rate'),
+        ))
+
+        # Failed sends back later by error class
+        self.retries = (RetryPolicy(
+            dict(((kind, config.getint('sender', 'retry-{0}'.format(kind))) for kind in ('connect', 'defer', 'reject', 'error'))),
+            delay=config.getfloat('sender', 'retry-delay'),
+            factor=config.getfloat('sender', 'retry-factor'),
+            limit=config.getfloat('sender', 'retry-delay-max'),
+            age=config.getint('sender', 'retry-age'),
+        ))
+
         # Http pool
         self._pool = HttpAgent(reactor)
         self._httpPool = ContentDecoderAgent(self._pool, (('gzip', GzipDecoder), ))
 
-        # Smtp pool
-        self._smtpPool = (ESMTPSenderPool(
-            poolsize=config.getint('smtp', 'poolsize'),
+        # Smtp pool, parts of connections for retries and transactional only
+        poolsize = config.getint('smtp', 'poolsize')
+
+        # Reserves are taken out of poolsize, bulk keeps at least one
+        poolsizeExpress = max(0, min(config.getint('sender', 'express-connections'), poolsize - 1))
+        poolsizeRetry = max(0, min(int(poolsize * self.retryShare), poolsize - 1 - poolsizeExpress))
+
+        self._smtpPool = self.smtpPool(max(1, poolsize - poolsizeRetry - poolsizeExpress))
+        self._smtpPoolRetry = self.smtpPool(poolsizeRetry) if poolsizeRetry else self._smtpPool
+        self._smtpPoolExpress = self.smtpPool(poolsizeExpress) if poolsizeExpress else self._smtpPool
+
+    def smtpPool(self, poolsize):
+        return (ESMTPSenderPool(
+            poolsize=poolsize,
             username=config.get('smtp', 'username'),
             password=config.get('smtp', 'password'),
             hostname=config.get('smtp', 'hostname'),
@@ -170,6 +243,9 @@ class SenderService(Service):
         if self.queue is None:
             self.queue = DeferredQueue()
 
+        if self.queueExpress is None:
+            self.queueExpress = DeferredQueue()
+
         # Start generator
         cooperate(self.queueGenerator())
 
@@ -202,9 +278,14 @@ class SenderService(Service):
         # Close smtp
         self._smtpPool.closeConnections()
 
+        for pool in (self._smtpPoolRetry, self._smtpPoolExpress):
+            if pool is not self._smtpPool:
+                pool.closeConnections()
+
         def s1(code, self=self):
             (msg(self.name,
                 'alive workers', self._workers,
+                'alive express workers', self._workersExpress,
                 'alive process', self._process,
                 'alive fetcher', self._fetcher,
             ))
@@ -214,7 +295,11 @@ class SenderService(Service):
                 for _ in xrange(1, self._workers + 1):
                     self.queue.put(self.queueStop)
 
-            if (self._process + self._workers + self._fetcher) > 0:
+            if self._workersExpress > 0:
+                for _ in xrange(1, self._workersExpress + 1):
+                    self.queueExpress.put(self.queueStop)
+
+            if (self._process + self._workers + self._workersExpress + self._fetcher) > 0:
                 # Fail, wait...
                 self._stopCall = callLater(1, s1, 0)
             else:
@@ -229,7 +314,7 @@ class SenderService(Service):
                     # Cancel stop
                     return
 
-                if not (self._state == 'stopping' and (self._process + self._workers) == 0):
+                if not (self._state == 'stopping' and (self._process + self._workers + self._workersExpress) == 0):
                     err(RuntimeError('{0} stop error: state-{1} p{2} w{3}'.format(
                         self.name,
                         self._state,
@@ -240,10 +325,14 @@ class SenderService(Service):
                 self._stopCall = None
                 self._stopDeferred = None
 
+                if self.limiter is not None and self.limiter.quotas:
+                    self.saveLimiter()
+
                 # Inside
                 Service.stopService(self)
 
                 self.queue = None
+                self.queueExpress = None
                 self._state = 'stopped'
 
                 # Show info
@@ -256,6 +345,17 @@ class SenderService(Service):
     senderIntervalEmpty = config.getfloat('sender', 'interval-empty')
     senderIntervalNext = config.getfloat('sender', 'interval-next')
 
+    domainHold = config.getint('sender', 'domain-hold')
+    domainScan = config.getint('sender', 'domain-scan')
+
+    # Part of workers and smtp connections reserved for retries
+    retryShare = config.getfloat('sender', 'retry-share')
+    retryWorkers = int(queueWorkers * retryShare)
+
+    # Own workers of transactional recipients, do not wait for bulk
+    expressWorkers = config.getint('sender', 'express-workers')
+    expressInterval = config.getfloat('sender', 'express-interval')
+
     def queueGenerator(self):
         self._fetcher += 1
 
@@ -269,29 +369,46 @@ class SenderService(Service):
                     for i in xrange(self._workers + 1, self.queueWorkers + 1):
                         yield cooperate(self.queueWorker(i))
 
+                    for i in xrange(self._workersExpress + 1, self.expressWorkers + 1):
+                        yield cooperate(self.queueWorker(i, True))
+
                     @inlineCallbacks
                     def _c(timeout=1, self=self):
                         if self.isStarted:
                             # Check after
                             tos.checkAfter()
 
-                        row = tos.pop()
+                        row = self.dispatch()
                         row = row if row else None
 
                         if not row:
+                            timeout = self.senderIntervalEmpty
+
+                            if tos.held:
+                                # Wait for throttled domains only
+                                timeout = min(timeout, max(0.01, self.domains.delay(tos.held, reactor.seconds()) or 0.1))
+
+                            if tos.capped:
+                                # Wait for groups over rate or quota
+                                timeout = min(timeout, max(0.01, tos.cappedDelay(reactor.seconds())))
+
+                            if self.expressWorkers and self.expressInterval:
+                                # Transactional may come any moment
+                                timeout = min(timeout, self.expressInterval)
+
                             if DEBUG:
-                                msg(self.name, 'empty queue, wait', self.senderIntervalEmpty, 'seconds', system='-')
+                                msg(self.name, 'empty queue, wait', timeout, 'seconds', system='-')
 
                             # Sleep
-                            yield sleep(self.senderIntervalEmpty)
+                            yield sleep(timeout)
                         else:
                             # rowId = row.id
                             rowGroup = None
+                            rowDomain = None
+                            rowRetrying = False
+                            rowExpress = False
 
                             try:
-                                row.priority = 0
-                                row.retries -= 1
-
                                 if row.group:
                                     rowGroup = groups.get(row.group)
 
@@ -299,26 +416,43 @@ class SenderService(Service):
                                     rowGroup.sending += 1
                                     rowGroup.wait -= 1
 
+                                # Domain slot is taken until item is processed
+                                rowDomain = row.domain
+
+                                self.domains.acquire(rowDomain, reactor.seconds())
+
+                                if row.attempts:
+                                    rowRetrying = True
+
+                                    self._retrying += 1
+                                elif row.express and self.expressWorkers:
+                                    rowExpress = True
+
+                                    self._expressing += 1
+
                                 # Add to queue
-                                self.queuePut(row)
+                                self.queuePut(row, rowExpress)
                             except Exception, e:
                                 traceback = sys.exc_info()[2]
 
                                 if not traceback:
                                     traceback = None
 
-                                if row.retries > 0:
-                                    # Fallback
-                                    tos.add(row)
+                                if rowDomain is not None:
+                                    self.domains.release(rowDomain)
 
-                                    if rowGroup:
-                                        rowGroup.sending -= 1
-                                        rowGroup.wait += 1
-                                elif rowGroup:
-                                    rowGroup.errors += 1
+                                if rowRetrying:
+                                    self._retrying -= 1
 
-                                    # Clean
-                                    row.delete()
+                                if rowExpress:
+                                    self._expressing -= 1
+
+                                # Fallback, was not sent
+                                tos.add(row)
+
+                                if rowGroup:
+                                    rowGroup.sending -= 1
+                                    rowGroup.wait += 1
 
                                 # Throw
                                 raise e, None, traceback
@@ -329,7 +463,7 @@ class SenderService(Service):
                         # Wait if error
                         return self.sleepOneWithFireOnServiceStop(2)
 
-                    if (self._process < self.queueWorkers) and (len(self.queue.pending) < self.queueWorkers):
+                    if self.queueFree() or self.expressFree():
                         if self.isStarted:
                             yield _c().addErrback(_e)
                     else:
@@ -343,29 +477,175 @@ class SenderService(Service):
         finally:
             self._fetcher -= 1
 
-    def queuePut(self, item):
-        self.queue.put(item)
+    def stats(self):
+        return (dict(
+            workers=self._workers,
+            process=self._process,
+            retrying=self._retrying,
+            retryWorkers=self.retryWorkers,
+            limiter=self.limiter.stats() if self.limiter is not None else None,
+            express=(dict(
+                workers=self._workersExpress,
+                process=self._expressing,
+                latency=self.latency.stats(),
+            )),
+            queue=tos.depth(),
+            domains=self.domains.stats(),
+            failed=self.retries.stats(),
+            cache=cache.stats(),
+        ))
+
+    def retryKind(self, e):
+        if isinstance(e, SenderDropItem):
+            return 'drop'
+
+        if isinstance(e, (ESMTPSenderPoolError, SMTPConnectError, SMTPProtocolError, ConnectError, ConnectionClosed)):
+            return 'connect'
+
+        if isinstance(e, SMTPClientError) and e.code:
+            return 'defer' if e.code < 500 else 'reject'
+
+        # Other
+        return 'error'
+
+    def queueFree(self):
+        return (self._process - self._expressing < self.queueWorkers) and (len(self.queue.pending) < self.queueWorkers)
+
+    def expressFree(self):
+        return self._expressing < self.expressWorkers and tos.waiting('express')
 
-    def queueWorker(self, number):
-        self._workers += 1
+    def dispatch(self):
+        """Next recipient allowed by domain limits, others are held in queue"""
+        current = reactor.seconds()
+
+        if self.expressFree():
+            row = tos.pop('express')
+
+            if row is not None:
+                # Own workers, domain limits are counted but not waited for
+                return row
+
+        if not self.queueFree():
+            # Bulk workers busy
+            return None
+
+        # Held recipients first, domain may be open again
+        for domain in tos.held.keys():
+            if self.domains.allowed(domain, current):
+                row = tos.release(domain)
+
+                if row is not None:
+                    return row
+
+        if self._retrying < self.retryWorkers:
+            # Reserved workers first
+            order = ('retry', 'ready')
+        elif self.retryWorkers:
+            order = ('ready', )
+        else:
+            # No reserve, retries only when nothing else
+            order = ('ready', 'retry')
+
+        if not self.expressWorkers:
+            # No own workers, transactional ahead of bulk
+            order = ('express', ) + order
+
+        for kind in order:
+            for i in xrange(self.domainScan):
+                row = tos.pop(kind)
+
+                if row is None:
+                    break
+
+                if self.domains.allowed(row.domain, current):
+                    return row
+
+                if tos.heldSize < self.domainHold:
+                    tos.hold(row)
+                else:
+                    # Hold is full, other domains go on
+                    tos.back(row)
+
+    def queuePut(self, item, express=False):
+        (self.queueExpress if express else self.queue).put(item)
+
+    def queueWorker(self, number, express=False):
+        queue = self.queueExpress if express else self.queue
+
+        if express:
+            self._workersExpress += 1
+        else:
+            self._workers += 1
 
         # Try
         try:
             msg(self.name, 'start queueWorker #%02d' % (
-                number), system='-')
+                number), 'express' if express else '', system='-')
 
-            while self.isStarted or self.queue.pending:
-                deferred = self.queue.get()
+            while self.isStarted or queue.pending:
+                deferred = queue.get()
+                deferred.addCallback(self.queueToken, express)
                 deferred.addCallback(self.queueProcess)
 
                 # Wait for next item
                 yield deferred.addErrback(err)
-                yield sleep(self.senderIntervalNext)
+
+                if self.limiter is None and not express:
+                    yield sleep(self.senderIntervalNext)
 
             msg(self.name, 'stops queueWorker #%02d' % (
-                number), system='-')
+                number), 'express' if express else '', system='-')
         finally:
-            self._workers -= 1
+            if express:
+                self._workersExpress -= 1
+            else:
+                self._workers -= 1
+
+    @inlineCallbacks
+    def queueToken(self, item, express=False):
+        """Wait for token of global limiter, transactional take it in debt"""
+        if self.limiter is not None and item is not self.queueStop:
+            if express:
+                self.limiter.take(reactor.seconds(), True)
+            else:
+                while self.isStarted and not self.limiter.take(reactor.seconds()):
+                    yield sleep(min(1.0, max(0.01, self.limiter.delay(reactor.seconds()))))
+
+            if self.limiter.quotas and reactor.seconds() - self._limiterSaved >= 1:
+                self.saveLimiter()
+
+        # Success
+        returnValue(item)
+
+    limiterFile = dbs('limiter.db')
+
+    def loadLimiter(self):
+        if not os.path.exists(self.limiterFile):
+            return
+
+        try:
+            with open(self.limiterFile, 'rb') as fp:
+                self.limiter.restore(mload(fp))
+        except (IOError, EOFError, ValueError, TypeError):
+            err()
+
+    def saveLimiter(self):
+        """Write windows and counts of quotas, if changed since last write"""
+        state = self.limiter.state()
+
+        if state == self._limiterState:
+            return
+
+        self._limiterState = state
+        self._limiterSaved = reactor.seconds()
+
+        temp = '{0}.tmp'.format(self.limiterFile)
+
+        # Save, few bytes
+        with open(temp, 'wb') as fp:
+            mdump(state, fp)
+
+        os.rename(temp, self.limiterFile)
 
     charsetMessage = 'UTF-8'
     charsetIn = 'utf8'
@@ -384,12 +664,15 @@ class SenderService(Service):
 
         self._process += 1
 
+        itemRetrying = item.attempts > 0
+        itemExpress = item.express and not itemRetrying and self.expressWorkers > 0
+
         # Try
         try:
             if DEBUG:
                 # Debug
                 (msg(self.name,
-                    'queueProcess item', item.id, 'start, retries', item.retries, system='-'))
+                    'queueProcess item', item.id, 'start, attempts', item.attempts, system='-'))
             else:
                 (msg(self.name,
                     'queueProcess item', item.id, 'start', system='-'))
@@ -400,11 +683,7 @@ class SenderService(Service):
                 itemGroup = None
 
                 if not itemMessage:
-                    # Clean
-                    item.priority = 0
-                    item.retries = 0
-
-                    raise RuntimeError('Message for item not found {0}'.format(item.message))
+                    raise SenderDropItem('Message for item not found {0}'.format(item.message))
 
                 if item.group:
                     # Fetch group
@@ -414,6 +693,12 @@ class SenderService(Service):
                     # Stop
                     raise SenderStopItem()
 
+                itemDeadline = item.deadline or (itemGroup.deadline if itemGroup else None)
+
+                if itemDeadline and itemDeadline < reactor.seconds():
+                    # Too late, do not render
+                    raise SenderExpiredItem('Deadline passed {0}'.format(itemDeadline))
+
                 # Data mail
                 id = str(uuid4())
                 current = dict()
@@ -557,7 +842,14 @@ class SenderService(Service):
                 if DEBUG_SENDER:
                     deferred = succeed(('DEBUG OK', (current['tEmail'], )))
                 else:
-                    deferred = (self._smtpPool.sendMail(
+                    if itemExpress:
+                        pool = self._smtpPoolExpress
+                    elif itemRetrying:
+                        pool = self._smtpPoolRetry
+                    else:
+                        pool = self._smtpPool
+
+                    deferred = (pool.sendMail(
                         sender=current['fEmail'],
                         to=current['tEmail'],
                         file=file
@@ -569,16 +861,26 @@ class SenderService(Service):
 
                 result = ((yield deferred))
 
+                # Domain accepts, speed up if backed off
+                self.domains.response(item.domain, None, reactor.seconds())
+
+                if itemExpress and item.queued is not None:
+                    self.latency.add(reactor.seconds() - item.queued)
+
                 if itemGroup:
                     itemGroup.sending -= 1
                     itemGroup.sent += 1
 
+                    groups.changed(itemGroup)
+
                 itemMessage.tos -= 1
 
                 try:
                     # Clean
                     item.delete()
 
+                    tos.done(item)
+
                     # Debug
                     (msg(self.name,
                         'queueProcess item', item.id, 'sent', repr(result), system='-'))
@@ -586,13 +888,26 @@ class SenderService(Service):
                     err()
             except Exception, e:
                 itemStopped = isinstance(e, SenderStopItem)
-                itemRetry = itemStopped or item.retries > 0 or isinstance(e, (ESMTPSenderPoolError,
-                    SMTPConnectError, SMTPProtocolError, ConnectError, ConnectionClosed))
 
                 # Show error if not stopped
-                if not itemStopped and not isinstance(e, SMTPClientError):
+                if not itemStopped and not isinstance(e, (SMTPClientError, SenderDropItem)):
                     err()
 
+                if isinstance(e, SMTPClientError) and e.code:
+                    # Slow down domain on deferral
+                    self.domains.response(item.domain, e.code, reactor.seconds())
+
+                if itemStopped:
+                    # Not attempted, back as is
+                    itemRetry = True
+                elif isinstance(e, SenderExpiredItem):
+                    # Not attempted, counted as expired only
+                    itemRetry = False
+                else:
+                    # Later, in delayed queue
+                    itemRetry = self.retries.schedule(item, self.retryKind(e), reactor.seconds(),
+                        item.deadline or (itemGroup.deadline if itemGroup else None))
+
                 if itemRetry:
                     # Fallback
                     tos.add(item)
@@ -604,12 +919,22 @@ class SenderService(Service):
                     # Clean
                     item.delete()
 
+                    tos.done(item)
+
                     if itemMessage:
                         itemMessage.tos -= 1
 
                     if itemGroup:
                         itemGroup.sending -= 1
-                        itemGroup.errors += 1
+
+                        if isinstance(e, SenderExpiredItem):
+                            itemGroup.expired += 1
+                        else:
+                            itemGroup.errors += 1
+
+                        groups.changed(itemGroup)
+                    elif isinstance(e, SenderExpiredItem):
+                        tos.stats['expired'] += 1
 
                 # Debug
                 (msg(self.name,
@@ -617,6 +942,15 @@ class SenderService(Service):
         finally:
             self._process -= 1
 
+            if itemRetrying:
+                self._retrying -= 1
+
+            if itemExpress:
+                self._expressing -= 1
+
+            # Free domain slot
+            self.domains.release(item.domain)
+
     @inlineCallbacks
     def multipartRoot(self, id, text, html):
         if DEBUG:
@@ -0,0 +1,73 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+# Usage: python tests/bench_queues.py [items]
+
+import sys
+import os
+import random
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from heapq import heappush, heappop
+from time import time
+
+from core.constants import QUEUE_MAX_PRIORITY
+from core.queues import BucketQueue
+from core.mappers import To
+
+
+def heap(items):
+	data = []
+
+	for priority, to in items:
+		heappush(data, (priority, to))
+
+	while data:
+		heappop(data)
+
+
+def buckets(items):
+	data = BucketQueue(QUEUE_MAX_PRIORITY + 1)
+
+	for priority, to in items:
+		data.append(priority - 1, to)
+
+	while data:
+		data.popleft(data.first())
+
+
+def main(size):
+	random.seed(size)
+
+	items = [(random.randint(1, QUEUE_MAX_PRIORITY), To(id=id, email='{0}@localhost'.format(id), time=1))
+		for id in xrange(size)]
+
+	for name, function in (('heap', heap), ('buckets', buckets)):
+		mark = time()
+
+		function(items)
+
+		elapsed = time() - mark
+
+		print '{0:10} {1} items {2:.3f} seconds {3:.0f} items/second'.format(name, size, elapsed, size / elapsed)
+
+
+if __name__ == '__main__':
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,413 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '../'))
+
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.internet.task import Clock
+
+from core import db
+from core.constants import GROUP_STATUS_ACTIVE, GROUP_STATUS_PAUSED
+from core.mappers import Group, To
+from core.queues import SpoolQueue
+from core.storage import SQLiteStorage
+
+# Trial fires shutdown, keep snapshots of module instances out of dbs
+directory = mkdtemp()
+
+for base in (db.messages, db.tos, db.groups):
+	base.file = os.path.join(directory, '{0}.db'.format(base.name))
+
+
+class TosTest(SynchronousTestCase):
+
+	def setUp(self):
+		self.directory = self.mktemp()
+		os.makedirs(self.directory)
+
+		# Noon of some UTC day
+		self.clock = Clock()
+		self.clock.advance(86400 * 20000 + 43200)
+
+		self.patch(db, 'reactor', self.clock)
+		self.patch(SpoolQueue, 'directory', os.path.join(self.directory, 'spool'))
+
+		self.patch(db, 'messages', db.Messages())
+		self.patch(db, 'groups', db.Groups())
+
+		self.tos = self.create()
+
+		self.patch(db, 'tos', self.tos)
+
+	def create(self, journal=None):
+		tos = db.Tos()
+		tos.file = os.path.join(self.directory, 'tos.db')
+		tos.journal = journal
+
+		return tos
+
+	def to(self, id, **params):
+		return To.fromDict(dict(id=id, email='{0}@localhost'.format(id), **params))
+
+	def group(self, id, **params):
+		db.groups.add(Group(id=id, **params))
+
+	def pops(self, kind='ready'):
+		result = []
+
+		while True:
+			to = self.tos.pop(kind)
+
+			if to is None:
+				return result
+
+			result.append(to.id)
+
+	def test_migrate_01(self):
+		self.tos.add(self.to(1))
+		self.tos.add(self.to(2, after=self.clock.seconds() + 3600))
+		self.tos.save()
+
+		storage = SQLiteStorage(os.path.join(self.directory, 'storage.sqlite'))
+
+		self.patch(db, 'storage', storage)
+
+		tos = self.create(storage.journal('tos'))
+		tos.load()
+
+		storage.flush()
+
+		self.assertEquals(sorted(to['id'] for to in storage.records('tos')), [1, 2])
+		self.assertEquals(len(tos.wheel), 1)
+
+	def test_flight_01(self):
+		self.tos.add(self.to(1))
+
+		to = self.tos.pop()
+
+		# Handed to sender, still saved
+		self.tos.save()
+
+		tos = self.create()
+		tos.load()
+
+		self.assertEquals([to.id for to in tos.iterate()], [1])
+
+		self.tos.done(to)
+		self.tos.save()
+
+		tos = self.create()
+		tos.load()
+
+		self.assertEquals(list(tos.iterate()), [])
+
+	def test_drr_01(self):
+		self.group(1, weight=2)
+		self.group(2)
+
+		for id in xrange(1, 7):
+			self.tos.add(self.to(id, group=1))
+
+		for id in xrange(11, 14):
+			self.tos.add(self.to(id, group=2))
+
+		# Two of heavier group per one of other
+		self.assertEquals(self.pops(), [1, 2, 11, 3, 4, 12, 5, 6, 13])
+
+	def test_drr_02(self):
+		self.group(1)
+		self.group(2)
+
+		for id in (1, 2, 11, 12):
+			self.tos.add(self.to(id, group=1 if id < 10 else 2))
+
+		self.assertEquals(self.tos.pop().id, 1)
+
+		db.groups.status(1, GROUP_STATUS_PAUSED)
+
+		self.tos.add(self.to(3, group=1))
+
+		# Paused lane is dropped from rings
+		self.assertEquals(self.pops(), [11, 12])
+		self.assertFalse(self.tos.waiting('ready'))
+
+		db.groups.status(1, GROUP_STATUS_ACTIVE)
+
+		# Listed again on resume
+		self.assertTrue(self.tos.waiting('ready'))
+		self.assertEquals(self.pops(), [2, 3])
+
+	def test_drr_03(self):
+		self.group(1, weight=0.5)
+		self.group(2)
+
+		for id in (1, 2, 11, 12):
+			self.tos.add(self.to(id, group=1 if id < 10 else 2))
+
+		# Weight below one is served every other round
+		self.assertEquals(self.pops(), [11, 1, 12, 2])
+
+	def test_capped_01(self):
+		self.group(1, rate=1)
+
+		for id in xrange(1, 5):
+			self.tos.add(self.to(id, group=1))
+
+		lane = self.tos.data[1]
+
+		# Over rate, parked until next token
+		self.assertEquals(self.pops(), [1])
+		self.assertEquals(lane.capped, self.clock.seconds() + 1)
+		self.assertTrue(lane.parked)
+
+		self.clock.advance(1)
+		self.tos.checkAfter()
+
+		self.assertFalse(lane.parked)
+		self.assertEquals(self.pops(), [2])
+
+		# Without limits listed again at once
+		db.groups.limits(1, 0, 0)
+
+		self.assertEquals(lane.capped, None)
+		self.assertEquals(self.pops(), [3, 4])
+
+	def test_quota_01(self):
+		self.group(1, dailyQuota=2)
+
+		for id in xrange(1, 5):
+			self.tos.add(self.to(id, group=1))
+
+		group = db.groups.get(1)
+		day = int(self.clock.seconds() // 86400)
+
+		self.assertEquals(self.pops(), [1, 2])
+		self.assertEquals(group.dailySent, 2)
+		self.assertEquals(self.tos.data[1].capped, (day + 1) * 86400)
+
+		# Still same UTC day
+		self.clock.advance(43199)
+		self.tos.checkAfter()
+
+		self.assertEquals(self.pops(), [])
+
+		self.clock.advance(1)
+		self.tos.checkAfter()
+
+		self.assertEquals(self.pops(), [3, 4])
+		self.assertEquals(group.day, day + 1)
+		self.assertEquals(group.dailySent, 2)
+
+	def test_start_01(self):
+		self.group(1)
+
+		start = self.clock.seconds() + 60
+
+		# No lane yet, lane is created with start of group
+		db.groups.start(1, start)
+
+		self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+		self.assertEquals(self.tos.data[1].start, start)
+
+		self.tos.add(self.to(1, group=1))
+
+		self.assertEquals(self.pops(), [])
+
+		# Moved, one timer still
+		db.groups.start(1, start + 60)
+
+		self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+
+		self.clock.advance(60)
+
+		self.assertEquals(self.pops(), [])
+
+		self.clock.advance(60)
+
+		self.assertEquals(self.tos.starts, {})
+		self.assertEquals(self.tos.data[1].start, None)
+		self.assertEquals(self.pops(), [1])
+
+	def test_start_02(self):
+		self.group(1)
+		self.tos.add(self.to(1, group=1))
+
+		db.groups.start(1, self.clock.seconds() + 60)
+
+		self.assertEquals(self.pops(), [])
+
+		# Started now, released at once
+		db.groups.start(1, None)
+
+		self.assertEquals(self.clock.getDelayedCalls(), [])
+		self.assertEquals(self.pops(), [1])
+
+	def test_hold_01(self):
+		self.group(1, dailyQuota=1)
+
+		for id in (1, 2, 3):
+			self.tos.add(self.to(id, group=1))
+
+		group = db.groups.get(1)
+
+		# Held recipient does not count in quota
+		self.tos.hold(self.tos.pop())
+
+		self.assertEquals(group.dailySent, 0)
+		self.assertEquals(self.tos.pop().id, 2)
+		self.assertEquals(group.dailySent, 1)
+
+		# Charged on release, over quota back to lane
+		self.assertEquals(self.tos.release('localhost'), None)
+		self.assertEquals(self.tos.heldSize, 0)
+		self.assertEquals(group.dailySent, 1)
+
+		self.clock.advance(43200)
+		self.tos.checkAfter()
+
+		self.assertEquals(self.pops(), [3])
+
+	def test_back_01(self):
+		for id in (1, 2):
+			self.tos.add(self.to(id))
+
+		self.tos.back(self.tos.pop())
+
+		self.assertEquals(self.tos.flight, {})
+		self.assertEquals(self.tos.data[0].dispatched, 0)
+		self.assertEquals(self.pops(), [2, 1])
+
+	def test_counter_01(self):
+		file = os.path.join(self.directory, 'storage.sqlite')
+		storage = SQLiteStorage(file)
+
+		self.patch(db, 'storage', storage)
+
+		tos = self.create(storage.journal('tos'))
+		tos.load()
+
+		self.assertEquals(tos.add(To.fromDict(dict(email='a@localhost'))), 1)
+
+		tos.done(tos.pop())
+		storage.close()
+
+		# Restart, last id is not given again
+		storage = SQLiteStorage(file)
+
+		self.patch(db, 'storage', storage)
+
+		tos = self.create(storage.journal('tos'))
+		tos.load()
+
+		self.assertEquals(list(tos.iterate()), [])
+		self.assertEquals(tos.add(To.fromDict(dict(email='b@localhost'))), 2)
+
+		storage.close()
+
+	def test_edf_01(self):
+		current = self.clock.seconds()
+
+		self.group(1, deadline=current + 100)
+		self.group(2)
+		self.group(3, deadline=current + 50)
+
+		self.tos.add(self.to(1, group=1, deadline=current + 200))
+		self.tos.add(self.to(2, group=1))
+		self.tos.add(self.to(3, group=1))
+		self.tos.add(self.to(11, group=2))
+		self.tos.add(self.to(12, group=2, deadline=current + 150))
+		self.tos.add(self.to(21, group=3))
+
+		# Earliest deadline first across groups, own or of group
+		self.assertEquals(self.pops(), [21, 2, 3, 12, 1, 11])
+
+	def test_edf_02(self):
+		current = self.clock.seconds()
+
+		self.group(1)
+		self.group(2)
+
+		for id in (1, 2, 11, 12):
+			self.tos.add(self.to(id, group=1 if id < 10 else 2))
+
+		db.groups.deadline(2, current + 60)
+
+		self.assertEquals(self.pops(), [11, 12, 1, 2])
+		self.assertEquals(self.tos.urgent.values(), [[]])
+
+	def test_counters_01(self):
+		storage = SQLiteStorage(os.path.join(self.directory, 'storage.sqlite'))
+
+		self.patch(db, 'storage', storage)
+
+		groups = db.Groups()
+		groups.file = os.path.join(self.directory, 'groups.db')
+		groups.journal = storage.journal('groups')
+
+		self.patch(db, 'groups', groups)
+
+		self.group(1, dailyQuota=5)
+
+		for id in (1, 2):
+			self.tos.add(self.to(id, group=1))
+
+		self.assertEquals(self.pops(), [1, 2])
+
+		groups.get(1).sent += 1
+		groups.changed(groups.get(1))
+
+		storage.flush()
+
+		# Crash, counters are in journal
+		loaded = db.Groups()
+		loaded.file = groups.file
+		loaded.journal = storage.journal('groups')
+		loaded.load()
+
+		self.assertEquals(loaded.get(1).dailySent, 2)
+		self.assertEquals(loaded.get(1).sent, 1)
+
+	def test_records_01(self):
+		self.tos.format = 'records'
+		self.tos.add(self.to(1))
+		self.tos.save()
+
+		files = []
+
+		def tracked(*args):
+			files.append(open(*args))
+
+			return files[-1]
+
+		db.open = tracked
+
+		self.addCleanup(delattr, db, 'open')
+
+		next, rows = self.tos.read()
+
+		self.assertEquals([row['id'] for row in rows], [1])
+		self.assertTrue(files[0].closed)
+
+
+testCases = [TosTest]
@@ -0,0 +1,74 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '../'))
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from core.journal import Journal
+
+
+class JournalTest(SynchronousTestCase):
+
+	def journal(self):
+		directory = self.mktemp()
+		os.makedirs(directory)
+
+		return Journal('test', directory=directory, fsync=False)
+
+	def test_replay_01(self):
+		journal = self.journal()
+		journal.open()
+		journal.write(('a', 1))
+		journal.write(('p', 1))
+		journal.close()
+
+		self.assertEquals(list(journal.replay()), [('a', 1), ('p', 1)])
+
+	def test_purge_01(self):
+		journal = self.journal()
+		journal.open()
+		journal.write(('a', 1))
+
+		segment = journal.rotate()
+		journal.write(('a', 2))
+		journal.purge(segment)
+		journal.close()
+
+		self.assertEquals(list(journal.replay()), [('a', 2)])
+
+	def test_truncated_01(self):
+		journal = self.journal()
+		journal.open()
+		journal.write(('a', 1))
+		journal.write(('a', 'long value'))
+		journal.close()
+
+		path = journal.path(journal.segment)
+
+		with open(path, 'r+b') as fp:
+			fp.truncate(os.path.getsize(path) - 3)
+
+		self.assertEquals(list(journal.replay()), [('a', 1)])
+
+
+testCases = [JournalTest]
@@ -0,0 +1,150 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '../'))
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from core.limits import TokenBucket, DomainLimits, RateLimiter
+
+
+class LimitsTest(SynchronousTestCase):
+
+	def test_bucket_01(self):
+		bucket = TokenBucket(2, 2, 100.0)
+
+		self.assertTrue(bucket.consume(100.0))
+		self.assertTrue(bucket.consume(100.0))
+		self.assertFalse(bucket.consume(100.0))
+		self.assertEquals(bucket.delay(100.0), 0.5)
+		self.assertTrue(bucket.consume(100.5))
+
+		# Not more than burst
+		bucket.refill(1000.0)
+
+		self.assertEquals(bucket.tokens, 2)
+
+	def test_domains_01(self):
+		limits = DomainLimits({'gmail.com': (1, 2)})
+
+		self.assertTrue(limits.allowed('other.org', 100.0))
+		self.assertTrue(limits.allowed('gmail.com', 100.0))
+
+		limits.acquire('gmail.com', 100.0)
+
+		# No token
+		self.assertFalse(limits.allowed('gmail.com', 100.0))
+		self.assertTrue(limits.allowed('gmail.com', 101.0))
+
+		limits.acquire('gmail.com', 101.0)
+
+		# In flight
+		self.assertFalse(limits.allowed('gmail.com', 110.0))
+
+		limits.release('gmail.com')
+
+		self.assertTrue(limits.allowed('gmail.com', 110.0))
+		self.assertEquals(limits.stats()['gmail.com']['throttled'], 2)
+
+	def test_domains_02(self):
+		limits = DomainLimits({'gmail.com': (8, 0)}, start=4, probe=1, floor=1)
+
+		limits.response('gmail.com', 421, 100.0)
+
+		# Halved, second answer in same second ignored
+		limits.response('gmail.com', 450, 100.5)
+
+		self.assertEquals(limits.stats()['gmail.com']['rate'], 4)
+		self.assertEquals(limits.stats()['gmail.com']['deferred'], 2)
+
+		limits.response('gmail.com', 550, 102.0)
+		limits.response('gmail.com', None, 102.0)
+
+		self.assertEquals(limits.stats()['gmail.com']['rate'], 5)
+
+		for i in xrange(10):
+			limits.response('gmail.com', None, 103.0)
+
+		# Not above configured rate
+		self.assertEquals(limits.stats()['gmail.com']['rate'], 8)
+
+		# Unlimited domain, limited until recovered
+		limits.response('other.org', 421, 100.0)
+
+		self.assertEquals(limits.stats()['other.org']['rate'], 4)
+		self.assertTrue(limits.allowed('other.org', 100.0))
+
+		limits.acquire('other.org', 100.0)
+
+		self.assertFalse(limits.allowed('other.org', 100.0))
+
+		limits.response('other.org', None, 101.0)
+
+		self.assertTrue(limits.allowed('other.org', 101.0))
+
+		limits.release('other.org')
+		limits.cleanup(101.0)
+
+		self.assertEquals(limits.stats().keys(), ['gmail.com'])
+
+	def test_limiter_01(self):
+		limiter = RateLimiter(2, 2, 3600.0, hourly=5)
+
+		self.assertTrue(limiter.take(3600.0))
+		self.assertTrue(limiter.take(3600.0))
+		self.assertFalse(limiter.take(3600.0))
+		self.assertEquals(limiter.delay(3600.0), 0.5)
+
+		# In debt
+		self.assertTrue(limiter.take(3600.0, True))
+		self.assertEquals(limiter.delay(3600.0), 1.0)
+
+		self.assertTrue(limiter.take(3601.0))
+		self.assertTrue(limiter.take(3610.0))
+
+		# Hourly quota until next hour
+		self.assertFalse(limiter.take(3620.0))
+		self.assertEquals(limiter.delay(3620.0), 3580.0)
+		self.assertTrue(limiter.take(7200.0))
+
+	def test_limiter_02(self):
+		limiter = RateLimiter(0, 0, 90000.0, hourly=10, daily=3)
+
+		self.assertTrue(limiter.take(90000.0))
+		self.assertTrue(limiter.take(90001.0))
+
+		# Restart
+		restored = RateLimiter(0, 0, 90002.0, hourly=10, daily=3)
+		restored.restore(limiter.state())
+
+		self.assertTrue(restored.take(90002.0))
+		self.assertFalse(restored.take(90003.0))
+
+		# Old window is rolled
+		restored = RateLimiter(0, 0, 172800.0, daily=3)
+		restored.restore(limiter.state())
+
+		self.assertEquals(restored.delay(172800.0), 0.0)
+		self.assertEquals(restored.state(), [(86400, 2, 0)])
+
+
+testCases = [LimitsTest]
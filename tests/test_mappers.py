@@ -30,14 +30,105 @@ from twisted.internet.defer import inlineCallbacks
 from twisted.python import log
 
 from core.dirs import tmp
-from core.utils import sleep
-from core.mappers import Message
+from core.utils import sleep, LRUCache
+from core import mappers
+from core.mappers import Message, To, Bodies, shared
+
+from test_storage import MemoryStorage
 
 
 class MappersTest(SynchronousTestCase):
 
+	def setUp(self):
+		# Fields in memory, not in dbs
+		self.storage = MemoryStorage()
+
+		self.patch(mappers, 'storage', self.storage)
+		self.patch(mappers, 'cache', LRUCache(65536, 60))
+		self.patch(mappers, 'bodies', Bodies())
+
 	def test_message_01(self):
 		self.assertEquals(Message.fromDict(dict(id=1)).id, 1)
 
+	def test_message_02(self):
+		a = Message.fromDict(dict(id=1, subject='subject', html=u'<p>body</p>'))
+		b = Message.fromDict(dict(id=2, subject='subject', html=u'<p>body</p>'))
+
+		self.assertEquals(a.bodies, b.bodies)
+		self.assertEquals(b.html, u'<p>body</p>')
+
+		id, digest, size = a.bodies['html']
+
+		self.assertEquals(mappers.bodies.digests[digest][1], 2)
+
+		a.delete()
+
+		self.assertEquals(b.html, u'<p>body</p>')
+		self.assertEquals(mappers.bodies.digests[digest][1], 1)
+
+		b.delete()
+
+		self.assertNotIn(digest, mappers.bodies.digests)
+		self.assertEquals(self.storage.fields, {})
+
+	def test_message_03(self):
+		deleted = []
+
+		self.patch(self.storage, 'delete', lambda prefix, id, name: deleted.append((prefix, name)))
+
+		Message.fromDict(dict(id=1, subject='subject', html=u'<p>body</p>')).delete()
+
+		# Shared bodies are not in fields
+		self.assertEquals(deleted, [(Message.prefix, 'params'), (Message.prefix, 'text'), ('b', 'body'), ('b', 'body')])
+
+	def test_to_01(self):
+		params = dict(id=1, message=2, group=3, email='User@Example.COM', name='name',
+			replyEmail=u'reply@localhost', replyName=u'reply', time=1, after=None, priority=0, attempts=1, express=False, deadline=None)
+
+		to = To.fromDict(params)
+
+		self.assertEquals(to.toDict(), params)
+		self.assertEquals(to.domain, 'example.com')
+		self.assertFalse(hasattr(to, '__dict__'))
+
+	def test_to_02(self):
+		a = To.fromDict(dict(id=1, email='a@localhost', replyEmail=u''.join([u'reply', u'@localhost'])))
+		b = To.fromDict(dict(id=2, email='b@localhost', replyEmail=u''.join([u'reply', u'@localhost'])))
+
+		self.assertIdentical(a.replyEmail, b.replyEmail)
+		self.assertIdentical(a.domain, b.domain)
+
+	def test_shared_01(self):
+		self.patch(mappers, '_shared', dict())
+		self.patch(mappers, '_sharedSize', 2)
+
+		self.assertIdentical(shared(''.join(['local', 'host'])), intern('localhost'))
+		self.assertEquals(mappers._shared, {})
+
+		value = shared(u''.join([u'a', u'@localhost']))
+
+		self.assertIdentical(shared(u''.join([u'a', u'@localhost'])), value)
+
+		shared(u'b@localhost')
+		shared(u'c@localhost')
+
+		# Table is bounded
+		self.assertEquals(mappers._shared, {u'c@localhost': u'c@localhost'})
+
+	def test_to_03(self):
+		small = To.fromDict(dict(id=1, email='a@localhost', parts={'name': 'value'}))
+
+		self.assertEquals(To.fromDict(small.toDict()).parts, {'name': 'value'})
+
+		large = To.fromDict(dict(id=2, email='b@localhost', parts={'name': 'x' * To.inline}))
+
+		self.assertNotIn('parts', large.toDict())
+		self.assertEquals(large.parts, {'name': 'x' * To.inline})
+		self.assertEquals(self.storage.fields.keys(), [('t', 2, 'parts')])
+
+		large.delete()
+
+		self.assertEquals(self.storage.fields, {})
+
 
 testCases = [MappersTest]
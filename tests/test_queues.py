@@ -0,0 +1,251 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '../'))
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from core.queues import SpoolQueue, BucketQueue, Budget, Lane, TimingWheel
+from core.mappers import To
+
+
+class SpoolQueueTest(SynchronousTestCase):
+
+	def spool(self, **params):
+		queue = SpoolQueue('test', **params)
+		queue.directory = self.mktemp()
+
+		# Success
+		return queue
+
+	def to(self, id):
+		return To(id=id, email='{0}@localhost'.format(id), name='name', time=1)
+
+	def test_spill_01(self):
+		queue = self.spool(limit=10, batch=5, size=256)
+
+		for id in xrange(1, 101):
+			queue.append(self.to(id))
+
+		self.assertEquals(len(queue.hot), 10)
+		self.assertEquals(len(queue), 100)
+
+		ids = []
+
+		while queue:
+			ids.append(queue.popleft().id)
+
+			if len(ids) == 50:
+				# New tail after partial drain
+				queue.append(self.to(101))
+
+		self.assertEquals(ids, range(1, 102))
+		self.assertEquals(os.listdir(queue.directory), [])
+
+	def test_capture_01(self):
+		queue = self.spool(limit=3, batch=2)
+
+		for id in xrange(1, 11):
+			queue.append(self.to(id))
+
+		queue.popleft()
+		queue.popleft()
+
+		view = queue.capture()
+
+		# Changes after capture are not visible
+		queue.popleft()
+		queue.append(self.to(11))
+
+		self.assertEquals(len(view), 8)
+		self.assertEquals([to.id for to in view], range(3, 11))
+
+		queue.clear()
+
+		self.assertEquals(len(queue), 0)
+		self.assertEquals(os.listdir(queue.directory), [])
+
+	def test_budget_01(self):
+		budget = Budget(10)
+
+		first = self.spool(batch=5, budget=budget)
+		second = self.spool(batch=5, budget=budget)
+
+		for id in xrange(1, 9):
+			first.append(self.to(id))
+			second.append(self.to(id + 10))
+
+		# One limit for all queues
+		self.assertEquals(len(first.hot) + len(second.hot), 10)
+		self.assertEquals(budget.used, 10)
+
+		self.assertEquals([first.popleft().id for i in xrange(8)], range(1, 9))
+		self.assertEquals([second.popleft().id for i in xrange(8)], range(11, 19))
+		self.assertEquals(budget.used, 0)
+
+
+class LaneTest(SynchronousTestCase):
+
+	def to(self, id, after=None):
+		return To(id=id, email='{0}@localhost'.format(id), time=1, after=after)
+
+	def test_lane_01(self):
+		lane = Lane(1, SpoolQueue('test'))
+
+		lane.append(0, self.to(1))
+		lane.append(3, self.to(2))
+		lane.append(0, self.to(3))
+
+		self.assertEquals(len(lane), 3)
+		self.assertEquals([to.id for to in lane.levels[0]], [1, 3])
+		self.assertEquals(sorted(to.id for to in lane), range(1, 4))
+
+		lane.clear()
+
+		self.assertEquals(len(lane), 0)
+
+	def test_lane_02(self):
+		lane = Lane(1, SpoolQueue('test'))
+
+		for id, deadline in ((1, None), (2, 300), (3, 100), (4, None), (5, 200)):
+			to = self.to(id)
+			to.deadline = deadline
+
+			lane.append(0, to)
+
+		self.assertEquals(lane.size(0), 5)
+
+		# Earliest deadline first, then FIFO
+		self.assertEquals([lane.popleft(0).id for i in xrange(5)], [3, 5, 2, 1, 4])
+		self.assertFalse(lane.ready(0))
+
+	def test_lane_03(self):
+		budget = Budget(2)
+
+		fifo = SpoolQueue('test', budget=budget)
+		fifo.directory = self.mktemp()
+
+		lane = Lane(1, fifo, budget=budget)
+
+		for id, deadline in ((1, 300), (2, 100), (3, 200), (4, None)):
+			to = self.to(id)
+			to.deadline = deadline
+
+			lane.append(0, to)
+
+		# Over budget deadline goes to FIFO, spilled
+		self.assertEquals(fifo.spilled, 2)
+		self.assertEquals([lane.popleft(0).id for i in xrange(4)], [2, 1, 3, 4])
+		self.assertEquals(budget.used, 0)
+
+
+class BucketQueueTest(SynchronousTestCase):
+
+	def test_buckets_01(self):
+		queue = BucketQueue(11)
+
+		for level, item in ((10, 'a'), (3, 'b'), (3, 'c'), (0, 'd'), (10, 'e')):
+			queue.append(level, item)
+
+		self.assertEquals(len(queue), 5)
+
+		items = []
+
+		while queue:
+			items.append(queue.popleft(queue.first()))
+
+		self.assertEquals(items, ['d', 'b', 'c', 'a', 'e'])
+		self.assertEquals(queue.first(), None)
+		self.assertEquals(queue.mask, 0)
+
+	def test_buckets_02(self):
+		queue = BucketQueue(12)
+
+		queue.append(11, 'a')
+		queue.append(4, 'b')
+
+		# Lower levels only
+		self.assertEquals(queue.first((1 << 11) - 1), 4)
+		self.assertEquals(queue.first(1 << 11), 11)
+
+		queue.popleft(4)
+
+		self.assertEquals(queue.first((1 << 11) - 1), None)
+
+
+class TimingWheelTest(SynchronousTestCase):
+
+	def to(self, id, after):
+		return To(id=id, email='{0}@localhost'.format(id), time=1, after=after)
+
+	def test_wheel_01(self):
+		random.seed(1)
+
+		start = 1000000007
+		wheel = TimingWheel(start, bits=(4, 3, 3))
+
+		tos = [self.to(id, start + random.choice((0, 1, 15, 16, 17, 127, 128, 1024, 1025, 5000, random.randint(0, 3000))))
+			for id in xrange(1, 501)]
+
+		for to in tos:
+			if not wheel.add('owner', to):
+				self.assertEquals(to.after, start)
+
+		self.assertEquals(len(wheel), len([to for to in tos if to.after > start]))
+		self.assertEquals(sorted(to.id for to in wheel), sorted(to.id for to in tos if to.after > start))
+
+		current = start
+		released = dict()
+
+		while wheel:
+			current += random.randint(1, 40)
+
+			for owner, items in wheel.advance(current):
+				self.assertEquals(owner, 'owner')
+
+				for to in items:
+					released[to.id] = current
+
+					self.assertTrue(to.after <= current)
+					self.assertTrue(to.after > current - 40)
+
+		self.assertEquals(len(released), len([to for to in tos if to.after > start]))
+
+	def test_wheel_02(self):
+		wheel = TimingWheel(100)
+
+		wheel.add('a', self.to(1, 150))
+		wheel.add('b', self.to(2, 150))
+		wheel.add('a', self.to(3, 100000))
+
+		self.assertEquals([to.id for to in wheel.remove('a')], [1, 3])
+		self.assertEquals(len(wheel), 1)
+		self.assertEquals([(owner, [to.id for to in items]) for owner, items in wheel.advance(200)], [('b', [2])])
+
+		# Empty wheel jumps to time
+		list(wheel.advance(10 ** 6))
+
+		self.assertEquals(wheel.current, 10 ** 6)
+
+
+testCases = [SpoolQueueTest, BucketQueueTest, LaneTest, TimingWheelTest]
@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '../'))
+
+from cStringIO import StringIO
+from twisted.trial.unittest import SynchronousTestCase
+
+from core.records import RecordWriter, RecordReader
+
+
+class RecordsTest(SynchronousTestCase):
+
+	def write(self, values, size):
+		fp = StringIO()
+
+		writer = RecordWriter(fp, size=size)
+
+		for value in values:
+			writer.write(value)
+
+		writer.close()
+
+		# Success
+		return fp.getvalue()
+
+	def test_records_01(self):
+		values = [dict(id=i, email='{0}@localhost'.format(i)) for i in xrange(100)]
+		fp = StringIO(self.write(values, 512))
+
+		self.assertTrue(RecordReader.match(fp))
+		self.assertEquals(list(RecordReader(fp)), values)
+
+	def test_records_02(self):
+		self.assertFalse(RecordReader.match(StringIO('\xfb\x00\x00')))
+
+	def test_truncated_01(self):
+		values = range(1000)
+		data = self.write(values, 256)
+
+		loaded = list(RecordReader(StringIO(data[:-10])))
+
+		self.assertTrue(0 < len(loaded) < len(values))
+		self.assertEquals(loaded, values[:len(loaded)])
+
+	def test_damaged_01(self):
+		values = range(1000)
+		data = self.write(values, 256)
+
+		# Damage one byte in the middle
+		middle = len(data) // 2
+		data = data[:middle] + chr(ord(data[middle]) ^ 0xff) + data[middle + 1:]
+
+		loaded = list(RecordReader(StringIO(data)))
+
+		self.assertTrue(0 < len(loaded) < len(values))
+		self.assertEquals(loaded, values[:len(loaded)])
+
+
+testCases = [RecordsTest]
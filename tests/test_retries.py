@@ -0,0 +1,67 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '../'))
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from core.mappers import To
+from core.retries import RetryPolicy
+
+
+class RetriesTest(SynchronousTestCase):
+
+	def test_schedule_01(self):
+		policy = RetryPolicy(dict(defer=3), delay=10, factor=2, limit=30, age=1000)
+		to = To.fromDict(dict(id=1, time=100))
+
+		self.assertTrue(policy.schedule(to, 'defer', 100.0))
+		self.assertEquals(to.attempts, 1)
+		self.assertTrue(105 <= to.after <= 110)
+
+		self.assertTrue(policy.schedule(to, 'defer', 200.0))
+		self.assertTrue(210 <= to.after <= 220)
+
+		# Not more than limit
+		self.assertTrue(policy.schedule(to, 'defer', 300.0))
+		self.assertTrue(315 <= to.after <= 330)
+
+		self.assertFalse(policy.schedule(to, 'defer', 400.0))
+		self.assertEquals(policy.stats(), dict(defer=1))
+
+	def test_schedule_02(self):
+		policy = RetryPolicy(dict(defer=3), age=1000)
+
+		# Not configured class
+		self.assertFalse(policy.schedule(To.fromDict(dict(id=1, time=100)), 'reject', 100.0))
+
+		# Too old
+		self.assertFalse(policy.schedule(To.fromDict(dict(id=2, time=100)), 'defer', 1101.0))
+
+	def test_legacy_01(self):
+		to = To.fromDict(dict(id=1, time=100, retries=1))
+
+		self.assertEquals(to.attempts, 0)
+		self.assertFalse('retries' in to.toDict())
+
+
+testCases = [RetriesTest]
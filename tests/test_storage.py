@@ -0,0 +1,357 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+from marshal import loads
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '../'))
+
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.internet.defer import Deferred, succeed
+
+from core import storage as engines
+from core.storage import FilesStorage, SQLiteStorage, SegmentStorage, WriteBehindStorage
+
+
+class SegmentStorageTest(SynchronousTestCase):
+
+	def setUp(self):
+		self.directory = self.mktemp()
+
+	def storage(self, **params):
+		params.setdefault('garbage', 2)
+
+		storage = SegmentStorage(self.directory, fsync=False, **params)
+		storage.legacy = None
+
+		self.addCleanup(storage.close)
+
+		return storage
+
+	def test_segments_01(self):
+		storage = self.storage()
+		storage.set('m', 1, 'html', u'<p>body</p>')
+		storage.set('m', 1, 'text', 'body')
+		storage.set('t', 2, 'parts', {'name': 'value'})
+		storage.delete('m', 1, 'text')
+
+		self.assertEquals(storage.get('m', 1, 'html'), u'<p>body</p>')
+		self.assertEquals(storage.get('m', 1, 'text'), None)
+
+		storage.close()
+
+		# Index is rebuilt from segments
+		storage = self.storage()
+
+		self.assertEquals(storage.get('m', 1, 'html'), u'<p>body</p>')
+		self.assertEquals(storage.get('m', 1, 'text'), None)
+		self.assertEquals(storage.get('t', 2, 'parts'), {'name': 'value'})
+
+	def test_segments_02(self):
+		storage = self.storage(size=256)
+
+		for id in xrange(1, 21):
+			storage.set('t', id, 'parts', 'x' * 32)
+
+		for id in xrange(1, 16):
+			storage.delete('t', id, 'parts')
+
+		segment = storage.segments[min(storage.segments)]
+
+		for step in storage.copy(segment):
+			pass
+
+		self.assertNotIn(segment.number, storage.segments)
+		self.assertFalse(os.path.exists(segment.path))
+
+		storage.close()
+
+		storage = self.storage(size=256)
+
+		self.assertEquals([id for id in xrange(1, 21) if storage.get('t', id, 'parts')], range(16, 21))
+
+	def test_segments_03(self):
+		storage = self.storage(size=256)
+		storage.set('t', 1, 'parts', 'old')
+		storage.set('t', 2, 'parts', 'old')
+		storage.rotate()
+
+		first = min(storage.segments)
+
+		storage.delete('t', 1, 'parts')
+		storage.delete('t', 2, 'parts')
+		storage.set('t', 2, 'parts', 'new')
+		storage.rotate()
+
+		# Tombstones hide values of first segment, still there
+		for step in storage.copy(storage.segments[first + 1]):
+			pass
+
+		storage.delete('t', 2, 'parts')
+		storage.rotate()
+
+		for step in storage.copy(storage.segments[first + 2]):
+			pass
+
+		self.assertIn(first, storage.segments)
+
+		storage.close()
+
+		storage = self.storage(size=256)
+
+		self.assertEquals(storage.get('t', 1, 'parts'), None)
+		self.assertEquals(storage.get('t', 2, 'parts'), None)
+
+	def test_segments_04(self):
+		storage = self.storage(size=1024)
+		storage.set('t', 1, 'parts', 'live')
+		storage.rotate()
+
+		storage.set('t', 2, 'parts', 'x' * 32)
+		storage.delete('t', 2, 'parts')
+		storage.rotate()
+
+		live, dead = [storage.segments[number] for number in sorted(storage.segments)[:2]]
+
+		# Put and its tombstone are dead as whole
+		self.assertEquals(live.dead, 0)
+		self.assertEquals(dead.dead, dead.size)
+
+		started = []
+
+		class Task(object):
+
+			def whenDone(self):
+				return Deferred()
+
+			def stop(self):
+				pass
+
+		self.patch(storage, 'copy', lambda segment: started.append(segment) or iter(()))
+		self.patch(engines, 'cooperate', lambda iterator: Task())
+
+		storage.garbage = 0.5
+		storage.compact()
+
+		# Live segment is left as is
+		self.assertEquals(started, [dead])
+
+	def test_fsync_01(self):
+		threaded = []
+
+		def deferToThread(f, fd):
+			os.close(fd)
+			threaded.append(f)
+
+			return succeed(None)
+
+		def fsync(fd):
+			raise AssertionError('fsync on main-loop')
+
+		storage = self.storage()
+		storage.fsync = True
+
+		self.patch(engines, 'deferToThread', deferToThread)
+		self.patch(os, 'fsync', fsync)
+
+		storage.set('t', 1, 'parts', 'first')
+		storage.flush(False)
+
+		self.assertEquals(threaded, [engines.fsync])
+
+		storage.fsync = False
+
+	def test_truncated_01(self):
+		storage = self.storage()
+		storage.set('t', 1, 'parts', 'first')
+		storage.set('t', 2, 'parts', 'second')
+		storage.close()
+
+		path = storage.active.path
+
+		with open(path, 'r+b') as fp:
+			fp.truncate(os.path.getsize(path) - 1)
+
+		storage = self.storage()
+
+		self.assertEquals(storage.get('t', 1, 'parts'), 'first')
+		self.assertEquals(storage.get('t', 2, 'parts'), None)
+
+
+class SQLiteStorageTest(SynchronousTestCase):
+
+	def storage(self):
+		storage = SQLiteStorage(self.mktemp(), interval=60)
+
+		self.addCleanup(storage.close)
+
+		return storage
+
+	def test_sqlite_01(self):
+		storage = self.storage()
+		storage.set('m', 1, 'html', u'<p>body</p>')
+		storage.set('m', 1, 'text', 'body')
+		storage.set('t', 2, 'parts', {'name': 'value'})
+		storage.delete('m', 1, 'text')
+
+		# Served from overlay before commit
+		self.assertEquals(storage.reader.execute('SELECT COUNT(*) FROM blobs').fetchone()[0], 0)
+		self.assertEquals(storage.get('m', 1, 'html'), u'<p>body</p>')
+		self.assertEquals(storage.get('m', 1, 'text'), None)
+
+		storage.flush()
+
+		self.assertEquals(storage.overlay, {})
+		self.assertEquals(storage.batch, [])
+		self.assertEquals(storage.get('m', 1, 'html'), u'<p>body</p>')
+		self.assertEquals(storage.get('m', 1, 'text'), None)
+		self.assertEquals(storage.get('t', 2, 'parts'), {'name': 'value'})
+
+	def test_sqlite_02(self):
+		storage = self.storage()
+		storage.set('t', 1, 'parts', 'first')
+
+		batch, storage.batch = storage.batch, []
+		storage.generation += 1
+
+		# Newer than batch in thread
+		storage.set('t', 2, 'parts', 'second')
+		storage.execute(batch)
+		storage.committed(None, storage.generation)
+
+		self.assertEquals(storage.overlay.keys(), [('t', 2, 'parts')])
+		self.assertEquals(storage.get('t', 1, 'parts'), 'first')
+		self.assertEquals(storage.get('t', 2, 'parts'), 'second')
+
+	def test_sqlite_03(self):
+		storage = self.storage()
+
+		journal = storage.journal('tos')
+		journal.write(('a', dict(id=3, status=0)))
+		journal.write(('a', dict(id=1, status=0)))
+		journal.write(('a', dict(id=2, status=0)))
+		journal.write(('s', 1, 2))
+		journal.write(('p', 2))
+		journal.write(('a', dict(id=4, status=0)))
+		journal.flush()
+
+		# Replay in order of writes, after counter
+		self.assertEquals(list(journal.replay()), ([
+			('n', 5),
+			('a', dict(id=3, status=0)),
+			('a', dict(id=1, status=2)),
+			('a', dict(id=4, status=0)),
+		]))
+
+		self.assertEquals(list(storage.journal('messages').replay()), [])
+
+	def test_counter_01(self):
+		file = self.mktemp()
+
+		storage = SQLiteStorage(file)
+		storage.journal('tos').write(('a', dict(id=7, status=0)))
+		storage.journal('tos').write(('p', 7))
+		storage.close()
+
+		# Counter outlives deleted rows
+		storage = SQLiteStorage(file)
+
+		self.addCleanup(storage.close)
+
+		self.assertEquals(list(storage.journal('tos').replay()), [('n', 8)])
+		self.assertEquals(list(storage.journal('messages').replay()), [])
+
+	def test_fallback_01(self):
+		storage = self.storage()
+		storage.legacy = MemoryStorage()
+		storage.legacy.set('m', 1, 'html', u'<p>old</p>')
+
+		self.assertEquals(storage.get('m', 1, 'html'), u'<p>old</p>')
+
+		storage.set('m', 1, 'html', u'<p>new</p>')
+		storage.flush()
+
+		self.assertEquals(storage.get('m', 1, 'html'), u'<p>new</p>')
+
+		storage.delete('m', 1, 'html')
+		storage.flush()
+
+		self.assertEquals(storage.legacy.fields, {})
+		self.assertEquals(storage.get('m', 1, 'html'), None)
+
+		storage.legacy = None
+		storage.fallback()
+
+		self.assertIsInstance(storage.legacy, FilesStorage)
+
+
+class MemoryStorage(FilesStorage):
+
+	def __init__(self):
+		self.fields = dict()
+
+	def write(self, prefix, id, name, data):
+		self.fields[(prefix, id, name)] = data
+
+	def get(self, prefix, id, name):
+		if (prefix, id, name) in self.fields:
+			return loads(self.fields[(prefix, id, name)])
+
+	def delete(self, prefix, id, name):
+		self.fields.pop((prefix, id, name), None)
+
+
+class WriteBehindStorageTest(SynchronousTestCase):
+
+	def test_write_behind_01(self):
+		engine = MemoryStorage()
+
+		storage = WriteBehindStorage(engine, limit=64, interval=60)
+		storage.set('t', 1, 'parts', {'name': 'value'})
+		storage.set('t', 2, 'parts', {'name': 'other'})
+		storage.delete('t', 2, 'parts')
+
+		# Served from memory before flush
+		self.assertEquals(engine.fields, {})
+		self.assertEquals(storage.get('t', 1, 'parts'), {'name': 'value'})
+		self.assertEquals(storage.get('t', 2, 'parts'), None)
+
+		storage.flush()
+
+		self.assertEquals(storage.overlay, {})
+		self.assertEquals(storage.bytes, 0)
+		self.assertEquals(sorted(engine.fields), [('t', 1, 'parts')])
+		self.assertEquals(storage.get('t', 1, 'parts'), {'name': 'value'})
+
+	def test_write_behind_02(self):
+		storage = WriteBehindStorage(MemoryStorage(), limit=64, interval=60)
+		storage.batch.append(('set', 't', 1, 'parts', 'x' * 64))
+		storage.bytes = storage.sizes[1] = 64
+
+		drained = storage.drained()
+
+		self.assertTrue(storage.full)
+		self.assertNoResult(drained)
+
+		storage.flush()
+
+		self.assertFalse(storage.full)
+		self.successResultOf(drained)
@@ -0,0 +1,76 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2013 p0is0n (poisonoff@gmail.com).
+#
+# This file is part of Mail-Services.
+#
+# Mail-Services is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mail-Services is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Mail-Services.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '../'))
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from core.utils import Latencies, LRUCache
+
+
+class UtilsTest(SynchronousTestCase):
+
+	def test_latencies_01(self):
+		latencies = Latencies(size=100, target=2)
+
+		self.assertEquals(latencies.percentile(99), None)
+
+		for i in xrange(1, 201):
+			latencies.add(i / 50.0)
+
+		# Last 100 only
+		self.assertEquals(latencies.percentile(50), 3.0)
+		self.assertEquals(latencies.percentile(99), 3.98)
+		self.assertEquals(latencies.stats()['count'], 200)
+		self.assertEquals(latencies.stats()['late'], 100)
+
+	def test_cache_01(self):
+		cache = LRUCache(10)
+		cache.set('a', 'xxxx')
+		cache.set('b', 'xxxx')
+
+		self.assertEquals(cache.get('a'), 'xxxx')
+
+		# Least recently used goes first
+		cache.set('c', 'xxxx')
+
+		self.assertEquals(cache.get('b'), None)
+		self.assertEquals(cache.get('a'), 'xxxx')
+		self.assertEquals(cache.bytes, 8)
+		self.assertEquals(cache.stats()['evictions'], 1)
+
+		cache.set('d', 'x' * 11)
+
+		self.assertEquals(cache.get('d'), None)
+		self.assertEquals(len(cache), 2)
+
+	def test_cache_02(self):
+		cache = LRUCache(100, life=60)
+		cache.set('a', {'name': 'value'})
+		cache.entries['a'] = cache.entries['a'][:2] + (1, )
+
+		self.assertEquals(cache.get('a'), None)
+		self.assertEquals(cache.bytes, 0)
+		self.assertEquals(cache.stats()['expirations'], 1)
+
+
+testCases = [UtilsTest]